@@ -0,0 +1,122 @@
+"""
+Compares the CPU cost of compressing the JSON responses with the bytes it saves, for every available encoding and
+a range of levels, on realistic offer pages: a page of /offers/<page> and a long /user/<id>/offers list, which is
+also compressed the way it is streamed (flushed after every batch). The levels currently configured in
+compression.COMPRESSION_LEVELS are marked, * by default and + for the long lists.
+
+The offers have varied titles and descriptions, sellers with 1-3 accepted currencies (so 1-3 converted prices each)
+and images with hashed names and real placeholders.
+
+Usage: python benchmarks/compression_benchmark.py [--offers 15 500] [--repeat 20]
+"""
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from hashlib import sha256
+from os import environ
+from pathlib import Path
+from random import Random
+from statistics import median
+from time import perf_counter
+
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src" / "harnas"))
+for name in ("POSTGRES_HOST", "POSTGRES_USER", "POSTGRES_PASSWORD", "POSTGRES_DB_MAIN", "SERVICE_ACCOUNT_PATH"):
+    environ.setdefault(name, "unused")
+environ.setdefault("IMAGE_OUTPUT", "unused")
+environ.setdefault("ROOT_URL", "https://api.example.com")
+
+from PIL import Image as PILImage
+
+from currencies import Currency, Price
+from images import Image, make_placeholder
+from offers import Offer
+from users import User
+
+import compression
+import json_encoder
+import serializer
+
+LEVELS = {
+    "gzip": [1, 3, 5, 6, 9],
+    "br": [1, 3, 4, 5, 6, 8, 11],
+    "zstd": [1, 3, 6, 9, 12, 19],
+}
+
+WORDS = ("półeczka szafka krzesło stół lampa rower hulajnoga książka płyta gra konsola telefon laptop monitor "
+         "kurtka buty plecak torba zegarek aparat obiektyw głośnik słuchawki kubek czajnik garnek patelnia "
+         "używany nowy stan bardzo dobry idealny sprawny odbiór osobisty wysyłka możliwa cena do negocjacji "
+         "okazja zamienię sprzedam oddam pilnie Kraków Warszawa Gdańsk Wrocław Poznań Łódź").split()
+
+
+def make_offers(offers: int, seed: int = 1) -> list[Offer]:
+    rng = Random(seed)
+    currencies = [Currency("Harnaś", "HAR", 1.0), Currency("Perła", "PER", 3.7), Currency("Złoty", "PLN", 0.25)]
+    sellers = [User(f"{sha256(str(i).encode()).hexdigest()[:28]}", f"seller{i}@example.com",
+                    " ".join(rng.choice(WORDS).capitalize() for _ in range(2)), rng.sample(currencies, 1 + i % 3), [])
+               for i in range(50)]
+    placeholders = []
+    for i in range(20):
+        colors = [tuple(rng.randrange(256) for _ in range(3)) for _ in range(4)]
+        img = PILImage.new("RGB", (160, 90), colors[0])
+        for j, color in enumerate(colors[1:]):
+            img.paste(color, (40 * j + rng.randrange(40), rng.randrange(45), 160, 90))
+        placeholders.append(make_placeholder(img))
+
+    page = []
+    created_at = datetime(2022, 10, 31, 18, 32, 19, 123456)
+    for i in range(offers):
+        images = []
+        for j in range(rng.randrange(1, 5)):
+            name = sha256(f"{i}-{j}".encode()).hexdigest()
+            images.append(Image(None, 4 * i + j, f"{name}_original.jpg", f"{name}_preview.jpg",
+                                f"{name}_thumbnail.jpg", placeholder=rng.choice(placeholders)))
+        created_at -= timedelta(seconds=rng.randrange(3600), microseconds=rng.randrange(10 ** 6))
+        page.append(Offer(10000 - i, " ".join(rng.choice(WORDS) for _ in range(rng.randrange(2, 7))).capitalize(),
+                          " ".join(rng.choice(WORDS) for _ in range(rng.randrange(5, 80))).capitalize() + ".",
+                          Price(rng.randrange(1, 5000), rng.choice(currencies)), rng.choice(sellers), images,
+                          rng.choice(WORDS[-6:]), created_at))
+
+    return page
+
+
+def timed(function, repeat: int) -> tuple[bytes, float]:
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        result = function()
+        times.append(perf_counter() - start)
+    return result, median(times)
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--offers", type=int, nargs="+", default=[15, 500])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"available: {', '.join(compression.AVAILABLE)}")
+
+    for offers in args.offers:
+        page = make_offers(offers)
+        body, serialize_time = timed(lambda: serializer.dumps(page), args.repeat)
+        batches = [serializer.dumps(page[i:i + 100])[1:-1] for i in range(0, offers, 100)]
+
+        print(f"\n{offers} offers, {len(body) / 1024:.1f} kB, serialized in {serialize_time * 1000:.2f} ms")
+        print(f"{'encoding':<10} {'level':>5} {'kB':>8} {'ratio':>6} {'ms':>7} {'MB/s':>7} {'streamed kB':>12} "
+              f"{'streamed ms':>12}")
+
+        for encoding in compression.AVAILABLE:
+            for level in LEVELS[encoding]:
+                compressed, elapsed = timed(lambda: compression.compress(body, encoding, level), args.repeat)
+                streamed, streamed_elapsed = timed(
+                    lambda: b"".join(compression.compress_stream(iter(batches), encoding, level)), args.repeat)
+                mark = " *" if level == compression.COMPRESSION_LEVELS["default"][encoding] else ""
+                mark += " +" if level == compression.LONG_LIST_LEVELS[encoding] else ""
+                print(f"{encoding:<10} {level:>5} {len(compressed) / 1024:8.1f} {len(body) / len(compressed):6.1f} "
+                      f"{elapsed * 1000:7.2f} {len(body) / elapsed / 1e6:7.0f} {len(streamed) / 1024:12.1f} "
+                      f"{streamed_elapsed * 1000:12.2f}{mark}")
+
+
+if __name__ == "__main__":
+    main()
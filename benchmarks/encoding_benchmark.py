@@ -0,0 +1,98 @@
+"""
+Compares JPEG encoding profiles for every rendition: the total size, the median encode time and the quality (PSNR
+against the unencoded rendition) over a corpus of photos.
+
+The candidates are Pillow's defaults, a few variations of quality, progressive encoding, Huffman table optimization
+and chroma subsampling, and the profile currently configured in images.ENCODING_PROFILES. A synthetic corpus is
+generated unless a directory with real photos is given, which is much more representative.
+
+Usage: python benchmarks/encoding_benchmark.py [--corpus DIR] [--repeat 3]
+"""
+from argparse import ArgumentParser
+from io import BytesIO
+from os import environ
+from pathlib import Path
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import math
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src" / "harnas"))
+for name in ("POSTGRES_HOST", "POSTGRES_USER", "POSTGRES_PASSWORD", "POSTGRES_DB_MAIN", "IMAGE_OUTPUT"):
+    environ.setdefault(name, "unused")
+
+from PIL import Image as PILImage, ImageChops, ImageStat
+
+from images import Image, ENCODING_PROFILES, RENDITIONS, SIZES, decode_for_renditions, encode
+from renditions_benchmark import make_corpus
+
+CANDIDATES = {
+    "pillow default": {},
+    "q75 optimize": {"quality": 75, "optimize": True},
+    "q75 opt prog": {"quality": 75, "optimize": True, "progressive": True},
+    "q80 optimize": {"quality": 80, "optimize": True},
+    "q80 opt prog": {"quality": 80, "optimize": True, "progressive": True},
+    "q85 opt prog": {"quality": 85, "optimize": True, "progressive": True},
+    "q80 opt 4:4:4": {"quality": 80, "optimize": True, "subsampling": "4:4:4"},
+    "q90 opt prog": {"quality": 90, "optimize": True, "progressive": True},
+}
+
+
+def psnr(reference: PILImage.Image, encoded: bytes) -> float:
+    with PILImage.open(BytesIO(encoded)) as img:
+        difference = ImageChops.difference(reference, img.convert("RGB"))
+    mse = sum(ImageStat.Stat(difference).sum2) / (3 * reference.width * reference.height)
+    return float("inf") if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+
+def renditions_of(path: Path) -> list[PILImage.Image]:
+    with PILImage.open(path) as raw_image:
+        decoded = decode_for_renditions(raw_image, SIZES)
+        if decoded.mode != "RGB":
+            decoded = decoded.convert("RGB")
+        return [Image.crop_center(decoded, width, height) for width, height in SIZES]
+
+
+def measure(rendition: PILImage.Image, profile: dict, repeat: int) -> tuple[int, float, float]:
+    times = []
+    for _ in range(repeat):
+        file = BytesIO()
+        ENCODING_PROFILES["benchmark"] = profile
+        start = perf_counter()
+        encode(rendition, file, "JPEG", "benchmark")
+        times.append(perf_counter() - start)
+    encoded = file.getvalue()
+    return len(encoded), median(times), psnr(rendition, encoded)
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--corpus", type=Path, help="directory with the photos to use instead of the synthetic ones")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    import pillow_heif
+    pillow_heif.register_heif_opener()
+
+    with TemporaryDirectory() as tmp:
+        paths = sorted(p for p in args.corpus.iterdir() if p.is_file()) if args.corpus else make_corpus(Path(tmp))
+        corpus = [renditions_of(path) for path in paths]
+
+    for i, name in enumerate(RENDITIONS):
+        candidates = {**CANDIDATES, "configured": ENCODING_PROFILES[name]}
+        print(f"\n{name} {SIZES[i][0]}x{SIZES[i][1]}, {len(corpus)} images")
+        print(f"{'profile':<16} {'total kB':>9} {'vs default':>10} {'encode ms':>10} {'PSNR dB':>8}")
+
+        baseline = None
+        for label, profile in candidates.items():
+            results = [measure(renditions[i], profile, args.repeat) for renditions in corpus]
+            size = sum(r[0] for r in results)
+            baseline = baseline or size
+            print(f"{label:<16} {size / 1024:9.1f} {size / baseline:10.0%} {median(r[1] for r in results) * 1000:10.2f} "
+                  f"{median(r[2] for r in results):8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Load tests the /image endpoint with a hot set of thumbnails, as requested by the offer lists.
+
+Measures the throughput and latency of full downloads, of revalidations with If-None-Match (which should be answered
+with 304 Not Modified) and of Range requests (which should be answered with 206 Partial Content). Run it against a
+server started with gunicorn, pointed at a directory with the renditions to request.
+
+Usage: python benchmarks/image_serving_load.py --url http://localhost:8080 --images DIR [--requests 5000]
+       [--concurrency 16] [--hot 50]
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
+from pathlib import Path
+from statistics import median, quantiles
+from time import perf_counter
+from urllib.parse import urlsplit
+
+import itertools
+import threading
+
+
+class Client(threading.local):
+    """ A keep-alive connection per thread """
+
+    def __init__(self, host: str, port: int):
+        self.connection = HTTPConnection(host, port, timeout=30)
+
+    def get(self, path: str, headers: dict) -> tuple[int, dict, int]:
+        self.connection.request("GET", path, headers=headers)
+        response = self.connection.getresponse()
+        body = response.read()
+        return response.status, dict(response.getheaders()), len(body)
+
+
+def scenario(client: Client, names: list[str], etags: dict, kind: str, requests: int, concurrency: int) -> dict:
+    cycle = itertools.cycle(names)
+    lock = threading.Lock()
+
+    def one(_):
+        with lock:
+            name = next(cycle)
+
+        headers = {}
+        if kind == "revalidate":
+            headers["If-None-Match"] = etags[name]
+        elif kind == "range":
+            headers["Range"] = "bytes=0-1023"
+
+        start = perf_counter()
+        status, _, size = client.get(f"/image/{name}", headers)
+        return perf_counter() - start, status, size
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one, range(requests)))
+    elapsed = perf_counter() - start
+
+    latencies = [r[0] * 1000 for r in results]
+    return {
+        "rps": requests / elapsed,
+        "p50": median(latencies),
+        "p99": quantiles(latencies, n=100)[98],
+        "statuses": sorted({r[1] for r in results}),
+        "bytes": sum(r[2] for r in results)
+    }
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--images", type=Path, required=True, help="the IMAGE_OUTPUT directory of the server")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--hot", type=int, default=50, help="the number of distinct thumbnails to request")
+    args = parser.parse_args()
+
+    names = sorted(p.name for p in args.images.rglob("*_thumbnail.jpg"))[:args.hot]
+    if not names:
+        parser.error(f"no thumbnails in {args.images}")
+
+    url = urlsplit(args.url)
+    client = Client(url.hostname, url.port or 80)
+
+    etags = {}
+    for name in names:
+        status, headers, _ = client.get(f"/image/{name}", {})
+        if status != 200:
+            parser.error(f"GET /image/{name} returned {status}")
+        etags[name] = headers.get("ETag", "")
+
+    print(f"{'scenario':<12} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'MiB':>8} statuses")
+    for kind in ("full", "revalidate", "range"):
+        r = scenario(client, names, etags, kind, args.requests, args.concurrency)
+        print(f"{kind:<12} {r['rps']:9.0f} {r['p50']:8.2f} {r['p99']:8.2f} {r['bytes'] / 2 ** 20:8.1f} "
+              f"{','.join(map(str, r['statuses']))}")
+
+
+if __name__ == "__main__":
+    main()
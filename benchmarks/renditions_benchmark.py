@@ -0,0 +1,129 @@
+"""
+Compares the wall time and peak memory of generating the renditions of an upload before and after the single-decode,
+cascaded resizing in images.generate_renditions.
+
+Every measurement runs in a fresh process, so that the peak RSS of one run does not hide the next one. A synthetic
+corpus of JPEG, HEIC and PNG photos is generated unless a directory with real ones is given.
+
+Usage: python benchmarks/renditions_benchmark.py [--corpus DIR] [--repeat 3]
+"""
+from argparse import ArgumentParser
+from multiprocessing import get_context
+from os import environ
+from pathlib import Path
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import resource
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src" / "harnas"))
+for name in ("POSTGRES_HOST", "POSTGRES_USER", "POSTGRES_PASSWORD", "POSTGRES_DB_MAIN"):
+    environ.setdefault(name, "unused")
+
+CORPUS = [
+    ("photo_48mp.jpg", "JPEG", (8000, 6000)),
+    ("photo_12mp.jpg", "JPEG", (4032, 3024)),
+    ("photo_12mp.heic", "HEIF", (4032, 3024)),
+    ("screenshot.png", "PNG", (2560, 1600)),
+    ("small.jpg", "JPEG", (800, 600)),
+]
+
+
+def make_corpus(directory: Path) -> list[Path]:
+    from PIL import Image as PILImage, ImageDraw
+
+    paths = []
+    for name, fmt, size in CORPUS:
+        img = PILImage.radial_gradient("L").resize(size).convert("RGB")
+        draw = ImageDraw.Draw(img)
+        for x in range(0, size[0], max(size[0] // 60, 1)):
+            draw.line((x, 0, size[0] - x, size[1]), fill=(x % 256, 90, 200), width=5)
+        img.save(directory / name, fmt)
+        paths.append(directory / name)
+    return paths
+
+
+def legacy_renditions(source: Path, output: Path) -> None:
+    """ The rendition generation before the cascade: three crops and resizes of the full resolution image """
+    from PIL import Image as PILImage
+    from images import Image, SIZES
+
+    with PILImage.open(source) as raw_image:
+        for i, (width, height) in enumerate(SIZES):
+            rendition = Image.crop_center(raw_image, width, height)
+            if rendition.mode != "RGB":
+                rendition = rendition.convert("RGB")
+            rendition.save(output / f"legacy_{i}.jpg", "JPEG")
+
+
+def cascaded_renditions(source: Path, output: Path) -> None:
+    import images
+    from storage import LocalStorage
+
+    images.storage = LocalStorage(output, "", shard_depth=0)
+    images.generate_renditions(str(source), ["new_0.jpg", "new_1.jpg", "new_2.jpg"])
+
+
+def measure(variant: str, source: str, output: str, queue) -> None:
+    environ["IMAGE_OUTPUT"] = output
+    function = legacy_renditions if variant == "legacy" else cascaded_renditions
+
+    # Keep the imports out of the measured time
+    import images
+
+    start = perf_counter()
+    function(Path(source), Path(output))
+    elapsed = perf_counter() - start
+
+    queue.put((elapsed, peak_rss_mib()))
+
+
+def peak_rss_mib() -> float:
+    # ru_maxrss survives exec on Linux, so it would include the parent's peak, VmHWM starts over
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(variant: str, source: Path, output: Path) -> tuple[float, float]:
+    context = get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=measure, args=(variant, str(source), str(output), queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--corpus", type=Path, help="directory with the images to use instead of the synthetic ones")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    import pillow_heif
+    pillow_heif.register_heif_opener()
+
+    with TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        paths = sorted(p for p in args.corpus.iterdir() if p.is_file()) if args.corpus else make_corpus(tmp)
+
+        print(f"{'file':<22} {'variant':<9} {'wall ms':>9} {'peak RSS MiB':>13}")
+        for path in paths:
+            for variant in ("legacy", "cascaded"):
+                runs = [run(variant, path, tmp) for _ in range(args.repeat)]
+                wall = median(r[0] for r in runs) * 1000
+                rss = max(r[1] for r in runs)
+                print(f"{path.name:<22} {variant:<9} {wall:9.1f} {rss:13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Compares the "levenshtein" and "trigram" search modes of Offer.search_offers_page on a seeded table.
+
+The offers are seeded into a separate piwegro_bench schema, the piwegro schema is not modified apart from the
+pg_trgm and fuzzystrmatch extensions. Uses the same POSTGRES_* environment variables as the application.
+
+Usage: python benchmarks/search_benchmark.py [--rows 1000000] [--repeat 5] [--keep]
+"""
+from argparse import ArgumentParser
+from os import environ
+from pathlib import Path
+from statistics import median
+from time import perf_counter
+
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src" / "harnas"))
+environ.setdefault("SERVICE_ACCOUNT_PATH", "unused")
+environ.setdefault("IMAGE_OUTPUT", "unused")
+
+import psycopg2
+
+from offers import SEARCH_QUERIES, RESULTS_PER_PAGE
+
+WORDS = ["półka", "szafa", "rower", "krzesło", "stół", "lampa", "biurko", "kanapa", "fotel", "regał",
+         "komoda", "lustro", "dywan", "zegar", "telewizor", "laptop", "telefon", "kurtka", "buty", "plecak"]
+ADJECTIVES = ["stary", "nowy", "duży", "mały", "drewniany", "metalowy", "czarny", "biały", "ładny", "tani"]
+QUERIES = ["polka", "rower", "krzeslo", "stol drewniany", "lampa biurkowa", "szafa", "telefn", "kurtka zimowa"]
+DEEP_PAGE = 200
+
+
+def connect():
+    return psycopg2.connect(host=environ["POSTGRES_HOST"], user=environ["POSTGRES_USER"],
+                            password=environ["POSTGRES_PASSWORD"], dbname=environ["POSTGRES_DB_MAIN"],
+                            options="-c search_path=piwegro_bench,piwegro,public")
+
+
+def seed(conn, rows: int) -> None:
+    with conn.cursor() as cursor:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm SCHEMA piwegro")
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS fuzzystrmatch SCHEMA piwegro")
+        cursor.execute("CREATE SCHEMA IF NOT EXISTS piwegro_bench")
+        cursor.execute("DROP TABLE IF EXISTS piwegro_bench.offers")
+        cursor.execute("CREATE TABLE piwegro_bench.offers (LIKE piwegro.offers INCLUDING DEFAULTS)")
+        cursor.execute("SELECT setseed(0.42)")
+        cursor.execute("INSERT INTO piwegro_bench.offers (seller_id, name, description, price, currency, images, "
+                       "created_at) "
+                       "SELECT 'bench', (%s::text[])[1 + floor(random() * %s)::int] || ' ' || "
+                       "(%s::text[])[1 + floor(random() * %s)::int], 'Opis', "
+                       "1 + floor(random() * 100)::int, 'HAR', '{}', NOW() - i * INTERVAL '1 second' "
+                       "FROM generate_series(1, %s) AS i",
+                       (ADJECTIVES, len(ADJECTIVES), WORDS, len(WORDS), rows))
+        cursor.execute("CREATE INDEX ON piwegro_bench.offers USING GIN (LOWER(name) gin_trgm_ops)")
+        cursor.execute("CREATE INDEX ON piwegro_bench.offers (created_at DESC, id DESC)")
+        cursor.execute("ANALYZE piwegro_bench.offers")
+    conn.commit()
+
+
+def timed(conn, query: str, params: dict, repeat: int) -> tuple[float, list]:
+    times = []
+    result = []
+    for _ in range(repeat):
+        with conn.cursor() as cursor:
+            start = perf_counter()
+            cursor.execute(query, params)
+            result = cursor.fetchall()
+            times.append(perf_counter() - start)
+        conn.rollback()
+    return median(times) * 1000, result
+
+
+def run(conn, mode: str, search: str, repeat: int) -> dict:
+    queries = SEARCH_QUERIES[mode]
+    params = {"query": search, "max_len": len(search) / 2, "limit": RESULTS_PER_PAGE + 1}
+
+    first_ms, first = timed(conn, queries["page"], {**params, "offset": 0}, repeat)
+    deep_ms, _ = timed(conn, queries["page"], {**params, "offset": DEEP_PAGE * RESULTS_PER_PAGE}, repeat)
+
+    after_ms = None
+    if len(first) > RESULTS_PER_PAGE:
+        last = first[RESULTS_PER_PAGE - 1]
+        after_ms, _ = timed(conn, queries["after"], {**params, "score": last[-1], "offer_id": last[0]}, repeat)
+
+    return {"first": first_ms, "deep_offset": deep_ms, "cursor": after_ms,
+            "ids": [row[0] for row in first[:RESULTS_PER_PAGE]]}
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--keep", action="store_true", help="keep the seeded piwegro_bench schema")
+    args = parser.parse_args()
+
+    conn = connect()
+    print(f"Seeding {args.rows} offers...")
+    seed(conn, args.rows)
+
+    fmt = lambda ms: "-" if ms is None else f"{ms:9.1f}"
+    print(f"{'query':<16} {'mode':<12} {'page 0 ms':>9} {'page ' + str(DEEP_PAGE) + ' ms':>11} "
+          f"{'cursor ms':>9} {'overlap':>7}")
+    for search in QUERIES:
+        results = {mode: run(conn, mode, search, args.repeat) for mode in ("levenshtein", "trigram")}
+        old_ids, new_ids = set(results["levenshtein"]["ids"]), set(results["trigram"]["ids"])
+        overlap = len(old_ids & new_ids) / len(old_ids) if old_ids else 1.0
+        for mode, r in results.items():
+            print(f"{search:<16} {mode:<12} {fmt(r['first'])} {fmt(r['deep_offset']):>11} {fmt(r['cursor'])} "
+                  f"{overlap:7.0%}")
+
+    if not args.keep:
+        with conn.cursor() as cursor:
+            cursor.execute("DROP SCHEMA piwegro_bench CASCADE")
+        conn.commit()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
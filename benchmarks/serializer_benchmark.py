@@ -0,0 +1,123 @@
+"""
+Compares the time of serializing a page of 1000 offers with the isinstance chain of the former APIEncoder and with the
+encoders registered in json_encoder, on the standard library and on orjson. Every output is checked to be byte for
+byte the same as the one of the former encoder.
+
+Usage: python benchmarks/serializer_benchmark.py [--offers 1000] [--repeat 20]
+"""
+from argparse import ArgumentParser
+from datetime import datetime
+from json import JSONEncoder, dumps as json_dumps
+from os import environ
+from pathlib import Path
+from statistics import median
+from time import perf_counter
+
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src" / "harnas"))
+for name in ("POSTGRES_HOST", "POSTGRES_USER", "POSTGRES_PASSWORD", "POSTGRES_DB_MAIN", "SERVICE_ACCOUNT_PATH"):
+    environ.setdefault(name, "unused")
+environ.setdefault("IMAGE_OUTPUT", "unused")
+environ.setdefault("ROOT_URL", "https://api.example.com")
+
+from currencies import Currency, Price
+from error import Error
+from images import Image
+from messages import Message
+from offers import Offer
+from review import Review
+from users import User
+from storage import storage
+
+import json_encoder
+import serializer
+
+
+class LegacyEncoder(JSONEncoder):
+    """ The encoder before the registry, without Flask's fallbacks which the payload does not need """
+
+    def default(self, obj):
+        if isinstance(obj, Error):
+            return {'error': obj.message}
+        if isinstance(obj, Offer):
+            prices = []
+            for c in obj.seller.accepted_currencies:
+                prices.append(obj.price.convert_to(c))
+            return {'offer_id': obj.offer_id, 'title': obj.title, 'description': obj.description, 'price': prices,
+                    'seller': obj.seller, 'images': obj.images, 'location': obj.location,
+                    'created_at': obj.created_at}
+        if isinstance(obj, Currency):
+            return {'symbol': obj.symbol, 'name': obj.name, 'value': obj.value}
+        if isinstance(obj, Image):
+            return {'image_id': obj.image_id, 'status': obj.status, 'original': storage.url(obj.original),
+                    'preview': storage.url(obj.preview), 'thumbnail': storage.url(obj.thumbnail),
+                    'placeholder': obj.placeholder}
+        if isinstance(obj, Message):
+            return {'message_id': obj.message_id, 'sender_id': obj.sender.uid, 'receiver_id': obj.receiver.uid,
+                    'content': obj.content, 'sent_at': obj.sent_at}
+        if isinstance(obj, Price):
+            return {'amount': obj.amount, 'currency': obj.currency}
+        if isinstance(obj, User):
+            return {'uid': obj.uid, 'name': obj.name, 'accepted_currencies': obj.accepted_currencies}
+        if isinstance(obj, Review):
+            return {'reviewer_id': obj.reviewer.uid, 'reviewee_id': obj.reviewee.uid, 'review': obj.review}
+        if isinstance(obj, datetime):
+            return obj.isoformat()
+        return super().default(obj)
+
+
+def legacy_dumps(obj) -> bytes:
+    return json_dumps(obj, cls=LegacyEncoder, ensure_ascii=True, sort_keys=True, separators=(",", ":")).encode()
+
+
+def make_page(offers: int) -> dict:
+    currencies = [Currency("Harnaś", "HAR", 1.0), Currency("Perła", "PER", 3.7), Currency("Złoty", "PLN", 0.25)]
+    sellers = [User(f"seller{i}", f"seller{i}@example.com", f"Sprzedawca {i}", currencies[:1 + i % 3], [])
+               for i in range(50)]
+
+    page = []
+    for i in range(offers):
+        images = [Image(None, 3 * i + j, f"{i:032x}{j}_original.jpg", f"{i:032x}{j}_preview.jpg",
+                        f"{i:032x}{j}_thumbnail.jpg", placeholder="data:image/jpeg;base64," + "A" * 300)
+                  for j in range(3)]
+        page.append(Offer(i, f"Półeczka nr {i}", "Bardzo ładna półeczka we wspaniałym stanie. " * 4,
+                          Price(100 + i * 7, currencies[i % 3]), sellers[i % 50], images, "Kraków",
+                          datetime(2022, 10, 31, 18, 32, i % 60, i)))
+
+    return {"offers": page, "next_cursor": "eyJpZCI6IDEwMDB9"}
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--offers", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    page = make_page(args.offers)
+    expected = legacy_dumps(page)
+
+    variants = {"legacy isinstance chain": legacy_dumps, "registry, json": serializer.dumps_json}
+    if serializer.orjson is not None:
+        variants["registry, orjson"] = serializer.dumps_orjson
+
+    print(f"{args.offers} offers, {len(expected) / 1024:.0f} kB")
+    print(f"{'variant':<24} {'median ms':>10} {'speedup':>8}")
+    baseline = None
+    for label, dumps in variants.items():
+        if dumps(page) != expected:
+            raise AssertionError(f"{label} does not produce the same output")
+
+        times = []
+        for _ in range(args.repeat):
+            start = perf_counter()
+            dumps(page)
+            times.append(perf_counter() - start)
+
+        elapsed = median(times)
+        baseline = baseline or elapsed
+        print(f"{label:<24} {elapsed * 1000:10.2f} {baseline / elapsed:7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
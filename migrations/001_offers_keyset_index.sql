@@ -0,0 +1,4 @@
+SET search_path TO piwegro;
+
+-- Keyset pagination of /offers/<page> walks offers newest first
+CREATE INDEX IF NOT EXISTS offers_created_at_id_idx ON offers (created_at DESC, id DESC);
@@ -0,0 +1,6 @@
+SET search_path TO piwegro;
+
+-- Index-backed fuzzy search over offer names (SEARCH_MODE=trigram)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS offers_name_trgm_idx ON offers USING GIN (LOWER(name) gin_trgm_ops);
@@ -0,0 +1,13 @@
+SET search_path TO piwegro;
+
+-- Tells the currency registries of all workers to reload when the currencies change
+CREATE OR REPLACE FUNCTION notify_currencies_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('currencies_changed', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS currencies_changed ON currencies;
+CREATE TRIGGER currencies_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON currencies
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_currencies_changed();
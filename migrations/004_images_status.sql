@@ -0,0 +1,5 @@
+SET search_path TO piwegro;
+
+-- Renditions are generated in the background, the stored upload is kept to generate them from
+ALTER TABLE images ADD COLUMN IF NOT EXISTS status VARCHAR(16) NOT NULL DEFAULT 'ready';
+ALTER TABLE images ADD COLUMN IF NOT EXISTS source VARCHAR(255);
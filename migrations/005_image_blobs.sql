@@ -0,0 +1,14 @@
+SET search_path TO piwegro;
+
+-- Uploads are stored under the SHA-256 of their bytes, every distinct upload is rendered once and shared by
+-- the images with the same content. The images referencing them are counted, for reclaiming unused files.
+CREATE TABLE IF NOT EXISTS image_blobs(
+    hash CHAR(64) PRIMARY KEY,
+    refcount INTEGER NOT NULL DEFAULT 0,
+    -- new or failed: no renditions and nobody generating them, pending: being generated, ready: generated
+    status VARCHAR(16) NOT NULL DEFAULT 'new',
+    created_at TIMESTAMP DEFAULT NOW()
+);
+
+ALTER TABLE images ADD COLUMN IF NOT EXISTS content_hash CHAR(64) REFERENCES image_blobs(hash);
+CREATE INDEX IF NOT EXISTS images_content_hash_idx ON images (content_hash);
@@ -0,0 +1,4 @@
+SET search_path TO piwegro;
+
+-- A tiny inline JPEG shown until the preview is loaded, backfilled with backfill_placeholders.py
+ALTER TABLE images ADD COLUMN IF NOT EXISTS placeholder TEXT;
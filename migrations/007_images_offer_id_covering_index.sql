@@ -0,0 +1,6 @@
+SET search_path TO piwegro;
+
+-- The images of a page of offers are loaded with one `offer_id = ANY(...)` query, which this index answers with an
+-- index-only scan, already in (offer_id, id) order
+CREATE INDEX IF NOT EXISTS images_offer_id_covering_idx ON images (offer_id, id)
+    INCLUDE (original, preview, thumbnail, status, source, content_hash, placeholder);
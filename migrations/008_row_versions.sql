@@ -0,0 +1,61 @@
+SET search_path TO piwegro;
+
+-- Row versions of the offers and the users, the entity tags of /offer/<id> and /user/<id> are made from them
+ALTER TABLE offers ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 1;
+ALTER TABLE offers ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT NOW();
+ALTER TABLE users ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 1;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT NOW();
+
+-- A review is replaced by deleting and inserting it, never updated
+ALTER TABLE IF EXISTS reviews ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT NOW();
+
+CREATE OR REPLACE FUNCTION bump_row_version() RETURNS trigger AS $$
+BEGIN
+    NEW.version := OLD.version + 1;
+    NEW.updated_at := NOW();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS offers_row_version ON offers;
+CREATE TRIGGER offers_row_version BEFORE UPDATE ON offers
+    FOR EACH ROW EXECUTE FUNCTION bump_row_version();
+
+DROP TRIGGER IF EXISTS users_row_version ON users;
+CREATE TRIGGER users_row_version BEFORE UPDATE ON users
+    FOR EACH ROW EXECUTE FUNCTION bump_row_version();
+
+-- The images of an offer are shown with it, a change of any of them is a new version of the offer
+CREATE OR REPLACE FUNCTION touch_image_offer() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' AND OLD.offer_id IS NOT NULL THEN
+        UPDATE piwegro.offers SET updated_at = NOW() WHERE id = OLD.offer_id;
+    END IF;
+    IF TG_OP <> 'DELETE' AND NEW.offer_id IS NOT NULL
+            AND (TG_OP = 'INSERT' OR NEW.offer_id IS DISTINCT FROM OLD.offer_id) THEN
+        UPDATE piwegro.offers SET updated_at = NOW() WHERE id = NEW.offer_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS images_touch_offer ON images;
+CREATE TRIGGER images_touch_offer AFTER INSERT OR UPDATE OR DELETE ON images
+    FOR EACH ROW EXECUTE FUNCTION touch_image_offer();
+
+-- And so are the accepted currencies of a user
+CREATE OR REPLACE FUNCTION touch_accepted_currencies_user() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        UPDATE piwegro.users SET updated_at = NOW() WHERE id = OLD.user_id;
+    END IF;
+    IF TG_OP <> 'DELETE' AND (TG_OP = 'INSERT' OR NEW.user_id IS DISTINCT FROM OLD.user_id) THEN
+        UPDATE piwegro.users SET updated_at = NOW() WHERE id = NEW.user_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS accepted_currencies_touch_user ON accepted_currencies;
+CREATE TRIGGER accepted_currencies_touch_user AFTER INSERT OR UPDATE OR DELETE ON accepted_currencies
+    FOR EACH ROW EXECUTE FUNCTION touch_accepted_currencies_user();
@@ -0,0 +1,5 @@
+SET search_path TO piwegro;
+
+-- When the renditions of a stored upload were claimed. A claim older than IMAGE_CLAIM_TIMEOUT is taken again, so
+-- the uploads claimed by a worker that died before it finished are rendered by the next upload of the content
+ALTER TABLE image_blobs ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP;
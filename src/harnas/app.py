@@ -1,43 +1,114 @@
 # Flask import
-from flask import Flask, request, make_response, send_from_directory
-from flask_cors import CORS
+from flask import Flask, Response, request, make_response, send_file, abort
 
 # Exceptions import
 from exc import PostgresError, FirebaseError, \
-    UserNotFoundError, UserAlreadyExistsError, CurrencyNotFoundError, OfferNotFoundError
+    UserNotFoundError, UserAlreadyExistsError, CurrencyNotFoundError, OfferNotFoundError, InvalidCursorError, \
+    ImageEncodingError, ImageNotFoundError, ImageTooLargeError
 
 
 # Functions and classes import
-from currencies import Currency
+from currencies import Currency, registry as currency_registry
 from error import Error
 from firebase import FirebaseUser, initialize_firebase, verify_token
 from review import Review
 from health import check_health
-from images import Image
+from db import pool_stats
+from images import Image, RENDITION_SIZES, RENDITION_FORMATS, IMAGE_MAX_BYTES, profile_digest
 from messages import Message
 from offers import Offer
-from users import User
-from favorites import add_to_favorites, remove_from_favorites, get_user_favorites
-
-from json_encoder import APIEncoder, as_json
+from users import User, user_cache
+from favorites import add_to_favorites, remove_from_favorites, get_user_favorites, stream_user_favorite_rows
+import renditions
+from pagination import parse_page
+from disk_cache import DiskCache
+from image_responses import IMAGE_MAX_AGE, cache_forever, not_modified, send_image
+
+from json_encoder import APIJSONProvider, as_json, conditional, offer_fields, stream_response, encode_offer_rows, \
+    NDJSON_MIMETYPE
+from fragments import offer_fragments
+from hashlib import sha1
+from json import loads
 from os import environ
+from pathlib import Path
+import metrics
+import compression
+from cors import enable_cors
 
 app = Flask(__name__)
-app.json_encoder = APIEncoder
+app.json = APIJSONProvider(app)
 
-CORS(app)
+enable_cors(app)
 
 initialize_firebase()
 
 IMAGE_PATH = environ["IMAGE_OUTPUT"]
+IMAGE_BATCH_LIMIT = int(environ.get("IMAGE_BATCH_LIMIT", "20"))
+
+# The renditions rendered on demand, in a size-bounded cache. The size is the budget of every worker process, the
+# directory may take up to the number of workers times it
+RENDITION_CACHE_DIR = environ.get("RENDITION_CACHE_DIR", str(Path(IMAGE_PATH, "cache")))
+RENDITION_CACHE_SIZE = int(environ.get("RENDITION_CACHE_SIZE", str(1024 ** 3)))
+rendition_cache = DiskCache(RENDITION_CACHE_DIR, RENDITION_CACHE_SIZE)
+
+# A base64 encoded image is read into memory as a whole, and so is a JSON batch of them. Bigger batches have to be
+# uploaded as multipart files, which are spooled to disk
+IMAGE_BASE64_MAX_BYTES = IMAGE_MAX_BYTES * 4 // 3 + 4
+IMAGE_JSON_BATCH_MAX_BYTES = int(environ.get("IMAGE_JSON_BATCH_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# Bound the size of whole requests too, a multipart batch of images being the biggest one
+app.config["MAX_CONTENT_LENGTH"] = IMAGE_BATCH_LIMIT * IMAGE_MAX_BYTES + 64 * 1024
+
+# Let a reverse proxy send the image files with X-Sendfile instead of the WSGI server
+app.config["USE_X_SENDFILE"] = environ.get("USE_X_SENDFILE", "false").lower() == "true"
+
+currency_registry.start()
+
+metrics.register("harnas_db_pool", pool_stats)
+metrics.register("harnas_currencies", currency_registry.stats)
+metrics.register("harnas_user_cache", user_cache.stats)
+metrics.register("harnas_rendition_cache", rendition_cache.stats)
+metrics.register("harnas_process", metrics.process_memory)
+metrics.register("harnas_renditions", renditions.stats)
+metrics.register("harnas_compression", compression.stats)
+metrics.register("harnas_offer_fragments", offer_fragments.stats)
+
+# The prices of the cached offers are converted with the old exchange rates, the memory is freed right away
+currency_registry.subscribe(lambda snapshot: offer_fragments.clear())
+
+app.after_request(compression.compress_response)
+
+def wants_ndjson() -> bool:
+    """
+    NDJSON is opt-in, with ?format=ndjson or an Accept header preferring it to JSON.
+    """
+    if request.args.get("format") == "ndjson":
+        return True
+
+    return request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+
+# The versions the entity tags of the conditional GETs are made from, the prices and the accepted currencies are
+# shown with the current exchange rates
+def offer_version(offer_id: str):
+    versions = Offer.get_version(offer_id)
+    return None if versions is None else (versions, currency_registry.snapshot.version)
+
+
+def user_version(user_id: str):
+    version = User.get_version(user_id)
+    return None if version is None else (version, currency_registry.snapshot.version)
+
 
 # GETTING OFFERS
 # Get a single offer by  its id
 @app.route("/offer/<offer_id>", methods=["GET"])
+@conditional(offer_version)
+@offer_fields
 @as_json
 def hande_get_offer_by_id(offer_id: str):
     try:
-        return Offer.get_offer_by_id(offer_id), 200
+        return encode_offer_rows([Offer.get_offer_row_by_id(offer_id)])[0], 200
     except OfferNotFoundError:
         return Error("Offer not found"), 400
     except Exception as e:
@@ -47,14 +118,19 @@ def hande_get_offer_by_id(offer_id: str):
 
 # Get all offers for a query (paginated)
 @app.route("/offers/search/<query>/<page>", methods=["GET"])
+@offer_fields
 @as_json
-def handle_get_offers_by_query(query: str, page: int):
+def handle_get_offers_by_query(query: str, page: str):
     try:
-        resp = make_response(Offer.search_offers(query, page))
+        page_number, cursor = parse_page(page)
+        raw_offers, next_cursor = Offer.search_offer_rows_page(query, page_number, cursor)
+        resp = make_response(encode_offer_rows(raw_offers))
         resp.status_code = 200
-        # TODO: Set the correct headers
-        # resp.headers["X-Total-Count"] = 0
+        if next_cursor is not None:
+            resp.headers["X-Next-Cursor"] = next_cursor
         return resp
+    except InvalidCursorError:
+        return Error("Invalid page"), 400
     except Exception as e:
         print("Exception:", e)
         return Error("Internal server error"), 500
@@ -62,14 +138,21 @@ def handle_get_offers_by_query(query: str, page: int):
 
 # Get all offers (paginated)
 @app.route("/offers/<page>", methods=["GET"])
+@offer_fields
 @as_json
-def handle_get_all_offers(page: int):
+def handle_get_all_offers(page: str):
     try:
-        resp = make_response(Offer.get_all_offers())
+        page_number, cursor = parse_page(page)
+        raw_offers, next_cursor = Offer.get_offer_rows_page(page_number, cursor)
+        offers = encode_offer_rows(raw_offers)
+        # A page is small and the cursor of the next one has to be known before the body, it is not streamed
+        resp = stream_response([offers], ndjson=True) if wants_ndjson() else make_response(offers)
         resp.status_code = 200
-        # TODO: Set the correct headers
-        # resp.headers["X-Total-Count"] = 0
+        if next_cursor is not None:
+            resp.headers["X-Next-Cursor"] = next_cursor
         return resp
+    except InvalidCursorError:
+        return Error("Invalid page"), 400
     except Exception as e:
         print("Exception:", e)
         return Error("Internal server error"), 500
@@ -77,10 +160,12 @@ def handle_get_all_offers(page: int):
 
 # Get all offers by a user id (not paginated)
 @app.route("/user/<user_id>/offers", methods=["GET"])
+@offer_fields
 @as_json
 def handle_get_offers_by_user_id(user_id: str):
     try:
-        return Offer.get_offers_by_user_id(user_id), 200
+        return stream_response(map(encode_offer_rows, Offer.stream_offer_rows_by_user_id(user_id)),
+                               wants_ndjson()), 200
     except UserNotFoundError:
         return Error("User not found"), 400
     except Exception as e:
@@ -156,6 +241,31 @@ def handle_add_offer():
     return offer, 201
 
 
+def read_body(limit: int) -> bytes:
+    """
+    Reads the body of the request into memory, rejected before it is read when its size is known, and as soon as
+    it grows over the limit otherwise (e.g. when it is chunked).
+
+    :param limit: The most bytes the body may have.
+    :return: The body.
+    :raises ImageTooLargeError: If the body has more bytes.
+    """
+    if request.content_length is not None and request.content_length > limit:
+        raise ImageTooLargeError(f"more than {limit} bytes")
+
+    chunks = []
+    size = 0
+    while True:
+        chunk = request.stream.read(64 * 1024)
+        if not chunk:
+            return b"".join(chunks)
+
+        size += len(chunk)
+        if size > limit:
+            raise ImageTooLargeError(f"more than {limit} bytes")
+        chunks.append(chunk)
+
+
 # Post images
 @app.route("/image", methods=["POST"])
 @as_json
@@ -167,11 +277,30 @@ def handle_post_images():
         print("Exception:", e)
         return Error("Unauthorized"), 401
 
-    body = request.get_data(cache=False)
-
     try:
-        img = Image.new_image_base64(body)
-        img.save()
+        if request.mimetype.startswith("image/"):
+            # Rejected before the body is read when its size is known. Clients used to send base64 strings with any
+            # content type, those are still accepted
+            if request.content_length is not None and request.content_length > IMAGE_BASE64_MAX_BYTES:
+                raise ImageTooLargeError(f"more than {IMAGE_BASE64_MAX_BYTES} bytes")
+            img = Image.new_image_stream(request.stream, base64_fallback=True)
+        elif request.mimetype == "multipart/form-data":
+            # Werkzeug spools the uploaded files to disk while parsing the form
+            file = request.files.get("image") or next(iter(request.files.values()), None)
+            if file is None:
+                return Error("Missing file: 'image'"), 400
+            img = Image.new_image_file(file.stream)
+        else:
+            img = Image.new_image_base64(read_body(IMAGE_BASE64_MAX_BYTES))
+    except ImageTooLargeError:
+        return Error("Image too large"), 413
+    except ImageEncodingError:
+        return Error("Unsupported image"), 400
+
+    try:
+        img.save_original()
+        if img.needs_renditions:
+            renditions.submit(img)
         return img, 201
 
     except Exception as e:
@@ -179,15 +308,122 @@ def handle_post_images():
         return Error("Internal server error"), 500
 
 
+# Post many images at once, as multipart files or a JSON list of base64 strings
+@app.route("/images", methods=["POST"])
+@as_json
+def handle_post_images_batch():
+    try:
+        verify_token(request.headers["Authorization"].split(" ")[1])
+    except Exception as e:
+        print("Exception:", e)
+        return Error("Unauthorized"), 401
+
+    if request.mimetype == "multipart/form-data":
+        uploads = [file.stream for _, file in request.files.items(multi=True)]
+        new_image = Image.new_image_file
+    else:
+        try:
+            uploads = loads(read_body(IMAGE_JSON_BATCH_MAX_BYTES))
+        except ImageTooLargeError:
+            return Error(f"A JSON batch may have at most {IMAGE_JSON_BATCH_MAX_BYTES} bytes, "
+                         f"upload bigger ones as multipart/form-data"), 413
+        except ValueError:
+            uploads = None
+
+        new_image = Image.new_image_base64
+        if not isinstance(uploads, list):
+            return Error("Expected a list of base64 encoded images"), 400
+
+    if len(uploads) == 0:
+        return Error("No images"), 400
+    if len(uploads) > IMAGE_BATCH_LIMIT:
+        return Error(f"At most {IMAGE_BATCH_LIMIT} images can be uploaded at once"), 400
+
+    # Every image fails on its own, the result keeps the order of the uploads
+    results = []
+    for upload in uploads:
+        try:
+            img = new_image(upload)
+            img.store_upload()
+            results.append(img)
+        except ImageTooLargeError:
+            results.append(Error("Image too large"))
+        except ImageEncodingError:
+            results.append(Error("Unsupported image"))
+        except Exception as e:
+            print("Exception:", e)
+            results.append(Error("Could not store the image"))
+
+    try:
+        Image.insert_pending([img for img in results if isinstance(img, Image)])
+    except PostgresError as e:
+        print("PostgresError:", e)
+        return Error("Internal server error"), 500
+
+    for img in results:
+        if isinstance(img, Image) and img.needs_renditions:
+            renditions.submit(img)
+
+    return results, 201
+
+
 # Handle images
 @app.route("/image/<path:path>", methods=["GET"])
 def handle_get_image(path: str):
-    return send_from_directory(IMAGE_PATH, path)
+    return send_image(path)
+
+
+# Render an image in one of the allowed sizes and formats on the first request, e.g. /image/13/640x360.webp
+@app.route("/image/<int:image_id>/<int:width>x<int:height>.<extension>", methods=["GET"])
+def handle_get_image_rendition(image_id: int, width: int, height: int, extension: str):
+    if (width, height) not in RENDITION_SIZES or extension not in RENDITION_FORMATS:
+        abort(404)
+
+    # The renditions are cached forever, they are named by the encoding profile so that a new one is not served stale
+    name = f"{image_id}_{width}x{height}_{profile_digest(extension)}.{extension}"
+    etag = sha1(name.encode("utf-8")).hexdigest()
+
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    def render(output: Path) -> None:
+        img = Image.get_image_by_id(image_id)
+        # Images uploaded before the uploads were kept are rendered from their biggest rendition
+        source = img.source or (img.original if img.is_ready else None)
+        if source is None:
+            raise ImageNotFoundError(image_id)
+        renditions.render(source, str(output), width, height, extension)
+
+    def send() -> Response:
+        try:
+            path = rendition_cache.get_or_create(name, render)
+        except (ImageNotFoundError, FileNotFoundError):
+            abort(404)
+        except Exception as e:
+            print("Exception:", e)
+            abort(500)
+
+        return send_file(path, RENDITION_FORMATS[extension][1], etag=etag, max_age=IMAGE_MAX_AGE, conditional=True)
+
+    try:
+        resp = send()
+    except FileNotFoundError:
+        # Evicted by another process, or by a concurrent request, after it was looked up. Looked up once more, which
+        # renders it again
+        try:
+            resp = send()
+        except FileNotFoundError as e:
+            print("Exception:", e)
+            abort(500)
+
+    resp.accept_ranges = "bytes"
+    return cache_forever(resp)
 
 
 # USER MANAGEMENT
 # Get a single user's info (including accepted currencies) by its id
 @app.route("/user/<user_id>", methods=["GET"])
+@conditional(user_version)
 @as_json
 def handle_user_by_id(user_id: str):
     try:
@@ -254,8 +490,7 @@ def handle_get_user_conversations():
         return Error("Unauthorized"), 401
 
     try:
-        result = Message.get_messages_by_user_id(user_id)
-        return result, 200
+        return stream_response(Message.stream_messages_by_user_id(user_id), wants_ndjson()), 200
     except UserNotFoundError:
         return Error("User with given ID not found"), 400
     except Exception as e:
@@ -339,10 +574,14 @@ def handle_send_message():
 # CURRENCIES
 # Get all currencies accepted by the system
 @app.route("/currencies", methods=["GET"])
+@conditional(lambda: currency_registry.snapshot.version)
 @as_json
 def handle_get_all_currencies():
     try:
-        return Currency.get_currencies(), 200
+        resp = make_response(Currency.get_currencies())
+        resp.status_code = 200
+        resp.headers["X-Currencies-Version"] = currency_registry.snapshot.version
+        return resp
     except Exception as e:
         print("Exception:", e)
         return Error("Internal server error"), 500
@@ -386,6 +625,7 @@ def handle_add_review():
 
 # Get all reviews for a user
 @app.route("/reviews/<user_id>", methods=["GET"])
+@conditional(lambda user_id: Review.get_version(user_id))
 @as_json
 def handle_get_reviews(user_id: str):
     try:
@@ -399,6 +639,7 @@ def handle_get_reviews(user_id: str):
 
 # Get the user favorites
 @app.route("/favorites")
+@offer_fields
 @as_json
 def handle_get_favorites():
     # TODO: Handle it better
@@ -409,7 +650,7 @@ def handle_get_favorites():
         return Error("Unauthorized"), 401
 
     try:
-        return get_user_favorites(user), 200
+        return stream_response(map(encode_offer_rows, stream_user_favorite_rows(user)), wants_ndjson()), 200
     except Exception as e:
         print("Exception:", e)
         return Error("Error"), 401
@@ -418,6 +659,7 @@ def handle_get_favorites():
 # FAVORITES
 # Add an offer to a user's favorites
 @app.route("/favorites/<offer_id>", methods=["PUT"])
+@offer_fields
 @as_json
 def handle_add_favorite(offer_id):
     # TODO: Handle it better
@@ -437,6 +679,7 @@ def handle_add_favorite(offer_id):
 
 # Remove an offer from a user's favorites
 @app.route("/favorites/<offer_id>", methods=["DELETE"])
+@offer_fields
 @as_json
 def handle_remove_favorite(offer_id):
     # TODO: Handle it better
@@ -448,7 +691,7 @@ def handle_remove_favorite(offer_id):
 
     try:
         remove_from_favorites(user, offer_id)
-        return get_user_favorites(user), 200
+        return stream_response(map(encode_offer_rows, stream_user_favorite_rows(user)), wants_ndjson()), 200
     except Exception as e:
         print("Exception:", e)
         return Error("Error"), 401
@@ -467,6 +710,14 @@ def handle_health():
     }, status_code
 
 
+# Expose the worker's metrics in the Prometheus text format
+@app.route("/metrics", methods=["GET"])
+def handle_metrics():
+    resp = make_response(metrics.render())
+    resp.mimetype = "text/plain"
+    return resp
+
+
 # Handle root queries
 @app.route("/", methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
 def handle_root():
@@ -0,0 +1,57 @@
+"""
+Generates the placeholders of the images uploaded before they were generated with the renditions, from their
+previews. Works in batches ordered by id, so it can be interrupted and run again.
+
+Usage: python backfill_placeholders.py [--batch 500] [--workers 4]
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image as PILImage
+
+from db import fetch, execute
+from images import IMAGE_READY, make_placeholder
+from storage import storage
+
+
+def placeholder_of(preview: str) -> str | None:
+    try:
+        with storage.open(preview) as file, PILImage.open(file) as img:
+            return make_placeholder(img.convert("RGB"))
+    except Exception as e:
+        print(f"Exception while generating the placeholder of {preview}:", e)
+        return None
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    last_id = 0
+    updated = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        while True:
+            rows = fetch("SELECT id, preview FROM images WHERE placeholder IS NULL AND status = %s AND id > %s "
+                         "ORDER BY id LIMIT %s", (IMAGE_READY, last_id, args.batch))
+            if len(rows) == 0:
+                break
+            last_id = rows[-1][0]
+
+            # Images with the same content share the preview, it is only read once
+            previews = {preview for _, preview in rows if not preview.startswith("http")}
+            placeholders = dict(zip(previews, executor.map(placeholder_of, previews)))
+
+            values = [(image_id, placeholders[preview]) for image_id, preview in rows
+                      if placeholders.get(preview) is not None]
+            if len(values) > 0:
+                execute("UPDATE images SET placeholder = data.placeholder FROM (VALUES " +
+                        ", ".join(["(%s, %s)"] * len(values)) + ") AS data (id, placeholder) "
+                        "WHERE images.id = data.id", tuple(v for value in values for v in value))
+            updated += len(values)
+            print(f"{updated} placeholders generated, up to image {last_id}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+import threading
+import time
+
+
+class LRUCache:
+    """
+    A thread-safe, size-bounded least recently used cache with an optional time to live for the entries.
+    Counts hits, misses and evictions so that they can be exported as metrics.
+    """
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        # key -> (value, expiry time)
+        self._entries: OrderedDict[Hashable, tuple[Any, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Gets the value cached under the key and marks it as recently used.
+
+        :param key: The key.
+        :param default: The value to return if the key is not cached or has expired.
+        :return: The cached value or the default.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            if entry[1] < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """
+        Caches the value under the key, evicting the least recently used entries if the cache is full.
+
+        :param key: The key.
+        :param value: The value.
+        """
+        if self.max_size <= 0:
+            return
+
+        expiry = float("inf") if self.ttl is None else time.monotonic() + self.ttl
+
+        with self._lock:
+            self._entries[key] = (value, expiry)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        """
+        Removes the key from the cache. Does nothing if the key is not cached.
+
+        :param key: The key.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """
+        Removes all entries from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
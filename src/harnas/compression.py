@@ -0,0 +1,202 @@
+from flask import request, Response
+from os import environ
+from typing import Dict, Iterator
+
+from cache import LRUCache
+
+import gzip
+import threading
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Smaller responses are sent as they are, compressing them saves less than it costs
+COMPRESSION_MIN_SIZE = int(environ.get("COMPRESSION_MIN_SIZE", "1024"))
+# The encodings offered, the preferred one first when the client accepts many equally. Those whose library is not
+# installed are skipped, gzip is always there
+COMPRESSION_ENCODINGS = environ.get("COMPRESSION_ENCODINGS", "zstd,br,gzip").split(",")
+# The number of compressed responses kept for their entity tags
+COMPRESSION_CACHE_SIZE = int(environ.get("COMPRESSION_CACHE_SIZE", "512"))
+# Bigger responses are compressed every time, so that a few of them cannot take over the cache
+COMPRESSION_CACHE_MAX_BYTES = 256 * 1024
+
+COMPRESSIBLE_MIMETYPES = {"application/json", "application/x-ndjson"}
+
+# The lists that are not paginated grow with the data, they are compressed about as fast as they are serialized
+# (1.5 MB of offers to about a tenth in 4 ms with zstd, 4 ms with brotli and 16 ms with gzip)
+LONG_LIST_LEVELS = {"zstd": 3, "br": 1, "gzip": 3}
+
+# The levels by encoding, per endpoint (the name of the view function). Tuned with
+# benchmarks/compression_benchmark.py, see there for the cost of the other levels
+COMPRESSION_LEVELS: Dict[str, Dict[str, int]] = {
+    # The single objects and the pages of 15 offers (about 45 kB, to 15%) take well under a millisecond
+    "default": {"zstd": 6, "br": 5, "gzip": 6},
+    "handle_get_offers_by_user_id": LONG_LIST_LEVELS,
+    "handle_get_user_conversations": LONG_LIST_LEVELS,
+    "handle_get_favorites": LONG_LIST_LEVELS,
+    "handle_add_favorite": LONG_LIST_LEVELS,
+    "handle_remove_favorite": LONG_LIST_LEVELS,
+}
+
+AVAILABLE = [encoding for encoding in COMPRESSION_ENCODINGS
+             if encoding == "gzip" or (encoding == "br" and brotli is not None)
+             or (encoding == "zstd" and zstandard is not None)]
+
+# Compressed bodies by (path with the query, entity tag, encoding), a tagged response is the same for everyone
+compression_cache = LRUCache(COMPRESSION_CACHE_SIZE)
+
+_stats_lock = threading.Lock()
+_stats = {"responses": 0, "streamed": 0, "bytes_in": 0, "bytes_out": 0}
+
+
+def level(endpoint: str | None, encoding: str) -> int:
+    """
+    :param endpoint: The name of the view function.
+    :param encoding: The content encoding.
+    :return: The compression level for the responses of the endpoint.
+    """
+    levels = COMPRESSION_LEVELS.get(endpoint) or COMPRESSION_LEVELS["default"]
+    return levels.get(encoding, COMPRESSION_LEVELS["default"][encoding])
+
+
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    """
+    Compresses a whole body.
+
+    :param data: The body.
+    :param encoding: "gzip", "br" or "zstd".
+    :param level: The compression level (the quality for brotli).
+    :return: The compressed body.
+    """
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if encoding == "gzip":
+        return gzip.compress(data, level, mtime=0)
+
+    raise ValueError(f"Unknown content encoding: {encoding}")
+
+
+def compress_stream(chunks: Iterator[bytes], encoding: str, level: int) -> Iterator[bytes]:
+    """
+    Compresses a streamed body as it is written. Every chunk is flushed, so that the client can read the items of a
+    chunk as soon as it arrives.
+
+    :param chunks: The chunks of the body, closed when the compressed stream is.
+    :param encoding: "gzip", "br" or "zstd".
+    :param level: The compression level (the quality for brotli).
+    :return: A generator of the compressed chunks.
+    """
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=level)
+        process, flush, finish = compressor.process, compressor.flush, compressor.finish
+    elif encoding == "zstd":
+        compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        process, finish = compressor.compress, compressor.flush
+        flush = lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+    elif encoding == "gzip":
+        compressor = zlib.compressobj(level, wbits=31)
+        process, finish = compressor.compress, compressor.flush
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+    else:
+        raise ValueError(f"Unknown content encoding: {encoding}")
+
+    try:
+        for chunk in chunks:
+            compressed = process(chunk) + flush()
+            _count(len(chunk), len(compressed))
+            yield compressed
+        yield finish()
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+def negotiate() -> str | None:
+    """
+    :return: The encoding of the available ones the client of the current request prefers, None for none.
+    """
+    return request.accept_encodings.best_match(AVAILABLE)
+
+
+def compress_response(response: Response) -> Response:
+    """
+    Compresses a JSON response with the encoding negotiated with the client, to be registered with
+    `app.after_request`. Responses that are small, already encoded, sent from a file or marked no-transform are
+    left as they are. The compressed bodies of responses with an entity tag are cached by the tag.
+
+    :param response: The response.
+    :return: The same response, compressed if it should be.
+    """
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+
+    response.vary.add("Accept-Encoding")
+
+    if response.status_code != 200 or response.direct_passthrough or response.cache_control.no_transform \
+            or "Content-Encoding" in response.headers:
+        return response
+
+    encoding = negotiate()
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding, level(request.endpoint, encoding))
+        response.headers.pop("Content-Length", None)
+        response.content_encoding = encoding
+        with _stats_lock:
+            _stats["streamed"] += 1
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESSION_MIN_SIZE:
+        return response
+
+    etag, weak = response.get_etag()
+    key = (request.full_path, etag, encoding) if etag is not None else None
+
+    compressed = compression_cache.get(key) if key is not None else None
+    if compressed is None:
+        compressed = compress(data, encoding, level(request.endpoint, encoding))
+        _count(len(data), len(compressed))
+        if key is not None and len(compressed) <= COMPRESSION_CACHE_MAX_BYTES:
+            compression_cache.put(key, compressed)
+
+    response.set_data(compressed)
+    response.content_encoding = encoding
+    # A strong tag is of the exact bytes, the compressed ones are another representation
+    if etag is not None and not weak:
+        response.set_etag(f"{etag}-{encoding}")
+
+    with _stats_lock:
+        _stats["responses"] += 1
+    return response
+
+
+def _count(bytes_in: int, bytes_out: int) -> None:
+    with _stats_lock:
+        _stats["bytes_in"] += bytes_in
+        _stats["bytes_out"] += bytes_out
+
+
+def stats() -> dict[str, int]:
+    """
+    :return: The number of compressed responses (whole and streamed), the bytes compressed and the bytes they
+        were compressed to, and the counters of the cache of compressed bodies.
+    """
+    with _stats_lock:
+        values = dict(_stats)
+
+    values.update({f"cache_{name}": value for name, value in compression_cache.stats().items()})
+    return values
@@ -0,0 +1,14 @@
+from flask import Flask
+from flask_cors import CORS
+
+# Browser clients can read only the CORS-safelisted headers of the responses and the ones exposed here
+EXPOSED_HEADERS = ["X-Next-Cursor", "X-Currencies-Version"]
+
+
+def enable_cors(app: Flask) -> None:
+    """
+    Lets the API be called from any origin, with the custom headers of the responses readable by the clients.
+
+    :param app: The application.
+    """
+    CORS(app, expose_headers=EXPOSED_HEADERS)
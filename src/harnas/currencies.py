@@ -1,9 +1,29 @@
 # Exceptions import
-from exc import CurrencyNotFoundError
+from exc import CurrencyNotFoundError, PostgresError
 
 # Functions import
-from dataclasses import dataclass
-from db import fetch
+from dataclasses import dataclass, field
+from db import fetch, new_connection
+from hashlib import sha1
+from os import environ
+from psycopg2 import sql
+from select import select
+from typing import Callable, Sequence
+
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# How often the currency registry is reloaded, in seconds
+CURRENCY_REFRESH_INTERVAL = float(environ.get("CURRENCY_REFRESH_INTERVAL", "300"))
+# The channel notified by the currencies table trigger, empty to only reload periodically
+CURRENCY_NOTIFY_CHANNEL = environ.get("CURRENCY_NOTIFY_CHANNEL", "currencies_changed")
+# Fewer prices are converted one by one, making the arrays costs more than it saves below about 8
+VECTORIZE_MIN_PRICES = 8
 
 
 @dataclass(init=True, eq=True, order=True, unsafe_hash=False, frozen=False)
@@ -16,25 +36,16 @@ class Currency:
     @classmethod
     def get_currencies(cls) -> list["Currency"]:
         """
-        Gets all possible currencies from the database
+        Gets all possible currencies from the currency registry
 
         :return: A list of all currencies
         """
-        c = []
-
-        result = fetch("SELECT symbol, name, exchange_rate FROM currencies", ())
-        if result is None:
-            raise CurrencyNotFoundError("No currencies found")
-        for raw_currency in result:
-            currency = Currency(raw_currency[1], raw_currency[0], raw_currency[2])
-            c.append(currency)
-
-        return c
+        return registry.all()
 
     @classmethod
     def get_currency_by_symbol(cls, symbol: str) -> "Currency":
         """
-        Gets a currency by its symbol
+        Gets a currency by its symbol from the currency registry
 
         :param symbol: The symbol of the currency
 
@@ -42,16 +53,20 @@ class Currency:
 
         :raises CurrencyNotFoundError: If the currency does not exist
         """
-        result = fetch("SELECT symbol, name, exchange_rate FROM currencies WHERE symbol = %s", (symbol,))
-        if result is None:
-            raise CurrencyNotFoundError(symbol)
-        if len(result) > 1:
-            raise CurrencyNotFoundError(symbol)
-        raw_currency = result[0]
-        if raw_currency is None:
-            raise CurrencyNotFoundError(symbol)
+        return registry.get(symbol)
+
+    @classmethod
+    def get_currencies_by_symbols(cls, symbols: list[str]) -> dict[str, "Currency"]:
+        """
+        Gets many currencies by their symbols from the currency registry
+
+        :param symbols: The symbols of the currencies
 
-        return cls(raw_currency[1], raw_currency[0], raw_currency[2])
+        :return: A mapping from the symbol to the currency
+
+        :raises CurrencyNotFoundError: If any of the currencies does not exist
+        """
+        return {symbol: registry.get(symbol) for symbol in set(symbols)}
 
     def __str__(self):
         return f'Currency(name="{self.name}", symbol="{self.symbol}", value="{self.value}")'
@@ -79,3 +94,220 @@ class Price:
             value = round(value, 0)
 
         return Price(value, other_currency)
+
+
+def convert_amounts(amounts: Sequence[int], values: Sequence[float]) -> list[int | float]:
+    """
+    Converts many amounts at once, each to the currency of the value at the same position, exactly as
+    `Price.convert_to` does: an amount below 1 is 1, the others are rounded half to even (as a float). Computed in
+    a single NumPy pass if it is installed, one by one otherwise.
+
+    :param amounts: The amounts.
+    :param values: The values of the currencies to convert the amounts to.
+    :return: The converted amounts, in the same order.
+    :raises ZeroDivisionError: If a value is 0, as `Price.convert_to` does.
+    """
+    if numpy is None or len(amounts) < VECTORIZE_MIN_PRICES:
+        converted = []
+        for amount, value in zip(amounts, values):
+            quotient = amount / value
+            converted.append(1 if amount < 1 else round(quotient, 0))
+        return converted
+
+    amounts_array = numpy.asarray(amounts, dtype=numpy.float64)
+    values_array = numpy.asarray(values, dtype=numpy.float64)
+    if not values_array.all():
+        raise ZeroDivisionError("float division by zero")
+
+    # rint rounds half to even as round does, both of the same quotient
+    converted = numpy.rint(amounts_array / values_array).tolist()
+    for i in numpy.flatnonzero(amounts_array < 1).tolist():
+        converted[i] = 1
+    return converted
+
+
+def convert_prices(prices: Sequence[Price], currencies: Sequence[Sequence[Currency]]) -> list[list[Price]]:
+    """
+    Converts every price to each of its currencies, e.g. the prices of a page of offers to the currencies accepted
+    by their sellers, with a single `convert_amounts`. The same as `Price.convert_to` of every pair.
+
+    :param prices: The prices.
+    :param currencies: The currencies to convert each price to, in the order of the prices.
+    :return: The converted prices of each price, in the order of its currencies.
+    :raises ZeroDivisionError: If a currency has the value 0.
+    """
+    converted = iter(convert_amounts([price.amount for price, targets in zip(prices, currencies) for _ in targets],
+                                     [currency.value for targets in currencies for currency in targets]))
+    return [[Price(next(converted), currency) for currency in targets] for targets in currencies]
+
+
+@dataclass(init=True, eq=True, frozen=True)
+class CurrencySnapshot:
+    """ An immutable view of the currencies table at a point in time """
+    currencies: dict[str, Currency] = field(compare=False)
+    version: str
+    loaded_at: float
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.loaded_at
+
+
+def load_currencies() -> list[Currency]:
+    """
+    Loads all currencies from the database
+
+    :return: A list of all currencies
+    :raises PostgresError: If the database error occurs
+    """
+    result = fetch("SELECT symbol, name, exchange_rate FROM currencies ORDER BY symbol", ())
+    if result is None:
+        raise PostgresError("No result from the database")
+
+    return [Currency(raw_currency[1], raw_currency[0], raw_currency[2]) for raw_currency in result]
+
+
+class CurrencyRegistry:
+    """
+    A process-wide, in-memory copy of the currencies table.
+
+    The registry is loaded on first use and reloaded every `interval` seconds, or as soon as a notification arrives
+    on `channel` once `start()` was called. Lookups never touch the database.
+    """
+
+    def __init__(self, loader: Callable[[], list[Currency]] = load_currencies,
+                 interval: float = CURRENCY_REFRESH_INTERVAL, channel: str = CURRENCY_NOTIFY_CHANNEL):
+        self.loader = loader
+        self.interval = interval
+        self.channel = channel
+
+        self._snapshot: CurrencySnapshot | None = None
+        self._lock = threading.Lock()
+        self._listeners: list[Callable[[CurrencySnapshot], None]] = []
+        self._thread: threading.Thread | None = None
+        self._stop = threading.Event()
+        self.refreshes = 0
+
+    @property
+    def snapshot(self) -> CurrencySnapshot:
+        """
+        The current snapshot of the currencies, loaded on first use.
+
+        :raises PostgresError: If the currencies could not be loaded
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self.refresh()
+        return snapshot
+
+    def get(self, symbol: str) -> Currency:
+        """
+        Gets a currency by its symbol
+
+        :param symbol: The symbol of the currency
+        :return: The currency
+        :raises CurrencyNotFoundError: If the currency does not exist
+        """
+        try:
+            return self.snapshot.currencies[symbol]
+        except KeyError:
+            raise CurrencyNotFoundError(symbol)
+
+    def all(self) -> list[Currency]:
+        """
+        Gets all currencies
+
+        :return: A list of all currencies
+        """
+        return list(self.snapshot.currencies.values())
+
+    def subscribe(self, listener: Callable[[CurrencySnapshot], None]) -> None:
+        """
+        Registers a function that is called with the new snapshot whenever the currencies change.
+
+        :param listener: The function to call
+        """
+        self._listeners.append(listener)
+
+    def refresh(self) -> CurrencySnapshot:
+        """
+        Reloads the currencies from the database. The version of the snapshot only changes when the currencies do.
+
+        :return: The new snapshot
+        :raises PostgresError: If the currencies could not be loaded
+        """
+        with self._lock:
+            currencies = self.loader()
+            digest = sha1(repr([(c.symbol, c.name, c.value) for c in currencies]).encode("utf-8")).hexdigest()[:16]
+
+            previous = self._snapshot
+            self._snapshot = CurrencySnapshot({c.symbol: c for c in currencies}, digest, time.time())
+            self.refreshes += 1
+
+        if previous is not None and previous.version != digest:
+            for listener in self._listeners:
+                try:
+                    listener(self._snapshot)
+                except Exception as e:
+                    print("Exception in currency listener:", e)
+
+        return self._snapshot
+
+    def stats(self) -> dict[str, float]:
+        snapshot = self._snapshot
+        return {
+            "count": 0 if snapshot is None else len(snapshot.currencies),
+            "age_seconds": 0 if snapshot is None else snapshot.age,
+            "refreshes": self.refreshes
+        }
+
+    def start(self) -> None:
+        """
+        Starts reloading the registry in a background thread. Does nothing if it is already running.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="currency-registry", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops the background thread started by `start()`. The thread exits after its current wait.
+        """
+        self._stop.set()
+        self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            conn = None
+            try:
+                if self.channel:
+                    conn = new_connection()
+                    conn.autocommit = True
+                    with conn.cursor() as cursor:
+                        cursor.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+
+                # Notifications might have been missed while (re)connecting
+                self.refresh()
+
+                while not self._stop.is_set():
+                    if conn is None:
+                        self._stop.wait(self.interval)
+                    else:
+                        select([conn], [], [], self.interval)
+                        conn.poll()
+                        conn.notifies.clear()
+
+                    if not self._stop.is_set():
+                        self.refresh()
+            except Exception as e:
+                print("Exception in currency registry:", e)
+                self._stop.wait(min(self.interval, 5.0))
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+registry = CurrencyRegistry()
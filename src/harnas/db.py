@@ -1,9 +1,16 @@
-from typing import Optional, List, Tuple
+from typing import Optional, List, Tuple, Callable, Iterator
+from dataclasses import dataclass
+from contextlib import contextmanager
+from uuid import uuid4
+
+import threading
+import time
 
 import psycopg2
+import psycopg2.extensions
 from os import environ
 
-from exc import PostgresError
+from exc import PostgresError, PoolTimeoutError
 
 
 DATABASE_HOST = environ["POSTGRES_HOST"]
@@ -11,16 +18,27 @@ DATABASE_USER = environ["POSTGRES_USER"]
 DATABASE_PASSWORD = environ["POSTGRES_PASSWORD"]
 DATABASE_NAME = environ["POSTGRES_DB_MAIN"]
 
-connection: Optional[psycopg2._psycopg.connection] = None
+POOL_MIN_SIZE = int(environ.get("POSTGRES_POOL_MIN", "1"))
+POOL_MAX_SIZE = int(environ.get("POSTGRES_POOL_MAX", "10"))
+POOL_TIMEOUT = float(environ.get("POSTGRES_POOL_TIMEOUT", "5.0"))
+# Idle connections older than this are pinged with "SELECT 1" before being handed out
+POOL_PING_AFTER = float(environ.get("POSTGRES_POOL_PING_AFTER", "30.0"))
+# The number of rows fetched at a time by `stream`
+STREAM_BATCH_SIZE = int(environ.get("POSTGRES_STREAM_BATCH_SIZE", "100"))
+# A stream holds its connection until the client has read the whole response. Only this many streams hold one at a
+# time, at most all connections but one, the results of the other streams are fetched whole
+POOL_MAX_STREAMS = int(environ.get("POSTGRES_POOL_MAX_STREAMS", str(POOL_MAX_SIZE // 2)))
 
 
-def connect() -> None:
-    global connection
-    if connection is not None:
-        return
+def new_connection() -> psycopg2.extensions.connection:
+    """
+    Opens a new, unpooled connection to the database.
 
+    :return: the connection
+    :raises PostgresError: if the connection could not be established
+    """
     try:
-        connection = psycopg2.connect(
+        return psycopg2.connect(
             host=DATABASE_HOST,
             user=DATABASE_USER,
             password=DATABASE_PASSWORD,
@@ -31,18 +49,311 @@ def connect() -> None:
         raise PostgresError(f"Error while connecting to Postgres: {e}")
 
 
+@dataclass(init=True, eq=True, frozen=True)
+class PoolStats:
+    """ A snapshot of the connection pool counters """
+    size: int
+    in_use: int
+    idle: int
+    waiting: int
+    waits: int
+    wait_time: float
+    timeouts: int
+    checkouts: int
+    discarded: int
+    queries: int
+    streams: int
+    buffered_streams: int
+
+
+class ConnectionPool:
+    """
+    A thread-safe pool of Postgres connections.
+
+    Connections are checked out with `connection()`, which blocks for at most `timeout` seconds when all
+    `max_size` connections are in use. Every connection is health-checked before being handed out, and
+    broken connections are discarded instead of being returned to the pool.
+
+    At most `max_streams` connections, always fewer than `max_size`, are held by streams (see `begin_stream`), so
+    slow clients of streamed responses cannot take all connections.
+    """
+
+    def __init__(self, min_size: int = POOL_MIN_SIZE, max_size: int = POOL_MAX_SIZE,
+                 timeout: float = POOL_TIMEOUT, ping_after: float = POOL_PING_AFTER,
+                 connect: Callable[[], psycopg2.extensions.connection] = new_connection,
+                 max_streams: int = POOL_MAX_STREAMS):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"Invalid pool size: min={min_size}, max={max_size}")
+        if max_streams < 0:
+            raise ValueError(f"Invalid number of streams: {max_streams}")
+
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.ping_after = ping_after
+        self.max_streams = min(max_streams, max_size - 1)
+        self._connect = connect
+
+        self._lock = threading.Condition()
+        # (connection, time it was returned to the pool), most recently used last
+        self._idle: list[tuple[psycopg2.extensions.connection, float]] = []
+        self._size = 0
+        self._closed = False
+
+        self._waiting = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._timeouts = 0
+        self._checkouts = 0
+        self._discarded = 0
+        self._queries = 0
+        self._streams = 0
+        self._buffered_streams = 0
+
+        for _ in range(min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def stats(self) -> PoolStats:
+        """
+        Returns a snapshot of the pool counters.
+
+        :return: the pool statistics
+        """
+        with self._lock:
+            return PoolStats(self._size, self._size - len(self._idle), len(self._idle), self._waiting,
+                             self._waits, self._wait_time, self._timeouts, self._checkouts, self._discarded,
+                             self._queries, self._streams, self._buffered_streams)
+
+    def count_query(self) -> None:
+        with self._lock:
+            self._queries += 1
+
+    def begin_stream(self) -> bool:
+        """
+        Takes one of the `max_streams` slots of the connections held by streams, without waiting.
+
+        :return: whether a slot was taken, to be released with `end_stream`. The result should be fetched whole
+            otherwise.
+        """
+        with self._lock:
+            if self._streams >= self.max_streams:
+                self._buffered_streams += 1
+                return False
+
+            self._streams += 1
+            return True
+
+    def end_stream(self) -> None:
+        with self._lock:
+            self._streams -= 1
+
+    def getconn(self) -> psycopg2.extensions.connection:
+        """
+        Checks out a healthy connection from the pool, opening a new one if the pool is not full.
+
+        :return: the connection
+        :raises PoolTimeoutError: if no connection became available within the timeout
+        :raises PostgresError: if the pool is closed or a new connection could not be established
+        """
+        deadline = None
+        waited_since = None
+
+        while True:
+            with self._lock:
+                if self._closed:
+                    raise PostgresError("The connection pool is closed")
+
+                if not self._idle and self._size >= self.max_size:
+                    if deadline is None:
+                        deadline = time.monotonic() + self.timeout
+                        waited_since = time.monotonic()
+                        self._waits += 1
+
+                    self._waiting += 1
+                    try:
+                        while not self._idle and self._size >= self.max_size and not self._closed:
+                            remaining = deadline - time.monotonic()
+                            if remaining <= 0:
+                                self._timeouts += 1
+                                self._wait_time += time.monotonic() - waited_since
+                                raise PoolTimeoutError(self.timeout)
+                            self._lock.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+                    continue
+
+                if waited_since is not None:
+                    self._wait_time += time.monotonic() - waited_since
+                    waited_since = None
+
+                if self._idle:
+                    conn, released_at = self._idle.pop()
+                else:
+                    conn, released_at = None, None
+                    # Reserve the slot before connecting outside the lock
+                    self._size += 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    self._release_slot()
+                    raise
+            elif not self._is_healthy(conn, released_at):
+                self._discard(conn)
+                continue
+
+            with self._lock:
+                self._checkouts += 1
+            return conn
+
+    def putconn(self, conn: psycopg2.extensions.connection, broken: bool = False) -> None:
+        """
+        Returns a connection to the pool. Broken connections and connections left in a transaction that
+        cannot be rolled back are closed instead.
+
+        :param conn: the connection to return
+        :param broken: whether the caller saw the connection fail
+        """
+        if not broken and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                broken = True
+
+        if broken or conn.closed or self._closed:
+            self._discard(conn)
+            return
+
+        with self._lock:
+            self._idle.append((conn, time.monotonic()))
+            self._lock.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a connection for the duration of the `with` block. The connection is returned to the pool
+        afterwards, or discarded if it broke while in use.
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.putconn(conn, broken=True)
+            raise
+        except Exception:
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    def close(self) -> None:
+        """
+        Closes all idle connections. Connections that are currently checked out are closed when returned.
+        """
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._lock.notify_all()
+
+        for conn, _ in idle:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _is_healthy(self, conn: psycopg2.extensions.connection, released_at: float) -> bool:
+        if conn.closed:
+            return False
+
+        if time.monotonic() - released_at < self.ping_after:
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, conn: psycopg2.extensions.connection) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+        with self._lock:
+            self._discarded += 1
+        self._release_slot()
+
+    def _release_slot(self) -> None:
+        with self._lock:
+            self._size -= 1
+            self._lock.notify()
+
+
+pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def connect() -> None:
+    """
+    Creates the connection pool. Does nothing if the pool already exists.
+
+    :raises PostgresError: if the initial connections could not be established
+    """
+    global pool
+    if pool is not None:
+        return
+
+    with _pool_lock:
+        if pool is None:
+            pool = ConnectionPool()
+
+
 def disconnect() -> None:
     """
-    Disconnects from the database.
+    Closes the connection pool.
 
     :return: None
     """
-    global connection
-    if connection is None:
-        return
+    global pool
+    with _pool_lock:
+        if pool is None:
+            return
 
-    connection.close()
-    connection = None
+        pool.close()
+        pool = None
+
+
+def get_pool() -> ConnectionPool:
+    """
+    Returns the connection pool, creating it on first use.
+
+    :return: the connection pool
+    :raises PostgresError: if the pool could not be created
+    """
+    if pool is None:
+        connect()
+
+    return pool
+
+
+def pool_stats() -> PoolStats:
+    """
+    Returns the statistics of the connection pool.
+
+    :return: the pool statistics
+    """
+    return get_pool().stats()
 
 
 def fetch(query: str, params: tuple) -> List[Tuple]:
@@ -54,23 +365,19 @@ def fetch(query: str, params: tuple) -> List[Tuple]:
 
     :return: a list of tuples
     """
+    p = get_pool()
 
     try:
-        global connection
-        if connection is None:
-            connect()
+        with p.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(query, params)
+                connection.commit()
+                p.count_query()
+
+                return cursor.fetchall()
     except PostgresError:
         raise
-
-    try:
-        with connection.cursor() as cursor:
-            cursor.execute(query, params)
-            connection.commit()
-
-            return cursor.fetchall()
     except Exception as e:
-        disconnect()
-        connect()
         raise PostgresError(f"Error while fetching from Postgres: {e}")
 
 
@@ -83,18 +390,66 @@ def execute(query: str, params: tuple) -> None:
 
     :return: None
     """
+    p = get_pool()
+
     try:
-        global connection
-        if connection is None:
-            connect()
+        with p.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(query, params)
+                connection.commit()
+                p.count_query()
     except PostgresError:
         raise
+    except Exception as e:
+        raise PostgresError(f"Error while executing with Postgres: {e}")
+
+
+def stream(query: str, params: tuple, batch_size: int = STREAM_BATCH_SIZE) -> Iterator[List[Tuple]]:
+    """
+    Fetches the rows of a query in batches from a server-side cursor, so that the whole result is never in memory.
+    A connection is checked out until the generator is exhausted or closed. When POOL_MAX_STREAMS streams already
+    hold a connection, the rows are fetched whole instead and the connection is returned right away.
+
+    :param query: SQL query to execute
+    :param params: parameters to pass to the query
+    :param batch_size: the number of rows in a batch
+
+    :return: a generator of lists of tuples
+    """
+    p = get_pool()
+    if not p.begin_stream():
+        rows = fetch(query, params)
+        for i in range(0, len(rows), batch_size):
+            yield rows[i:i + batch_size]
+        return
+
+    try:
+        connection = p.getconn()
+    except Exception:
+        p.end_stream()
+        raise
+    broken = False
 
     try:
-        with connection.cursor() as cursor:
+        # A named cursor is declared in a transaction, which is rolled back by `putconn`
+        with connection.cursor(name=f"stream_{uuid4().hex}") as cursor:
+            cursor.itersize = batch_size
             cursor.execute(query, params)
-            connection.commit()
+            p.count_query()
+
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+
+                yield rows
+    except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+        broken = True
+        raise PostgresError(f"Error while streaming from Postgres: {e}")
+    except PostgresError:
+        raise
     except Exception as e:
-        disconnect()
-        connect()
-        raise PostgresError(f"Error while executing with Postgres: {e}")
+        raise PostgresError(f"Error while streaming from Postgres: {e}")
+    finally:
+        p.putconn(connection, broken)
+        p.end_stream()
@@ -0,0 +1,162 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Callable
+from uuid import uuid4
+
+import os
+import threading
+import time
+
+# Temporary files modified longer ago than this are leftovers of renders interrupted by a crash. Younger ones may still
+# be written by another process sharing the directory
+TEMPORARY_GRACE = 60 * 60
+
+
+class DiskCache:
+    """
+    A size-bounded least recently used cache of files in a directory. Files are created on the first request,
+    written to a temporary file and atomically renamed, so a reader never sees a partial file. Concurrent requests
+    for a file that is still being created wait for the first one instead of creating it again.
+
+    The index is kept in memory and rebuilt from the directory (oldest modification first) when the cache is
+    created. Every process keeps its own index and its own `max_bytes` budget, so the directory may take up to the
+    number of processes times `max_bytes`. Files created by other processes are adopted when they are requested,
+    files evicted by them are created again.
+    """
+
+    def __init__(self, directory: str | Path, max_bytes: int, temporary_grace: float = TEMPORARY_GRACE):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.temporary_grace = temporary_grace
+
+        # name -> size in bytes, least recently used first
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._in_flight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.vanished = 0
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._scan()
+
+    def _scan(self) -> None:
+        files = []
+        for path in self.directory.iterdir():
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # Renamed or deleted by another process in the meantime
+                continue
+
+            if path.name.startswith("."):
+                if stat.st_mtime < time.time() - self.temporary_grace:
+                    path.unlink(missing_ok=True)
+                continue
+            if path.is_file():
+                files.append((stat.st_mtime, path.name, stat.st_size))
+
+        with self._lock:
+            for _, name, size in sorted(files):
+                self._entries[name] = size
+                self.total_bytes += size
+            self._evict()
+
+    def path(self, name: str) -> Path:
+        return self.directory / name
+
+    def get_or_create(self, name: str, create: Callable[[Path], None]) -> Path:
+        """
+        Gets the path of the cached file, creating it first if it is not cached.
+
+        :param name: The name of the file.
+        :param create: The function writing the file to the path it is given.
+        :return: The path of the cached file.
+        :raises Exception: Whatever `create` raised, in every request waiting for the file.
+        """
+        with self._lock:
+            if name in self._entries:
+                if self.path(name).exists():
+                    self._entries.move_to_end(name)
+                    self.hits += 1
+                    return self.path(name)
+
+                # Evicted by another process
+                self.total_bytes -= self._entries.pop(name)
+                self.vanished += 1
+
+            future = self._in_flight.get(name)
+            if future is None:
+                future = self._in_flight[name] = Future()
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            return future.result()
+
+        try:
+            path = self.path(name)
+            if path.exists():
+                # Created by another process
+                size = path.stat().st_size
+                with self._lock:
+                    self.hits += 1
+            else:
+                size = self._create(name, create)
+                with self._lock:
+                    self.misses += 1
+
+            with self._lock:
+                self._entries[name] = size
+                self.total_bytes += size
+                self._evict()
+
+            future.set_result(path)
+            return path
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(name, None)
+
+    def _create(self, name: str, create: Callable[[Path], None]) -> int:
+        temporary = self.directory / f".{name}.{uuid4().hex}"
+        try:
+            create(temporary)
+            size = temporary.stat().st_size
+            os.replace(temporary, self.path(name))
+            return size
+        finally:
+            temporary.unlink(missing_ok=True)
+
+    def _evict(self) -> None:
+        # The most recently used file is kept even if it is bigger than the whole cache
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            self.path(name).unlink(missing_ok=True)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "files": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "vanished": self.vanished
+            }
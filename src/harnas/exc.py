@@ -92,6 +92,17 @@ class ImageEncodingError (Exception):
         return f"Image with id {self.image_id} encoding failed."
 
 
+class ImageTooLargeError (ImageEncodingError):
+    """Raised when an image has more pixels or bytes than an upload may have."""
+
+    def __init__(self, reason: str):
+        super().__init__(None)
+        self.reason = reason
+
+    def __str__(self):
+        return f"Image too large: {self.reason}."
+
+
 class ImageAlreadySavedError(Exception):
     """Raised when an image is already saved in the database."""
 
@@ -130,3 +141,33 @@ class BadTokenError (Exception):
 
     def __str__(self):
         return self.message
+
+
+class PoolTimeoutError (PostgresError):
+    """Raised when no pooled database connection becomes available in time."""
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+
+    def __str__(self):
+        return f"No database connection available after {self.timeout} seconds."
+
+
+class InvalidCursorError (Exception):
+    """Raised when a pagination cursor cannot be decoded."""
+
+    def __init__(self, cursor: str):
+        self.cursor = cursor
+
+    def __str__(self):
+        return f"Invalid page cursor {self.cursor}."
+
+
+class InvalidFieldsetError (Exception):
+    """Raised when a requested field or expansion of a response does not exist."""
+
+    def __init__(self, field: str):
+        self.field = field
+
+    def __str__(self):
+        return f"Unknown field {self.field}."
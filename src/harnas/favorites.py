@@ -1,6 +1,8 @@
-from db import execute, fetch
+from typing import Iterator
+
+from db import execute, fetch, stream
 from exc import PostgresError
-from offers import Offer
+from offers import Offer, SELECT_OFFERS
 
 
 def add_to_favorites(user_id: str, offer_id: int) -> None:
@@ -38,12 +40,31 @@ def get_user_favorites(user_id) -> list["Offer"]:
     :raises PostgresError: if the internal error occurs
     """
     try:
-        result = fetch("SELECT * FROM offers WHERE id IN (SELECT offer FROM favorites WHERE user = %s)", (user_id,))
-        o = []
-
-        for row in result:
-            o.append(Offer.new_offer_from_row(row))
+        result = fetch(SELECT_OFFERS + " WHERE id IN (SELECT offer FROM favorites WHERE user = %s)", (user_id,))
 
-        return o
+        return Offer.new_offers_from_rows(result)
     except PostgresError:
-        raise
\ No newline at end of file
+        raise
+
+
+def stream_user_favorites(user_id) -> Iterator[list["Offer"]]:
+    """
+    Streams the favorites of the given user, loaded a batch at a time.
+
+    :param user_id: ID of the user
+    :return: a generator of lists of offers
+    :raises PostgresError: if the internal error occurs
+    """
+    for rows in stream_user_favorite_rows(user_id):
+        yield Offer.new_offers_from_rows(rows)
+
+
+def stream_user_favorite_rows(user_id) -> Iterator[list[tuple]]:
+    """
+    Streams the rows of the favorites of the given user, a batch at a time.
+
+    :param user_id: ID of the user
+    :return: a generator of lists of rows
+    :raises PostgresError: if the internal error occurs
+    """
+    yield from stream(SELECT_OFFERS + " WHERE id IN (SELECT offer FROM favorites WHERE user = %s)", (user_id,))
@@ -0,0 +1,62 @@
+from contextvars import ContextVar
+from dataclasses import dataclass
+
+from exc import InvalidFieldsetError
+
+# The fields of a serialized offer
+OFFER_FIELDS = ("offer_id", "title", "description", "price", "seller", "images", "location", "created_at")
+# The nested objects embedded in full only when expanded, otherwise the seller is its uid and the images their ids
+EXPANDABLE = ("seller", "images")
+
+
+@dataclass(init=True, eq=True, frozen=True)
+class Fieldset:
+    """ The fields of the offers to load and to serialize, and which of the nested objects to embed """
+    fields: frozenset[str]
+    expand: frozenset[str]
+
+    def includes(self, field: str) -> bool:
+        return field in self.fields
+
+    def expands(self, field: str) -> bool:
+        return field in self.fields and field in self.expand
+
+    @property
+    def needs_sellers(self) -> bool:
+        # The prices are converted to the currencies the seller accepts
+        return self.expands("seller") or self.includes("price")
+
+
+# Everything, as the offers were always serialized
+DEFAULT_FIELDSET = Fieldset(frozenset(OFFER_FIELDS), frozenset(EXPANDABLE))
+
+# The fieldset of the current request, both the loading and the serialization of the offers follow it
+offer_fieldset: ContextVar[Fieldset] = ContextVar("offer_fieldset", default=DEFAULT_FIELDSET)
+
+
+def parse_fieldset(fields: str | None, expand: str | None) -> Fieldset:
+    """
+    Parses the fields and expand query parameters, e.g. ?fields=offer_id,title,price,images&expand=images.
+    All fields are included unless fields is given, all nested objects are expanded unless expand is given
+    (an empty expand expands none of them).
+
+    :param fields: The comma separated fields, or None.
+    :param expand: The comma separated nested objects to embed, or None.
+    :return: The fieldset.
+    :raises InvalidFieldsetError: If a field or a nested object does not exist.
+    """
+    selected = DEFAULT_FIELDSET.fields if fields is None else _split(fields, OFFER_FIELDS)
+    expanded = DEFAULT_FIELDSET.expand if expand is None else _split(expand, EXPANDABLE)
+
+    fieldset = Fieldset(selected, expanded)
+    # The same object, so that the default is recognized by identity
+    return DEFAULT_FIELDSET if fieldset == DEFAULT_FIELDSET else fieldset
+
+
+def _split(value: str, allowed: tuple[str, ...]) -> frozenset[str]:
+    names = frozenset(name.strip() for name in value.split(",") if name.strip() != "")
+    for name in names:
+        if name not in allowed:
+            raise InvalidFieldsetError(name)
+
+    return names
@@ -0,0 +1,159 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from os import environ
+from typing import Hashable
+
+import threading
+
+# The memory the serialized offers of a worker may take
+OFFER_FRAGMENT_CACHE_BYTES = int(environ.get("OFFER_FRAGMENT_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+# What an entry takes besides its fragments: the entry, its key and the dict of the fragments
+ENTRY_OVERHEAD = 512
+
+
+@dataclass(init=True, eq=False)
+class _Entry:
+    versions: tuple
+    seller_id: str
+    fragments: dict[Hashable, bytes] = field(default_factory=dict)
+    size: int = ENTRY_OVERHEAD
+
+
+class FragmentCache:
+    """
+    A thread-safe least recently used cache of serialized offers, bounded by the memory they take. The fragments of
+    an offer are kept per fieldset, together with the versions of everything they show (the offer with its images,
+    the seller with their accepted currencies and the exchange rates). A fragment of other versions is never
+    returned. The callers look fragments up with the versions of the database, not of the caches of the worker, so
+    the cache is correct without invalidation too, invalidating only frees the memory sooner.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+
+        self._entries: OrderedDict[int, _Entry] = OrderedDict()
+        # seller id -> the ids of their cached offers
+        self._sellers: dict[str, set[int]] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, offer_id: int, versions: tuple, fieldset: Hashable) -> bytes | None:
+        """
+        Gets the offer serialized with the fieldset at the given versions.
+
+        :param offer_id: The id of the offer.
+        :param versions: The current versions of the offer.
+        :param fieldset: The fieldset it is serialized with.
+        :return: The serialized offer, None if it is not cached at these versions.
+        """
+        with self._lock:
+            entry = self._entries.get(offer_id)
+            fragment = None if entry is None or entry.versions != versions else entry.fragments.get(fieldset)
+            if fragment is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(offer_id)
+            self.hits += 1
+            return fragment
+
+    def put(self, offer_id: int, versions: tuple, seller_id: str, fieldset: Hashable, fragment: bytes) -> None:
+        """
+        Caches the offer serialized with the fieldset, replacing its fragments of other versions and evicting the
+        least recently used offers if the cache is full.
+
+        :param offer_id: The id of the offer.
+        :param versions: The versions of the offer it was serialized at.
+        :param seller_id: The id of the seller, for `invalidate_seller`.
+        :param fieldset: The fieldset it was serialized with.
+        :param fragment: The serialized offer.
+        """
+        if len(fragment) + ENTRY_OVERHEAD > self.max_bytes:
+            return
+
+        with self._lock:
+            entry = self._entries.get(offer_id)
+            if entry is not None and (entry.versions != versions or entry.seller_id != seller_id):
+                self._remove(offer_id)
+                entry = None
+
+            if entry is None:
+                entry = _Entry(versions, seller_id)
+                self._entries[offer_id] = entry
+                self._sellers.setdefault(seller_id, set()).add(offer_id)
+                self._bytes += entry.size
+
+            previous = entry.fragments.get(fieldset)
+            growth = len(fragment) - (0 if previous is None else len(previous))
+            entry.fragments[fieldset] = fragment
+            entry.size += growth
+            self._bytes += growth
+            self._entries.move_to_end(offer_id)
+
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_offer(self, offer_id: int) -> None:
+        """
+        Removes all fragments of the offer. Does nothing if it is not cached.
+
+        :param offer_id: The id of the offer.
+        """
+        with self._lock:
+            if offer_id in self._entries:
+                self._remove(offer_id)
+                self.invalidations += 1
+
+    def invalidate_seller(self, seller_id: str) -> None:
+        """
+        Removes all fragments of the offers of the seller, e.g. after their accepted currencies changed.
+
+        :param seller_id: The id of the seller.
+        """
+        with self._lock:
+            for offer_id in list(self._sellers.get(seller_id, ())):
+                self._remove(offer_id)
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        """
+        Removes all fragments, e.g. after the exchange rates changed.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._sellers.clear()
+            self._bytes = 0
+
+    def _remove(self, offer_id: int) -> None:
+        entry = self._entries.pop(offer_id)
+        self._bytes -= entry.size
+
+        offers = self._sellers[entry.seller_id]
+        offers.discard(offer_id)
+        if len(offers) == 0:
+            del self._sellers[entry.seller_id]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+
+offer_fragments = FragmentCache(OFFER_FRAGMENT_CACHE_BYTES)
@@ -0,0 +1,65 @@
+from flask import request, make_response, send_file, abort, redirect, Response
+from hashlib import sha1
+from os import environ
+
+from storage import storage
+
+IMAGE_MAX_AGE = int(environ.get("IMAGE_MAX_AGE", str(365 * 24 * 60 * 60)))
+
+
+def cache_forever(resp: Response) -> Response:
+    """
+    Lets clients and proxies cache the response for IMAGE_MAX_AGE without revalidating it.
+
+    :param resp: The response of a file that never changes.
+    :return: The response.
+    """
+    resp.cache_control.public = True
+    resp.cache_control.max_age = IMAGE_MAX_AGE
+    resp.cache_control.immutable = True
+    return resp
+
+
+def not_modified(etag: str) -> Response:
+    """
+    :param etag: The ETag the client already has.
+    :return: The 304 response for the ETag.
+    """
+    resp = make_response("", 304)
+    resp.set_etag(etag)
+    return cache_forever(resp)
+
+
+def send_image(path: str) -> Response:
+    """
+    Sends a stored file by its name, the view of /image/<path>. The renditions are named by a content hash (or a
+    random UUID) and never change, so they are cached forever and validated by name.
+
+    :param path: The name of the file.
+    :return: The file, a 304 if the client has it, or a redirect to the storage if it is not local.
+    """
+    # The stored uploads still carry their metadata (e.g. the location), only the renditions are public
+    if "_source" in path:
+        abort(404)
+
+    etag = sha1(path.encode("utf-8")).hexdigest()
+
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+
+    try:
+        local_path = storage.local_path(path)
+    except ValueError:
+        abort(404)
+
+    # The files of remote storages are served by the storage itself, this only handles old URLs
+    if local_path is None:
+        return cache_forever(redirect(storage.url(path), 301))
+
+    if not local_path.is_file():
+        abort(404)
+
+    # Range requests are answered by Werkzeug, whole files are sent with sendfile by the WSGI server
+    resp = send_file(local_path, etag=etag, max_age=IMAGE_MAX_AGE, conditional=True)
+    resp.accept_ranges = "bytes"
+    return cache_forever(resp)
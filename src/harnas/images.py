@@ -1,23 +1,123 @@
-from dataclasses import dataclass
-from typing import List
+from dataclasses import dataclass, field
+from typing import Any, List, Dict, BinaryIO
 
 from io import BytesIO
-from base64 import b64decode
-from uuid import uuid4
+from base64 import b64decode, b64encode
+from hashlib import sha1, sha256
+from json import dumps, loads
 from os import environ
-from pathlib import Path
+from tempfile import SpooledTemporaryFile
+
+import math
 
 from db import fetch, execute
-from exc import ImageNotFoundError, PostgresError, ImageEncodingError, ImageNotEditableError, ImageNotSavedError
+from storage import storage
+from fragments import offer_fragments
+from exc import ImageNotFoundError, PostgresError, ImageEncodingError, ImageNotEditableError, ImageNotSavedError, \
+    ImageTooLargeError
 
 from PIL import Image as PILImage
 import pillow_heif
 
 
 SIZES = [(1920, 1080), (200, 113), (96, 96)]
-IMAGE_OUTPUT = environ["IMAGE_OUTPUT"]
+RENDITIONS = ["original", "preview", "thumbnail"]
+
+# The sizes and formats that can be requested from the on-demand rendition endpoint, e.g. "1280x720,320x320"
+RENDITION_SIZES = {tuple(int(n) for n in size.split("x")) for size in
+                   environ.get("RENDITION_SIZES", "1920x1080,1280x720,640x360,320x320,200x113,96x96").split(",")}
+# extension -> (Pillow format, MIME type)
+RENDITION_FORMATS = {
+    "jpg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+    "avif": ("AVIF", "image/avif")
+}
+
+# How the renditions (by name) and the on-demand renditions (by extension) are encoded. Everything but "metadata"
+# is passed to Pillow's save, "metadata" is "strip", "icc" (keep the color profile) or "all" (keep EXIF too).
+# Overridden per key with IMAGE_ENCODING_PROFILES, e.g. '{"original": {"quality": 85}}'.
+# The JPEGs keep Pillow's default quality, optimized Huffman tables make them 5-20% smaller at the same quality and
+# progressive encoding saves a few more percent on the big ones (see benchmarks/encoding_benchmark.py).
+ENCODING_PROFILES: Dict[str, Dict[str, Any]] = {
+    "original": {"quality": 75, "optimize": True, "progressive": True, "subsampling": "4:2:0", "metadata": "icc"},
+    "preview": {"quality": 75, "optimize": True, "progressive": False, "subsampling": "4:2:0", "metadata": "strip"},
+    "thumbnail": {"quality": 75, "optimize": True, "progressive": False, "subsampling": "4:2:0",
+                  "metadata": "strip"},
+    "jpg": {"quality": 75, "optimize": True, "progressive": True, "subsampling": "4:2:0", "metadata": "strip"},
+    "webp": {"quality": 75, "method": 4, "metadata": "strip"},
+    "avif": {"quality": 60, "metadata": "strip"}
+}
+for _name, _profile in loads(environ.get("IMAGE_ENCODING_PROFILES", "{}")).items():
+    ENCODING_PROFILES.setdefault(_name, {}).update(_profile)
+
+
+def profile_digest(profile: str) -> str:
+    """
+    :param profile: The name of one of the ENCODING_PROFILES.
+    :return: A short hash of its settings, for the names of the files encoded with it.
+    """
+    return sha1(dumps(ENCODING_PROFILES[profile], sort_keys=True).encode("utf-8")).hexdigest()[:8]
+
+# Uploads bigger than this many bytes are spooled to disk instead of being kept in memory
+UPLOAD_SPOOL_SIZE = int(environ.get("UPLOAD_SPOOL_SIZE", str(1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# The largest upload that is accepted, checked before the image is decoded. A decoded image takes about
+# 4 bytes per pixel, so the pixel budget bounds the memory used to generate the renditions.
+IMAGE_MAX_PIXELS = int(environ.get("IMAGE_MAX_PIXELS", str(50_000_000)))
+IMAGE_MAX_BYTES = int(environ.get("IMAGE_MAX_BYTES", str(25 * 1024 * 1024)))
+
+# The renditions of an image are generated after it is saved, the image is "pending" until then
+IMAGE_PENDING = "pending"
+IMAGE_READY = "ready"
+IMAGE_FAILED = "failed"
+# The size of the placeholder shown before the preview is loaded, with the aspect ratio of the preview
+PLACEHOLDER_SIZE = (16, 9)
+PLACEHOLDER_QUALITY = 40
+
+# The status of a stored upload nobody generates the renditions of yet
+BLOB_NEW = "new"
+# The seconds after which the renditions claimed by an upload are claimed again by the next upload of the content,
+# in case the worker generating them died. Longer than generating the renditions of the biggest image takes
+IMAGE_CLAIM_TIMEOUT = int(environ.get("IMAGE_CLAIM_TIMEOUT", "600"))
 
 pillow_heif.register_heif_opener()
+pillow_heif.register_avif_opener()
+
+# Pillow checks the size in the header when opening an image with any opener, including pillow_heif's, but only
+# fails above twice the limit, `open_image` checks the limit itself
+PILImage.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS
+
+
+def open_image(file: BinaryIO) -> PILImage.Image:
+    """
+    Opens an image, reading only its header.
+
+    :param file: The file.
+    :return: The opened, not yet decoded image.
+    :raises ImageTooLargeError: If the image has more than IMAGE_MAX_PIXELS pixels.
+    :raises ImageEncodingError: If the file is not a supported image.
+    """
+    try:
+        img = PILImage.open(file)
+    except PILImage.DecompressionBombError as e:
+        raise ImageTooLargeError(f"more than {IMAGE_MAX_PIXELS} pixels") from e
+    except Exception as e:
+        raise ImageEncodingError(None) from e
+
+    if img.width * img.height > IMAGE_MAX_PIXELS:
+        img.close()
+        raise ImageTooLargeError(f"more than {IMAGE_MAX_PIXELS} pixels")
+
+    return img
+
+
+def check_upload_size(size: int) -> None:
+    """
+    :raises ImageTooLargeError: If the upload has more than IMAGE_MAX_BYTES bytes.
+    """
+    if size > IMAGE_MAX_BYTES:
+        raise ImageTooLargeError(f"more than {IMAGE_MAX_BYTES} bytes")
 
 @dataclass(init=True, eq=True, order=True, unsafe_hash=False, frozen=False)
 class Image:
@@ -29,6 +129,18 @@ class Image:
     preview: str | None
     thumbnail: str | None
 
+    status: str = IMAGE_READY
+    # The name of the stored upload the renditions are generated from
+    source: str | None = None
+    # The SHA-256 of the uploaded bytes, images with the same content share the stored upload and the renditions
+    content_hash: str | None = None
+    # A tiny inline JPEG (a data URI) to show until the preview is loaded
+    placeholder: str | None = None
+    # The uploaded file, only set for images that were not saved yet
+    upload: BinaryIO | None = field(default=None, repr=False, compare=False)
+    # Whether this image has to generate the renditions, i.e. it is the first upload of its content
+    needs_renditions: bool = field(default=False, repr=False, compare=False)
+
     @property
     def is_saved(self) -> bool:
         return self.image_id is not None and self.original is not None \
@@ -38,6 +150,10 @@ class Image:
     def is_editable(self) -> bool:
         return self.raw_image is not None
 
+    @property
+    def is_ready(self) -> bool:
+        return self.status == IMAGE_READY
+
     @staticmethod
     def crop_center(img: PILImage.Image, crop_width: int, crop_height: int) -> PILImage.Image:
         """
@@ -74,13 +190,88 @@ class Image:
 
         :param b64_image: The base64 string.
         :return: The image object.
+        :raises ImageTooLargeError: If the image is bigger than the budget.
         :raises ImageEncodingError: If the image could not be decoded.
         """
+        # Rejected before the string is decoded
+        check_upload_size(len(b64_image) * 3 // 4)
+
         try:
-            img = PILImage.open(BytesIO(b64decode(b64_image)))
-            return cls(img, None, None, None, None)
+            upload = BytesIO(b64decode(b64_image))
         except Exception as e:
-            raise ImageEncodingError from e
+            raise ImageEncodingError(None) from e
+
+        return cls(open_image(upload), None, None, None, None, upload=upload)
+
+    @classmethod
+    def new_image_file(cls, file: BinaryIO) -> "Image":
+        """
+        Creates an Image object from a seekable binary file, e.g. an uploaded multipart file. Only the header of
+        the image is read, the file has to stay open until the image is saved.
+
+        :param file: The file.
+        :return: The image object.
+        :raises ImageTooLargeError: If the image is bigger than the budget.
+        :raises ImageEncodingError: If the image could not be decoded.
+        """
+        try:
+            check_upload_size(file.seek(0, 2))
+            file.seek(0)
+        except ImageTooLargeError:
+            raise
+        except Exception as e:
+            raise ImageEncodingError(None) from e
+
+        return cls(open_image(file), None, None, None, None, upload=file)
+
+    @classmethod
+    def new_image_stream(cls, stream: BinaryIO, base64_fallback: bool = False) -> "Image":
+        """
+        Creates an Image object from a raw binary stream, e.g. the body of a request. The stream is copied in chunks
+        to a temporary file that is kept in memory only while it is smaller than UPLOAD_SPOOL_SIZE, so the memory
+        used per upload is bounded no matter how big the file is.
+
+        :param stream: The stream.
+        :param base64_fallback: Whether to decode the stream as a base64 string if it is not an image, for clients
+            that send base64 strings with an image content type.
+        :return: The image object.
+        :raises ImageTooLargeError: If the image is bigger than the budget, the rest of the stream is not read.
+        :raises ImageEncodingError: If the image could not be decoded.
+        """
+        # A base64 string of the biggest image allowed is a third longer
+        limit = IMAGE_MAX_BYTES * 4 // 3 + 4 if base64_fallback else IMAGE_MAX_BYTES
+
+        upload = SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE)
+        # Hash the upload while spooling it, so that it does not have to be read again to find duplicates
+        content_hash = sha256()
+        size = 0
+        while chunk := stream.read(UPLOAD_CHUNK_SIZE):
+            size += len(chunk)
+            if size > limit:
+                upload.close()
+                check_upload_size(size)
+            content_hash.update(chunk)
+            upload.write(chunk)
+
+        try:
+            img = cls.new_image_file(upload)
+        except (ImageEncodingError, ImageTooLargeError):
+            if not base64_fallback:
+                upload.close()
+                raise
+
+            upload.seek(0)
+            with upload:
+                encoded = upload.read()
+            try:
+                return cls.new_image_base64(encoded)
+            except ImageEncodingError:
+                # Neither an image nor a base64 string of one, report an image over the budget as such
+                check_upload_size(size)
+                raise
+
+        img.content_hash = content_hash.hexdigest()
+        return img
 
     @classmethod
     def get_image_by_id(cls, image_id: int) -> "Image":
@@ -94,32 +285,87 @@ class Image:
         :raises PostgresError: If there is an error with the database.
         """
         try:
-            result = fetch("SELECT original, preview, thumbnail FROM images WHERE id = %s", (image_id,))
+            result = fetch("SELECT original, preview, thumbnail, status, source, content_hash, placeholder "
+                           "FROM images WHERE id = %s", (image_id,))
         except PostgresError:
             raise
 
         if len(result) == 0:
             raise ImageNotFoundError(image_id)
 
-        return cls(None, image_id, result[0][0], result[0][1], result[0][2])
+        return cls(None, image_id, *result[0])
+
+    @classmethod
+    def get_images_by_ids(cls, image_ids: List[int]) -> List["Image"]:
+        """
+        Gets many images in a single query.
+
+        :param image_ids: The ids of the images.
+        :return: The images, in the order of the given ids.
+
+        :raises ImageNotFoundError: If any of the images does not exist.
+        :raises PostgresError: If there is an error with the database.
+        """
+        if len(image_ids) == 0:
+            return []
+
+        try:
+            results = fetch("SELECT id, original, preview, thumbnail, status, source, content_hash, placeholder "
+                            "FROM images WHERE id = ANY(%s)", (list(image_ids),))
+        except PostgresError:
+            raise
+
+        images = {result[0]: result for result in results}
+        for image_id in image_ids:
+            if image_id not in images:
+                raise ImageNotFoundError(image_id)
+
+        return [cls(None, *images[image_id]) for image_id in image_ids]
 
     @classmethod
     def get_images_by_offer_id(cls, offer_id: int) -> List["Image"]:
         """
-        Gets all images of the offer with the given id.
+        Gets all images of the offer with the given id, in the order they were uploaded.
 
         :param offer_id: The id of the offer.
         :return: A list of images. The list is empty if the offer has no images.
 
         :raises PostgresError: If the database query fails.
         """
+        return cls.get_images_by_offer_ids([offer_id])[offer_id]
+
+    @classmethod
+    def get_images_by_offer_ids(cls, offer_ids: List[int], ids_only: bool = False) -> Dict[int, List["Image"]]:
+        """
+        Gets the images of many offers in a single query, answered from the images_offer_id_covering_idx index
+        without reading the table.
+
+        :param offer_ids: The ids of the offers.
+        :param ids_only: Whether to load the ids of the images only, the other fields are None.
+        :return: A mapping from the offer id to the list of its images, in the order they were uploaded. Offers
+                 without images map to an empty list.
+
+        :raises PostgresError: If the database query fails.
+        """
+        images = {offer_id: [] for offer_id in offer_ids}
+        if len(images) == 0:
+            return images
+
+        columns = "offer_id, id" if ids_only else \
+            "offer_id, id, original, preview, thumbnail, status, source, content_hash, placeholder"
         try:
-            results = fetch("SELECT id, original, preview, thumbnail FROM images "
-                            "WHERE offer_id = %s", (offer_id,))
+            results = fetch(f"SELECT {columns} FROM images WHERE offer_id = ANY(%s) ORDER BY offer_id, id",
+                            (list(images),))
         except PostgresError:
             raise
 
-        return [cls(None, result[0], result[1], result[2], result[3]) for result in results]
+        for result in results:
+            if ids_only:
+                images[result[0]].append(cls(None, result[1], None, None, None))
+            else:
+                images[result[0]].append(cls(None, *result[1:]))
+
+        return images
 
     @classmethod
     def dummies(cls) -> List["Image"]:
@@ -134,7 +380,8 @@ class Image:
 
     def save(self) -> None:
         """
-        Saves the image both in the database and on the disk. Does nothing if the image is already saved.
+        Saves the image both in the database and on the disk, generating the renditions synchronously unless they
+        already exist for the same content. Does nothing if the image is already saved.
 
         :raises PostgresError: If the database query fails.
         :raises ImageNotEditableError: If the image is not editable.
@@ -142,40 +389,172 @@ class Image:
         if self.is_saved:
             return
 
-        if not self.is_editable:
+        self.save_original()
+        if not self.needs_renditions:
+            return
+
+        try:
+            placeholder = generate_renditions(self.source, [self.original, self.preview, self.thumbnail])
+        except Exception:
+            self.set_status(IMAGE_FAILED)
+            raise
+
+        self.set_status(IMAGE_READY, placeholder)
+
+    def save_original(self) -> None:
+        """
+        Stores the uploaded file and inserts the image into the database, without generating the renditions.
+        If the renditions have to be generated, `needs_renditions` is set and `generate_renditions` can be run
+        later, e.g. by the rendition worker pool.
+
+        :raises PostgresError: If the database query fails.
+        :raises ImageNotEditableError: If the image is not editable.
+        """
+        self.store_upload()
+        Image.insert_pending([self])
+
+    def hash_upload(self) -> str:
+        """
+        Computes the SHA-256 of the uploaded bytes, unless it was computed while the upload was received.
+
+        :return: The hex digest.
+        :raises ImageNotEditableError: If the image is not editable.
+        """
+        if self.content_hash is not None:
+            return self.content_hash
+
+        if not self.is_editable or self.upload is None:
             raise ImageNotEditableError(self.image_id)
 
-        group_name = str(uuid4())
+        content_hash = sha256()
+        self.upload.seek(0)
+        while chunk := self.upload.read(UPLOAD_CHUNK_SIZE):
+            content_hash.update(chunk)
 
-        original = self.crop_center(self.raw_image, SIZES[0][0], SIZES[0][1])
-        original_name = group_name + "_original.jpg"
-        original_path = Path(IMAGE_OUTPUT, original_name)
-        original.save(original_path, "JPEG")
-        self.original = original_name
+        self.content_hash = content_hash.hexdigest()
+        return self.content_hash
+
+    def store_upload(self) -> None:
+        """
+        Writes the uploaded file to the storage under its content hash and sets the names of the renditions.
+        A file with the same content is only written once. The image is not inserted into the database,
+        see `insert_pending`.
+
+        :raises ImageNotEditableError: If the image is not editable.
+        """
+        if not self.is_editable or self.upload is None:
+            raise ImageNotEditableError(self.image_id)
 
-        preview = self.crop_center(self.raw_image, SIZES[1][0], SIZES[1][1])
-        preview_name = group_name + "_preview.jpg"
-        preview_path = Path(IMAGE_OUTPUT, preview_name)
-        preview.save(preview_path, "JPEG")
-        self.preview = preview_name
+        group_name = self.hash_upload()
+        source_name = group_name + "_source"
 
-        thumbnail = self.crop_center(self.raw_image, SIZES[2][0], SIZES[2][1])
-        thumbnail_name = group_name + "_thumbnail.jpg"
-        thumbnail_path = Path(IMAGE_OUTPUT, thumbnail_name)
-        thumbnail.save(thumbnail_path, "JPEG")
-        self.thumbnail = thumbnail_name
+        if not storage.exists(source_name):
+            self.upload.seek(0)
+            storage.save(source_name, self.upload)
+
+        self.original = group_name + "_original.jpg"
+        self.preview = group_name + "_preview.jpg"
+        self.thumbnail = group_name + "_thumbnail.jpg"
+        self.source = source_name
+
+    @classmethod
+    def insert_pending(cls, images: List["Image"]) -> None:
+        """
+        Inserts images stored with `store_upload` into the database, with a single query, and takes a reference
+        to their stored uploads. Images whose content was uploaded before reuse its renditions: they are "ready"
+        if the renditions were generated, otherwise they are "pending" and become ready with the first image.
+        Exactly one image of every content without renditions gets `needs_renditions` set.
+
+        :param images: The images.
+
+        :raises PostgresError: If the database query fails.
+        """
+        if len(images) == 0:
+            return
+
+        references = {}
+        params = []
+        for image in images:
+            references[image.content_hash] = references.get(image.content_hash, 0) + 1
+            params.extend((image.original, image.preview, image.thumbnail, image.source, image.content_hash))
+        for content_hash, count in references.items():
+            params.extend((content_hash, count))
+
+        try:
+            result = fetch("WITH uploads (original, preview, thumbnail, source, content_hash) AS (VALUES " +
+                           ", ".join(["(%s, %s, %s, %s, %s)"] * len(images)) + "), "
+                           "blobs AS (INSERT INTO image_blobs (hash, refcount) VALUES " +
+                           ", ".join(["(%s, %s)"] * len(references)) + " "
+                           "ON CONFLICT (hash) DO UPDATE SET refcount = image_blobs.refcount + EXCLUDED.refcount "
+                           "RETURNING hash, status) "
+                           "INSERT INTO images (original, preview, thumbnail, source, content_hash, status, "
+                           "placeholder) "
+                           "SELECT u.original, u.preview, u.thumbnail, u.source, u.content_hash, "
+                           "CASE WHEN b.status = %s THEN %s ELSE %s END, "
+                           "(SELECT placeholder FROM images i WHERE i.content_hash = u.content_hash "
+                           "AND i.placeholder IS NOT NULL LIMIT 1) "
+                           "FROM uploads u JOIN blobs b ON b.hash = u.content_hash "
+                           "RETURNING id, content_hash, status, placeholder",
+                           tuple(params) + (IMAGE_READY, IMAGE_READY, IMAGE_PENDING))
+        except PostgresError:
+            raise
+
+        if len(result) != len(images):
+            raise PostgresError("Could not insert images into database.")
+
+        # The order of RETURNING is not guaranteed, images with the same content are interchangeable
+        inserted = {}
+        for image_id, content_hash, status, placeholder in result:
+            inserted.setdefault(content_hash, []).append((int(image_id), status, placeholder))
+        for image in images:
+            image.image_id, image.status, image.placeholder = inserted[image.content_hash].pop()
+            image.needs_renditions = False
+
+        # Claim the renditions nobody is generating yet (or whose claim is stale), only one upload of a content can win
+        missing = [content_hash for content_hash in references
+                   if any(image.status != IMAGE_READY for image in images if image.content_hash == content_hash)]
+        if len(missing) == 0:
+            return
 
         try:
-            result = fetch("INSERT INTO images(original, preview, thumbnail) VALUES (%s, %s, %s) RETURNING id",
-                    (original_name, preview_name, thumbnail_name))
+            claimed = fetch("UPDATE image_blobs SET status = %s, claimed_at = NOW() WHERE hash = ANY(%s) "
+                            "AND (status IN (%s, %s) OR (status = %s AND (claimed_at IS NULL "
+                            "OR claimed_at < NOW() - make_interval(secs => %s)))) "
+                            "RETURNING hash",
+                            (IMAGE_PENDING, missing, BLOB_NEW, IMAGE_FAILED, IMAGE_PENDING, IMAGE_CLAIM_TIMEOUT))
         except PostgresError:
             raise
 
-        if len(result) == 0 or result[0][0] is None:
-            raise PostgresError("Could not insert image into database.")
+        claimed = {row[0] for row in claimed}
+        for image in images:
+            if image.content_hash in claimed:
+                image.needs_renditions = True
+                claimed.remove(image.content_hash)
 
-        self.image_id = int(result[0][0])
+    def set_status(self, status: str, placeholder: str | None = None) -> None:
+        """
+        Updates the rendition status of the image and of all images with the same content.
 
+        :param status: The new status.
+        :param placeholder: The placeholder generated with the renditions, if any.
+
+        :raises PostgresError: If the database query fails.
+        """
+        try:
+            if self.content_hash is None:
+                execute("UPDATE images SET status = %s, placeholder = COALESCE(%s, placeholder) WHERE id = %s",
+                        (status, placeholder, self.image_id))
+            else:
+                # The stored upload first: it is locked by uploads of the same content until they are inserted,
+                # so the images are updated only after they are visible
+                execute("UPDATE image_blobs SET status = %s WHERE hash = %s", (status, self.content_hash))
+                execute("UPDATE images SET status = %s, placeholder = COALESCE(%s, placeholder) "
+                        "WHERE content_hash = %s", (status, placeholder, self.content_hash))
+        except PostgresError:
+            raise
+
+        self.status = status
+        self.placeholder = placeholder or self.placeholder
 
     def associate_with_offer(self, offer_id: int) -> None:
         """
@@ -186,11 +565,153 @@ class Image:
 
         :raises PostgresError: If the database query fails.
         :raises ImageNotFoundError: If the image does not exist.
+        :raises ImageNotSavedError: If the image is not saved or its renditions could not be generated.
         """
-        if not self.is_saved:
+        if not self.is_saved or self.status == IMAGE_FAILED:
             raise ImageNotSavedError(self.image_id)
 
         try:
             execute("UPDATE images SET offer_id = %s WHERE id = %s", (offer_id, self.image_id))
         except PostgresError:
-            raise
\ No newline at end of file
+            raise
+
+        offer_fragments.invalidate_offer(offer_id)
+
+
+def decode_for_renditions(raw_image: PILImage.Image, sizes: List[tuple[int, int]]) -> PILImage.Image:
+    """
+    Decodes the image at the smallest scale that still covers the center crops of all given sizes. JPEG images
+    are downscaled by the decoder itself (draft mode), so a large photo is never decoded at full resolution.
+    Other formats are decoded fully and then reduced with a fast box filter.
+
+    :param raw_image: The opened, not yet loaded image.
+    :param sizes: The sizes of the renditions that will be cropped from the result.
+    :return: The decoded image.
+    """
+    width, height = raw_image.size
+
+    # The largest factor by which the image can be scaled down so that every center crop still has enough pixels
+    scale = min(min(width, height * w / h) / w for w, h in sizes)
+
+    if scale >= 2 and raw_image.format == "JPEG":
+        raw_image.draft("RGB", (math.ceil(width / scale), math.ceil(height / scale)))
+        raw_image.load()
+        # draft only scales by powers of two, reduce the rest of the way
+        width, height = raw_image.size
+        scale = min(min(width, height * w / h) / w for w, h in sizes)
+
+    raw_image.load()
+    if scale >= 2:
+        return raw_image.reduce(int(scale))
+
+    return raw_image
+
+
+def encode(img: PILImage.Image, file: BinaryIO | str, fmt: str, profile: str) -> None:
+    """
+    Encodes a rendition with one of the ENCODING_PROFILES.
+
+    :param img: The rendition.
+    :param file: The file or the path to write to.
+    :param fmt: The Pillow format, e.g. "JPEG".
+    :param profile: The name of the profile.
+    """
+    params = dict(ENCODING_PROFILES[profile])
+    metadata = params.pop("metadata", "strip")
+
+    # The renditions keep the metadata of the upload through the crops and resizes, it is only written if asked for
+    if metadata in ("icc", "all") and img.info.get("icc_profile"):
+        params["icc_profile"] = img.info["icc_profile"]
+    if metadata == "all" and img.info.get("exif"):
+        params["exif"] = img.info["exif"]
+
+    img.save(file, fmt, **params)
+
+
+def make_placeholder(img: PILImage.Image) -> str:
+    """
+    Creates the placeholder of an image: a tiny, blurry JPEG as a data URI of about 450 bytes, that clients can
+    show (scaled up) before the preview is loaded.
+
+    :param img: The image, e.g. the preview rendition.
+    :return: The data URI.
+    """
+    encoded = BytesIO()
+    img.resize(PLACEHOLDER_SIZE, PILImage.Resampling.BOX).save(encoded, "JPEG", quality=PLACEHOLDER_QUALITY, optimize=True)
+    return "data:image/jpeg;base64," + b64encode(encoded.getvalue()).decode("ascii")
+
+
+def generate_renditions(source_name: str, rendition_names: List[str]) -> str:
+    """
+    Generates the renditions of a stored upload, one for each of the SIZES, and its placeholder. Runs in the
+    rendition worker processes, so it must only depend on its arguments and the storage.
+
+    The upload is decoded once, at the smallest scale the largest rendition needs. Every next rendition is then
+    resized from the previous one with the same framing, or from a reduced copy of the decoded image, instead of
+    from the full resolution upload.
+
+    The renditions are encoded one after another and written to the storage in parallel.
+
+    :param source_name: The name of the stored upload.
+    :param rendition_names: The names of the renditions, in the order of SIZES.
+    :return: The placeholder, made from the preview.
+    """
+    encoded = {}
+    placeholder = None
+    with storage.open(source_name) as file, open_image(file) as raw_image:
+        decoded = decode_for_renditions(raw_image, SIZES)
+        if decoded.mode != "RGB":
+            decoded = decoded.convert("RGB")
+
+        previous = None
+        for (width, height), name, profile in zip(SIZES, rendition_names, RENDITIONS):
+            if previous is not None and abs(previous.width / previous.height - width / height) < 0.01 \
+                    and previous.width * previous.height < decoded.width * decoded.height:
+                source = previous
+            else:
+                source = decoded
+                # Reduce cheaply to about twice the needed size before the expensive resampling
+                factor = int(min(decoded.width / width, decoded.height / height) / 2)
+                if factor >= 2:
+                    source = decoded.reduce(factor)
+
+            rendition = Image.crop_center(source, width, height)
+            encoded[name] = SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE)
+            encode(rendition, encoded[name], "JPEG", profile)
+            encoded[name].seek(0)
+            previous = rendition
+
+            if (width, height) == SIZES[1]:
+                placeholder = make_placeholder(rendition)
+
+    try:
+        storage.save_many(encoded)
+    finally:
+        for file in encoded.values():
+            file.close()
+
+    return placeholder
+
+
+def render_rendition(source_name: str, output: str, width: int, height: int, extension: str) -> None:
+    """
+    Renders a single rendition of a stored upload, for the on-demand rendition endpoint. Runs in the rendition
+    worker processes, like `generate_renditions`.
+
+    :param source_name: The name of the stored upload (or of a rendition of images uploaded before they were kept).
+    :param output: The path to write the rendition to.
+    :param width: The width of the rendition.
+    :param height: The height of the rendition.
+    :param extension: The extension of the format, one of RENDITION_FORMATS.
+    """
+    with storage.open(source_name) as file, open_image(file) as raw_image:
+        decoded = decode_for_renditions(raw_image, [(width, height)])
+        if decoded.mode != "RGB":
+            decoded = decoded.convert("RGB")
+
+        factor = int(min(decoded.width / width, decoded.height / height) / 2)
+        if factor >= 2:
+            decoded = decoded.reduce(factor)
+
+        rendition = Image.crop_center(decoded, width, height)
+        encode(rendition, output, RENDITION_FORMATS[extension][0], extension)
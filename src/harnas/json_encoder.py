@@ -1,20 +1,25 @@
-from flask.json import JSONEncoder
-from flask import jsonify
+from flask.json.provider import DefaultJSONProvider
+from flask import jsonify, make_response, request, Response
 
-from typing import Any, Callable
+from typing import Any, Callable, Iterable, Iterator
 
 from error import Error
-from currencies import Currency, Price
+from currencies import Currency, Price, registry as currency_registry
 from images import Image
 from messages import Message
-from offers import Offer
-from users import User
+from offers import Offer, SELLER_VERSION_COLUMN, VERSION_COLUMN
+from users import User, drop_if_stale
 from review import Review
+from storage import storage
+from serializer import encoder, is_registered, default, dumps, number, stream_array, stream_lines, Fragment
 
 from datetime import datetime
-from os import environ
+from contextvars import Context, copy_context
+from hashlib import sha1
 
-ROOT_URL = environ["ROOT_URL"]
+from exc import InvalidFieldsetError
+from fieldsets import DEFAULT_FIELDSET, Fieldset, offer_fieldset, parse_fieldset
+from fragments import offer_fragments
 
 
 # TODO: Refactor
@@ -27,9 +32,7 @@ def as_json(func: Callable) -> Callable:
         else:
             o = result
 
-        if isinstance(o, Error) or isinstance(o, Currency) or isinstance(o, Image) \
-                or isinstance(o, Message) or isinstance(o, Offer) or isinstance(o, User) \
-                or isinstance(o, Review) or isinstance(o, Price):
+        if is_registered(o):
             o = jsonify(o)
 
         if isinstance(result, tuple):
@@ -41,88 +44,298 @@ def as_json(func: Callable) -> Callable:
     return wrapper
 
 
-class APIEncoder(JSONEncoder):
-    def default(self, obj: Any) -> Any:
-        if isinstance(obj, Error):
-            return {
-                'error': obj.message
-            }
-
-        if isinstance(obj, Offer):
-            prices = []
-            for c in obj.seller.accepted_currencies:
-                prices.append(obj.price.convert_to(c))
-
-            return {
-                'offer_id': obj.offer_id,
-                'title': obj.title,
-                'description': obj.description,
-                'price': prices,
-                'seller': obj.seller,
-                'images': obj.images,
-                'location': obj.location,
-                'created_at': obj.created_at
-            }
-
-        if isinstance(obj, Currency):
-            return {
-                'symbol': obj.symbol,
-                'name': obj.name,
-                'value': obj.value
-            }
-
-        if isinstance(obj, Image):
-            # Temporary solution
-            # TODO: Remove after updating the database
-            if "http" in obj.original:
-                return {
-                    'image_id': obj.image_id,
-                    'original': obj.original,
-                    'preview': obj.preview,
-                    'thumbnail': obj.thumbnail
-                }
-
-            original_url = ROOT_URL + '/image/' + obj.original
-            preview_url = ROOT_URL + '/image/' + obj.preview
-            thumbnail_url = ROOT_URL + '/image/' + obj.thumbnail
-
-            return {
-                'image_id': obj.image_id,
-                'original': original_url,
-                'preview': preview_url,
-                'thumbnail': thumbnail_url
-            }
-
-        if isinstance(obj, Message):
-            return {
-                'message_id': obj.message_id,
-                'sender_id': obj.sender.uid,
-                'receiver_id': obj.receiver.uid,
-                'content': obj.content,
-                'sent_at': obj.sent_at
-            }
-
-        if isinstance(obj, Price):
-            return {
-                'amount': obj.amount,
-                'currency': obj.currency
-            }
-
-        if isinstance(obj, User):
-            return {
-                'uid': obj.uid,
-                'name': obj.name,
-                'accepted_currencies': obj.accepted_currencies
-            }
-
-        if isinstance(obj, Review):
-            return {
-                'reviewer_id': obj.reviewer.uid,
-                'reviewee_id': obj.reviewee.uid,
-                'review': obj.review,
-            }
-
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-
-        return super().default(obj)
+def conditional(validator: Callable[..., Any]) -> Callable:
+    """
+    Answers GET requests with 304 Not Modified when their If-None-Match matches the weak entity tag made from the
+    validator, without calling the view at all. Otherwise the tag is set on the 200 responses of the view. Goes
+    above `as_json`.
+
+    The validator is called with the arguments of the view and returns something cheap to get that changes
+    whenever the response would (e.g. row versions), or None to skip validation. It runs before the view, so a
+    change in between only makes the tag older than the body, which is never answered with stale data.
+
+    :param validator: The function returning the version of the response.
+    :return: The decorator.
+    """
+    def decorator(func: Callable) -> Callable:
+        def wrapper(*args, **kwargs):
+            try:
+                version = validator(*args, **kwargs)
+            except Exception as e:
+                print("Exception:", e)
+                version = None
+
+            if version is None:
+                return func(*args, **kwargs)
+
+            etag = sha1(repr(version).encode("utf-8")).hexdigest()
+            if request.if_none_match.contains_weak(etag):
+                resp = make_response("", 304)
+                resp.set_etag(etag, weak=True)
+                # As the 200 responses, which are compressed
+                resp.vary.add("Accept-Encoding")
+                return resp
+
+            resp = make_response(func(*args, **kwargs))
+            if resp.status_code == 200:
+                resp.set_etag(etag, weak=True)
+            return resp
+
+        wrapper.__name__ = func.__name__
+        return wrapper
+
+    return decorator
+
+
+def offer_fields(func: Callable) -> Callable:
+    """
+    Loads and serializes the offers of the decorated view with the fields and the nested objects requested with
+    the fields and expand query parameters (see `fieldsets.parse_fieldset`). Goes above `as_json`, so that the
+    offers are serialized with the fieldset too.
+
+    :param func: The view.
+    :return: The decorated view.
+    """
+    def wrapper(*args, **kwargs):
+        try:
+            fieldset = parse_fieldset(request.args.get("fields"), request.args.get("expand"))
+        except InvalidFieldsetError as e:
+            return jsonify(Error(str(e))), 400
+
+        token = offer_fieldset.set(fieldset)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            offer_fieldset.reset(token)
+
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+
+def stream_response(batches: Iterable[list], ndjson: bool = False) -> Response:
+    """
+    Streams a JSON array (or NDJSON, an item per line) written a batch of items at a time, as the batches are loaded.
+    The first batch is loaded before returning, so that an error of the query is still answered with an error status.
+    The rest is loaded in the context of the request (e.g. with its fieldset), after the view returned.
+
+    :param batches: The lists of items, e.g. hydrated from the batches of `db.stream`.
+    :param ndjson: Whether to write NDJSON instead of a JSON array.
+    :return: The response.
+    """
+    chunks = stream_lines(batches) if ndjson else stream_array(batches)
+    first = next(chunks, b"")
+    mimetype = NDJSON_MIMETYPE if ndjson else "application/json"
+    return Response(_resume(first, chunks, copy_context()), mimetype=mimetype)
+
+
+def _resume(first: bytes, chunks: Iterator[bytes], context: Context) -> Iterator[bytes]:
+    try:
+        yield first
+        while True:
+            chunk = context.run(next, chunks, None)
+            if chunk is None:
+                break
+            yield chunk
+    except Exception as e:
+        # The status is sent already, the client sees the body cut short
+        print("Exception:", e)
+    finally:
+        chunks.close()
+
+
+def encode_offer_rows(raw_offers: list[tuple]) -> list[Fragment]:
+    """
+    Serializes offers from their rows with the fieldset of the request. The offers already serialized at the
+    current versions of the offer (which changes with its images), of the seller (which changes with their accepted
+    currencies) and of the exchange rates are taken from the fragment cache as they are. The versions of the offer and
+    of the seller are read from the rows, so a change made through another worker is seen right away. Only the other
+    offers are loaded and serialized, and then cached. A list of the fragments is serialized by joining them.
+
+    :param raw_offers: The raw rows of the database.
+    :return: The serialized offers, in the same order.
+    :raises UserNotFoundError: If the seller of an offer does not exist.
+    :raises PostgresError: If the database error occurs.
+    """
+    fieldset = offer_fieldset.get()
+    currencies_version = currency_registry.snapshot.version
+
+    versions = {}
+    fragments = {}
+    missing = []
+    for raw_offer in raw_offers:
+        # The fragments without the sellers do not depend on them
+        seller_version = raw_offer[SELLER_VERSION_COLUMN] if fieldset.needs_sellers else None
+        versions[raw_offer[0]] = (raw_offer[VERSION_COLUMN], seller_version, currencies_version)
+
+        fragment = offer_fragments.get(raw_offer[0], versions[raw_offer[0]], fieldset)
+        if fragment is None:
+            if seller_version is not None:
+                # The seller cached by this worker may be older than the one in the key of the fragment
+                drop_if_stale(raw_offer[1], seller_version)
+            missing.append(raw_offer)
+        else:
+            fragments[raw_offer[0]] = fragment
+
+    for offer in Offer.new_offers_from_rows(missing):
+        fragment = Fragment(dumps(offer))
+        offer_fragments.put(offer.offer_id, versions[offer.offer_id], offer.seller.uid, fieldset, fragment)
+        fragments[offer.offer_id] = fragment
+
+    return [fragments[raw_offer[0]] for raw_offer in raw_offers]
+
+
+class APIJSONProvider(DefaultJSONProvider):
+    """
+    Serializes the responses with `serializer.dumps` and the encoders registered below. The output is the same as
+    the one of Flask's own provider, which is still used for the indented responses of the debug mode.
+    """
+    default = staticmethod(default)
+
+    def response(self, *args, **kwargs) -> Response:
+        if (self.compact is None and self._app.debug) or self.compact is False \
+                or not self.ensure_ascii or not self.sort_keys:
+            return super().response(*args, **kwargs)
+
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj) + b"\n", mimetype=self.mimetype)
+
+
+# The encoders of the models call each other for the nested models, instead of leaving them to another dispatch
+@encoder(Error)
+def encode_error(obj: Error) -> dict:
+    return {
+        'error': obj.message
+    }
+
+
+@encoder(Offer)
+def encode_offer(obj: Offer) -> dict:
+    fieldset = offer_fieldset.get()
+    if fieldset is not DEFAULT_FIELDSET:
+        return encode_offer_fields(obj, fieldset)
+
+    return {
+        'offer_id': obj.offer_id,
+        'title': obj.title,
+        'description': obj.description,
+        'price': encode_converted_prices(obj),
+        'seller': encode_user(obj.seller),
+        'images': [encode_image(image) for image in obj.images],
+        'location': obj.location,
+        'created_at': obj.created_at
+    }
+
+
+def encode_offer_fields(obj: Offer, fieldset: Fieldset) -> dict:
+    encoded = {}
+    for name in fieldset.fields:
+        if name == 'price':
+            encoded['price'] = encode_converted_prices(obj)
+        elif name == 'seller':
+            encoded['seller'] = encode_user(obj.seller) if fieldset.expands('seller') else obj.seller.uid
+        elif name == 'images':
+            encoded['images'] = [encode_image(image) for image in obj.images] if fieldset.expands('images') \
+                else [image.image_id for image in obj.images]
+        else:
+            encoded[name] = getattr(obj, name)
+
+    return encoded
+
+
+def encode_converted_prices(obj: Offer) -> list[dict]:
+    prices = obj.converted_prices
+    if prices is None:
+        price = obj.price
+        prices = [price.convert_to(c) for c in obj.seller.accepted_currencies]
+
+    return [encode_price(price) for price in prices]
+
+
+@encoder(Currency)
+def encode_currency(obj: Currency) -> dict:
+    return {
+        'symbol': obj.symbol,
+        'name': obj.name,
+        'value': number(obj.value)
+    }
+
+
+@encoder(Image)
+def encode_image(obj: Image) -> dict:
+    # The renditions of pending and failed images do not exist
+    if not obj.is_ready:
+        return {
+            'image_id': obj.image_id,
+            'status': obj.status,
+            'original': None,
+            'preview': None,
+            'thumbnail': None,
+            'placeholder': obj.placeholder
+        }
+
+    # Temporary solution
+    # TODO: Remove after updating the database
+    if "http" in obj.original:
+        return {
+            'image_id': obj.image_id,
+            'status': obj.status,
+            'original': obj.original,
+            'preview': obj.preview,
+            'thumbnail': obj.thumbnail,
+            'placeholder': obj.placeholder
+        }
+
+    url = storage.url
+    return {
+        'image_id': obj.image_id,
+        'status': obj.status,
+        'original': url(obj.original),
+        'preview': url(obj.preview),
+        'thumbnail': url(obj.thumbnail),
+        'placeholder': obj.placeholder
+    }
+
+
+@encoder(Message)
+def encode_message(obj: Message) -> dict:
+    return {
+        'message_id': obj.message_id,
+        'sender_id': obj.sender.uid,
+        'receiver_id': obj.receiver.uid,
+        'content': obj.content,
+        'sent_at': obj.sent_at
+    }
+
+
+@encoder(Price)
+def encode_price(obj: Price) -> dict:
+    return {
+        'amount': number(obj.amount),
+        'currency': encode_currency(obj.currency)
+    }
+
+
+@encoder(User)
+def encode_user(obj: User) -> dict:
+    return {
+        'uid': obj.uid,
+        'name': obj.name,
+        'accepted_currencies': [encode_currency(c) for c in obj.accepted_currencies]
+    }
+
+
+@encoder(Review)
+def encode_review(obj: Review) -> dict:
+    return {
+        'reviewer_id': obj.reviewer.uid,
+        'reviewee_id': obj.reviewee.uid,
+        'review': obj.review,
+    }
+
+
+@encoder(datetime)
+def encode_datetime(obj: datetime) -> str:
+    return obj.isoformat()
@@ -1,5 +1,5 @@
 # Types import
-from typing import Optional
+from typing import Optional, Iterator
 from users import User
 
 # Exceptions import
@@ -8,7 +8,7 @@ from exc import MessageAlreadySentError, UserNotFoundError
 # Functions import
 from datetime import datetime
 from dataclasses import dataclass
-from db import execute, fetch
+from db import execute, fetch, stream
 
 
 @dataclass(init=True, eq=True, order=True, unsafe_hash=False, frozen=False)
@@ -94,16 +94,40 @@ class Message:
         except UserNotFoundError:
             raise
 
-        m = []
-
         result = fetch("SELECT * FROM messages WHERE sender_id = %s OR receiver_id = %s", (user_id, user_id))
 
-        for raw_message in result:
-            sender = User.get_user_by_id(raw_message[1])
-            receiver = User.get_user_by_id(raw_message[2])
-            m.append(cls(raw_message[0], sender, receiver, raw_message[3], raw_message[4]))
+        return cls.new_messages_from_rows(result)
 
-        return m
+    @classmethod
+    def stream_messages_by_user_id(cls, user_id: str) -> Iterator[list["Message"]]:
+        """
+        Streams all messages sent to or from a user, loaded a batch at a time.
+
+        :param user_id: The id of the user.
+        :raises UserNotFoundError: If the user does not exist, before the first batch.
+        :return: A generator of lists of messages.
+        """
+        try:
+            User.get_user_by_id(user_id)
+        except UserNotFoundError:
+            raise
+
+        for rows in stream("SELECT * FROM messages WHERE sender_id = %s OR receiver_id = %s", (user_id, user_id)):
+            yield cls.new_messages_from_rows(rows)
+
+    @classmethod
+    def new_messages_from_rows(cls, raw_messages) -> list["Message"]:
+        """
+        Creates messages from raw rows of the database, loading all the senders and receivers with a single query.
+
+        :param raw_messages: The raw rows of the database.
+        :return: The messages, in the same order.
+        """
+        users = User.get_users_by_ids([raw_message[1] for raw_message in raw_messages] +
+                                      [raw_message[2] for raw_message in raw_messages])
+
+        return [cls(raw_message[0], users[raw_message[1]], users[raw_message[2]], raw_message[3], raw_message[4])
+                for raw_message in raw_messages]
 
     @classmethod
     def get_messages_beetween_user_ids(cls, user_id_1: str, user_id_2: str) -> list["Message"]:
@@ -127,9 +151,12 @@ class Message:
         result = fetch("SELECT * FROM messages WHERE (sender_id = %s AND receiver_id = %s) OR "
                        "(sender_id = %s AND receiver_id = %s)", (user_id_1, user_id_2, user_id_2, user_id_1))
 
+        users = User.get_users_by_ids([raw_message[1] for raw_message in result] +
+                                      [raw_message[2] for raw_message in result])
+
         for raw_message in result:
-            sender = User.get_user_by_id(raw_message[1])
-            receiver = User.get_user_by_id(raw_message[2])
+            sender = users[raw_message[1]]
+            receiver = users[raw_message[2]]
             m.append(cls(raw_message[0], sender, receiver, raw_message[3], raw_message[4]))
 
         return m
@@ -149,15 +176,12 @@ class Message:
         except UserNotFoundError:
             raise
 
-        users = []
-
         result = fetch("SELECT DISTINCT sender_id FROM messages WHERE receiver_id = %s UNION "
                        "SELECT DISTINCT receiver_id FROM messages WHERE sender_id = %s", (user_id, user_id))
 
-        for raw_user in result:
-            users.append(User.get_user_by_id(raw_user[0]))
+        users = User.get_users_by_ids([raw_user[0] for raw_user in result])
 
-        return users
+        return [users[raw_user[0]] for raw_user in result]
 
     def __str__(self) -> str:
         return f"Message {self.message_id} from {self.sender.uid} to {self.receiver.uid} at {self.sent_at}"
@@ -0,0 +1,77 @@
+from dataclasses import asdict, is_dataclass
+from typing import Any, Callable
+
+import resource
+
+# Registered metric providers, name prefix -> function returning a mapping (or a dataclass) of numeric values
+providers: dict[str, Callable[[], Any]] = {}
+
+
+def register(prefix: str, provider: Callable[[], Any]) -> None:
+    """
+    Registers a metrics provider. The provider is called on every scrape and should return a dict
+    (or a dataclass instance) mapping metric names to numbers.
+
+    :param prefix: The prefix of the metric names, e.g. "harnas_db_pool".
+    :param provider: The function returning the current values.
+    """
+    providers[prefix] = provider
+
+
+def collect() -> dict[str, float]:
+    """
+    Collects the current values of all registered metrics. Failing providers are skipped.
+
+    :return: A flat mapping of metric names to values.
+    """
+    values = {}
+
+    for prefix, provider in providers.items():
+        try:
+            result = provider()
+        except Exception as e:
+            print("Exception while collecting metrics:", e)
+            continue
+
+        if is_dataclass(result):
+            result = asdict(result)
+
+        for name, value in result.items():
+            if isinstance(value, bool):
+                value = int(value)
+            if isinstance(value, (int, float)):
+                values[f"{prefix}_{name}"] = value
+
+    return values
+
+
+def render() -> str:
+    """
+    Renders all metrics in the Prometheus text exposition format.
+
+    :return: The metrics as text.
+    """
+    return "".join(f"{name} {value}\n" for name, value in sorted(collect().items()))
+
+
+def process_memory(pid: int | str = "self") -> dict[str, int]:
+    """
+    Reads the resident memory of a process from /proc, e.g. to tell how close a worker is to being OOM-killed.
+
+    :param pid: The id of the process, the current process by default.
+    :return: The current and the peak resident set size in bytes.
+    """
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    memory["rss_bytes"] = int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    memory["peak_rss_bytes"] = int(line.split()[1]) * 1024
+    except OSError:
+        # Not on Linux, only the peak of the current process is known (in kilobytes on Linux, bytes on macOS)
+        if pid == "self":
+            memory["peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    return memory
@@ -0,0 +1,59 @@
+"""
+Moves the images kept flat in IMAGE_OUTPUT to the storage configured by IMAGE_STORAGE: to the sharded directories
+of the local storage, or to the S3 bucket. Safe to interrupt and run again, the files are served from the flat layout
+until they are moved.
+
+Usage: python migrate_storage.py [--workers 8] [--delete] [--dry-run]
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+
+import itertools
+
+from storage import storage, LocalStorage
+
+
+def migrate(source: LocalStorage, name: str, delete: bool) -> None:
+    if isinstance(storage, LocalStorage) and storage.root.resolve() == source.root.resolve():
+        storage.move_to_shard(name)
+        return
+
+    with open(source.flat_path(name), "rb") as f:
+        storage.save(name, f)
+
+    if delete:
+        source.flat_path(name).unlink()
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--delete", action="store_true", help="delete the local files after uploading them to S3")
+    parser.add_argument("--dry-run", action="store_true", help="only count the files to move")
+    args = parser.parse_args()
+
+    source = LocalStorage(environ["IMAGE_OUTPUT"], "", shard_depth=0)
+    names = source.flat_files()
+
+    if args.dry_run:
+        print(f"{sum(1 for _ in names)} files to move")
+        return
+
+    moved = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        # Submit in batches, so that millions of files are not all queued at once
+        while batch := list(itertools.islice(names, 1000)):
+            for name, future in [(name, executor.submit(migrate, source, name, args.delete)) for name in batch]:
+                try:
+                    future.result()
+                    moved += 1
+                except Exception as e:
+                    print(f"Exception while moving {name}:", e)
+                    failed += 1
+            print(f"{moved} files moved, {failed} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,77 @@
 # Types import
 from datetime import datetime
-from dataclasses import dataclass
-from users import User
-from currencies import Currency, Price
-from typing import Optional, List
+from dataclasses import dataclass, field
+from users import User, drop_if_stale
+from currencies import Currency, Price, convert_prices
+from typing import Optional, List, Iterator
+from os import environ
 from images import Image
 
 # Exceptions
-from exc import OfferNotFoundError, UserNotFoundError, CurrencyNotFoundError, PostgresError
+from exc import OfferNotFoundError, UserNotFoundError, CurrencyNotFoundError, PostgresError, InvalidCursorError
 
 # Functions import
-from db import fetch
+from db import fetch, stream
+from pagination import encode_cursor, decode_cursor
+from fieldsets import offer_fieldset
+from fragments import offer_fragments
 
 RESULTS_PER_PAGE = 15
 
+# The columns of the rows of offers, selected by name so that the positions read from the rows (by
+# `Offer.new_offers_from_rows` and `json_encoder.encode_offer_rows`) do not depend on the order of the table
+OFFER_COLUMNS = ("id", "seller_id", "name", "description", "price", "currency", "images", "created_at", "location",
+                 "version")
+# The current row version of the seller comes last, so that the serialized offers can be checked against it in every
+# worker, not only in the one that changed the seller
+SELECTED_COLUMNS = ", ".join(OFFER_COLUMNS) + \
+    ", (SELECT users.version FROM users WHERE users.id = offers.seller_id) AS seller_version"
+SELECT_OFFERS = f"SELECT {SELECTED_COLUMNS} FROM offers"
+# The positions of the row versions, see migrations/008_row_versions.sql
+VERSION_COLUMN = OFFER_COLUMNS.index("version")
+SELLER_VERSION_COLUMN = len(OFFER_COLUMNS)
+
+# "trigram" uses the pg_trgm GIN index on LOWER(name), "levenshtein" scans the whole table
+SEARCH_MODE = environ.get("SEARCH_MODE", "trigram")
+
+# The score of every row is selected last, so that it can be put into the cursor of the next page
+SEARCH_QUERIES = {
+    "trigram": {
+        "page": f"SELECT {SELECTED_COLUMNS}, SIMILARITY(LOWER(name), LOWER(%(query)s)) AS score FROM offers "
+                "WHERE LOWER(name) %% LOWER(%(query)s) "
+                "ORDER BY score DESC, id DESC LIMIT %(limit)s OFFSET %(offset)s",
+        "after": f"SELECT {SELECTED_COLUMNS}, SIMILARITY(LOWER(name), LOWER(%(query)s)) AS score FROM offers "
+                 "WHERE LOWER(name) %% LOWER(%(query)s) "
+                 "AND (SIMILARITY(LOWER(name), LOWER(%(query)s)), id) < (%(score)s::real, %(offer_id)s) "
+                 "ORDER BY score DESC, id DESC LIMIT %(limit)s",
+    },
+    "levenshtein": {
+        "page": f"SELECT {SELECTED_COLUMNS}, LEVENSHTEIN(LOWER(name), LOWER(%(query)s)) AS score FROM offers "
+                "WHERE LEVENSHTEIN(LOWER(name), LOWER(%(query)s)) < %(max_len)s "
+                "ORDER BY score ASC, id ASC LIMIT %(limit)s OFFSET %(offset)s",
+        "after": f"SELECT {SELECTED_COLUMNS}, LEVENSHTEIN(LOWER(name), LOWER(%(query)s)) AS score FROM offers "
+                 "WHERE LEVENSHTEIN(LOWER(name), LOWER(%(query)s)) < %(max_len)s "
+                 "AND (LEVENSHTEIN(LOWER(name), LOWER(%(query)s)), id) > (%(score)s, %(offer_id)s) "
+                 "ORDER BY score ASC, id ASC LIMIT %(limit)s",
+    },
+}
+
+
+def search_queries(mode: str) -> dict[str, str]:
+    """
+    :param mode: The search mode, a key of SEARCH_QUERIES.
+    :return: The queries of the mode.
+    :raises ValueError: If there is no such mode.
+    """
+    if mode not in SEARCH_QUERIES:
+        raise ValueError(f"Invalid SEARCH_MODE: {mode!r}, expected one of {', '.join(SEARCH_QUERIES)}")
+
+    return SEARCH_QUERIES[mode]
+
+
+# A misspelled mode fails the start of the server, not every search
+search_queries(SEARCH_MODE)
+
 
 @dataclass(init=True, eq=True, order=True, unsafe_hash=False, frozen=False)
 class Offer:
@@ -25,6 +83,8 @@ class Offer:
     images: List[Image]
     location: str
     created_at: datetime
+    # The price converted to the accepted currencies of the seller, for the offers loaded with a page of others
+    converted_prices: Optional[List[Price]] = field(default=None, compare=False)
 
     is_added = property(lambda self: self.offer_id is not None)
 
@@ -76,7 +136,7 @@ class Offer:
             raise
 
         try:
-            parsed_images = [Image.get_image_by_id(image_id) for image_id in images]
+            parsed_images = Image.get_images_by_ids(images)
         except Exception:
             raise
 
@@ -93,9 +153,41 @@ class Offer:
         :raises CurrencyNotFoundError: If the currency with the given symbol does not exist.
         :raises PostgresError: If the internal error happens.
         """
+        return cls.new_offers_from_rows([raw_offer])[0]
+
+    @classmethod
+    def new_offers_from_rows(cls, raw_offers) -> list["Offer"]:
+        """
+        Creates offers from raw rows of the database. The sellers, their accepted currencies, the currencies
+        and the images of all rows are loaded with a constant number of queries, regardless of the number of rows.
+        Only what the fieldset of the request needs is loaded: the sellers of the offers serialized without them
+        and without their prices are references only, and so are the images that are not expanded. The prices are
+        converted to the accepted currencies of the sellers for all rows at once.
+
+        :param raw_offers: The raw rows of the database.
+        :return: The offers from the parsed rows, in the same order.
+        :raises UserNotFoundError: If the user with the given id does not exist.
+        :raises CurrencyNotFoundError: If the currency with the given symbol does not exist.
+        :raises PostgresError: If the internal error happens.
+        """
+        if len(raw_offers) == 0:
+            return []
+
+        fieldset = offer_fieldset.get()
+        offer_ids = [raw_offer[0] for raw_offer in raw_offers]
+
         try:
-            currency = Currency.get_currency_by_symbol(raw_offer[5])
-            user = User.get_user_by_id(raw_offer[1])
+            currencies = Currency.get_currencies_by_symbols([raw_offer[5] for raw_offer in raw_offers])
+
+            if fieldset.needs_sellers:
+                users = User.get_users_by_ids([raw_offer[1] for raw_offer in raw_offers])
+            else:
+                users = {raw_offer[1]: User.reference(raw_offer[1]) for raw_offer in raw_offers}
+
+            if fieldset.includes("images"):
+                images = Image.get_images_by_offer_ids(offer_ids, ids_only=not fieldset.expands("images"))
+            else:
+                images = {offer_id: [] for offer_id in offer_ids}
         except UserNotFoundError:
             raise
         except CurrencyNotFoundError:
@@ -103,14 +195,16 @@ class Offer:
         except PostgresError:
             raise
 
-        try:
-            res = fetch("SELECT id FROM images WHERE offer_id = %s", (raw_offer[0],))
-            images = [Image.get_image_by_id(image_id[0]) for image_id in res]
-        except Exception:
-            raise
+        prices = [Price(raw_offer[4], currencies[raw_offer[5]]) for raw_offer in raw_offers]
+        if fieldset.includes("price"):
+            converted_prices = convert_prices(prices, [users[raw_offer[1]].accepted_currencies
+                                                       for raw_offer in raw_offers])
+        else:
+            converted_prices = [None] * len(raw_offers)
 
-        return cls(raw_offer[0], raw_offer[2], raw_offer[3],
-                   Price(raw_offer[4], currency), user, images, raw_offer[8], raw_offer[7])
+        return [cls(raw_offer[0], raw_offer[2], raw_offer[3], price, users[raw_offer[1]], images[raw_offer[0]],
+                    raw_offer[8], raw_offer[7], converted)
+                for raw_offer, price, converted in zip(raw_offers, prices, converted_prices)]
 
     def add(self) -> None:
         """
@@ -128,6 +222,7 @@ class Offer:
             raise PostgresError("The offer was not added to the database.")
 
         self.offer_id = result[0][0]
+        offer_fragments.invalidate_offer(self.offer_id)
 
         # Associate the images with the offer
         for image in self.images:
@@ -141,14 +236,67 @@ class Offer:
         :return: list of offers
         :raises: PostgresError if there is no offers in the database
         """
-        result = fetch("SELECT * FROM offers", ())
+        result = fetch(SELECT_OFFERS, ())
 
-        list_of_offers = []
+        return cls.new_offers_from_rows(result)
 
-        for offer in result:
-            list_of_offers.append(cls.new_offer_from_row(offer))
+    @classmethod
+    def get_offers_page(cls, page: Optional[int] = None, cursor: Optional[str] = None) -> tuple[list["Offer"], Optional[str]]:
+        """
+        Get a single page of offers, see `get_offer_rows_page`.
 
-        return list_of_offers
+        :param page: The page number, used when no cursor is given.
+        :param cursor: The cursor returned with the previous page.
+        :return: The offers on the page and the cursor of the next page (None if this is the last page).
+        :raises InvalidCursorError: If the cursor is malformed.
+        :raises PostgresError: If the database error occurs.
+        """
+        result, next_cursor = cls.get_offer_rows_page(page, cursor)
+        return cls.new_offers_from_rows(result), next_cursor
+
+    @classmethod
+    def get_offer_rows_page(cls, page: Optional[int] = None,
+                            cursor: Optional[str] = None) -> tuple[list[tuple], Optional[str]]:
+        """
+        Get the rows of a single page of offers, newest first, using keyset pagination on (created_at, id).
+
+        Pages can be addressed either by a cursor returned with the previous page, which costs the same regardless
+        of how deep the page is, or by a page number (starting at 0) for older clients.
+
+        :param page: The page number, used when no cursor is given.
+        :param cursor: The cursor returned with the previous page.
+        :return: The rows of the offers on the page and the cursor of the next page (None if this is the last page).
+        :raises InvalidCursorError: If the cursor is malformed.
+        :raises PostgresError: If the database error occurs.
+        """
+        if cursor is not None:
+            raw_created_at, offer_id = decode_cursor(cursor, 2)
+            try:
+                created_at = datetime.fromisoformat(raw_created_at)
+                offer_id = int(offer_id)
+            except (TypeError, ValueError):
+                raise InvalidCursorError(cursor)
+
+            result = fetch(SELECT_OFFERS + " WHERE (created_at, id) < (%s, %s) "
+                           "ORDER BY created_at DESC, id DESC LIMIT %s",
+                           (created_at, offer_id, RESULTS_PER_PAGE + 1))
+        elif page is None or page == 0:
+            result = fetch(SELECT_OFFERS + " ORDER BY created_at DESC, id DESC LIMIT %s",
+                           (RESULTS_PER_PAGE + 1,))
+        else:
+            # The first key of the page is found with an index-only scan, the page itself is then a keyset query
+            result = fetch(SELECT_OFFERS + " WHERE (created_at, id) <= "
+                           "(SELECT created_at, id FROM offers ORDER BY created_at DESC, id DESC OFFSET %s LIMIT 1) "
+                           "ORDER BY created_at DESC, id DESC LIMIT %s",
+                           (page * RESULTS_PER_PAGE, RESULTS_PER_PAGE + 1))
+
+        next_cursor = None
+        if len(result) > RESULTS_PER_PAGE:
+            result = result[:RESULTS_PER_PAGE]
+            last = result[-1]
+            next_cursor = encode_cursor(last[7].isoformat(), last[0])
+
+        return result, next_cursor
 
     @classmethod
     def search_offers(cls, query: str, page: int) -> list["Offer"]:
@@ -159,18 +307,65 @@ class Offer:
         :param query: the query to search
         :return: list of offers
         """
-        max_len = len(query)/2
-        page_start = page * RESULTS_PER_PAGE
-        result = fetch("SELECT * FROM piwegro.offers WHERE LEVENSHTEIN(LOWER(name), LOWER(%s)) < %s "
-                       "ORDER BY LEVENSHTEIN(LOWER(name), LOWER(%s)) ASC LIMIT %s OFFSET %s ;",
-                       (query, max_len, query, RESULTS_PER_PAGE, page_start))
+        return cls.search_offers_page(query, page)[0]
 
-        list_of_offers = []
-
-        for offer in result:
-            list_of_offers.append(cls.new_offer_from_row(offer))
+    @classmethod
+    def search_offers_page(cls, query: str, page: Optional[int] = None,
+                           cursor: Optional[str] = None) -> tuple[list["Offer"], Optional[str]]:
+        """
+        Search offers by query, see `search_offer_rows_page`.
+
+        :param query: The query to search.
+        :param page: The page number, used when no cursor is given.
+        :param cursor: The cursor returned with the previous page.
+        :return: The offers on the page and the cursor of the next page (None if this is the last page).
+        :raises InvalidCursorError: If the cursor is malformed.
+        :raises PostgresError: If the database error occurs.
+        """
+        result, next_cursor = cls.search_offer_rows_page(query, page, cursor)
+        return cls.new_offers_from_rows(result), next_cursor
 
-        return list_of_offers
+    @classmethod
+    def search_offer_rows_page(cls, query: str, page: Optional[int] = None,
+                               cursor: Optional[str] = None) -> tuple[list[tuple], Optional[str]]:
+        """
+        Search the rows of offers by query, most fitting first.
+
+        In the "trigram" mode (the default) the offers are matched by the trigram similarity of their names, which
+        is served by a GIN index. The "levenshtein" mode computes the edit distance for every offer instead.
+        Both modes can be paginated with a cursor, so deep pages do not need an OFFSET.
+
+        :param query: The query to search.
+        :param page: The page number, used when no cursor is given.
+        :param cursor: The cursor returned with the previous page.
+        :return: The rows of the offers on the page and the cursor of the next page (None if this is the last page).
+        :raises InvalidCursorError: If the cursor is malformed.
+        :raises PostgresError: If the database error occurs.
+        """
+        queries = search_queries(SEARCH_MODE)
+        max_len = len(query) / 2
+
+        if cursor is not None:
+            score, offer_id = decode_cursor(cursor, 2)
+            try:
+                score = float(score)
+                offer_id = int(offer_id)
+            except (TypeError, ValueError):
+                raise InvalidCursorError(cursor)
+
+            result = fetch(queries["after"], {"query": query, "max_len": max_len, "score": score,
+                                              "offer_id": offer_id, "limit": RESULTS_PER_PAGE + 1})
+        else:
+            result = fetch(queries["page"], {"query": query, "max_len": max_len, "limit": RESULTS_PER_PAGE + 1,
+                                             "offset": (page or 0) * RESULTS_PER_PAGE})
+
+        next_cursor = None
+        if len(result) > RESULTS_PER_PAGE:
+            result = result[:RESULTS_PER_PAGE]
+            last = result[-1]
+            next_cursor = encode_cursor(last[-1], last[0])
+
+        return result, next_cursor
 
     @classmethod
     def get_offer_by_id(cls, offer_id: str) -> "Offer":
@@ -181,7 +376,18 @@ class Offer:
         :return: an offer
         :raises: PostgresError: if there is no offer with the given id
         """
-        result = fetch("SELECT * from offers WHERE id = %s", (offer_id,))
+        return cls.new_offer_from_row(cls.get_offer_row_by_id(offer_id))
+
+    @classmethod
+    def get_offer_row_by_id(cls, offer_id: str) -> tuple:
+        """
+        Get the row of an offer by its id
+
+        :param offer_id:
+        :return: the row of the offer
+        :raises: OfferNotFoundError: if there is no offer with the given id
+        """
+        result = fetch(SELECT_OFFERS + " WHERE id = %s", (offer_id,))
 
         if result is None or len(result) == 0:
             raise OfferNotFoundError(f"Offer with id {offer_id} not found")
@@ -190,8 +396,25 @@ class Offer:
         if raw_offer is None:
             raise OfferNotFoundError(f"Offer with id {offer_id} not found")
 
-        offer = cls.new_offer_from_row(raw_offer)
-        return offer
+        return raw_offer
+
+    @classmethod
+    def get_version(cls, offer_id: str) -> tuple[int, int] | None:
+        """
+        Gets the row versions of an offer and of its seller, without loading the offer. The version of the offer
+        changes with its images too.
+
+        :param offer_id: The id of the offer.
+        :return: The version of the offer and the version of the seller, None if the offer does not exist.
+        :raises PostgresError: If the database error occurs.
+        """
+        result = fetch("SELECT o.version, o.seller_id, u.version FROM offers o JOIN users u ON u.id = o.seller_id "
+                       "WHERE o.id = %s", (offer_id,))
+        if len(result) == 0:
+            return None
+
+        drop_if_stale(result[0][1], result[0][2])
+        return result[0][0], result[0][2]
 
     @classmethod
     def get_offers_by_user_id(cls, user_id: str) -> list["Offer"]:
@@ -202,7 +425,7 @@ class Offer:
         :return: an offer
         :raises PostgresError is there is no offer from the user
         """
-        result = fetch("SELECT * from offers WHERE seller_id = %s", (user_id,))
+        result = fetch(SELECT_OFFERS + " WHERE seller_id = %s", (user_id,))
 
         if result is None or len(result) == 0:
 
@@ -212,11 +435,38 @@ class Offer:
         if raw_offer is None:
             raise OfferNotFoundError(f"No offers found for user {user_id}")
 
-        list_of_offers = []
-        for offer in result:
-            list_of_offers.append(cls.new_offer_from_row(offer))
+        return cls.new_offers_from_rows(result)
+
+    @classmethod
+    def stream_offers_by_user_id(cls, user_id: str) -> Iterator[list["Offer"]]:
+        """
+        Streams all offers of a user, loaded a batch at a time.
+
+        :param user_id: The id of the user.
+        :return: A generator of lists of offers.
+        :raises OfferNotFoundError: If the user has no offers, before the first batch.
+        :raises PostgresError: If the database error occurs.
+        """
+        for rows in cls.stream_offer_rows_by_user_id(user_id):
+            yield cls.new_offers_from_rows(rows)
 
-        return list_of_offers
+    @classmethod
+    def stream_offer_rows_by_user_id(cls, user_id: str) -> Iterator[list[tuple]]:
+        """
+        Streams the rows of all offers of a user, a batch at a time.
+
+        :param user_id: The id of the user.
+        :return: A generator of lists of rows.
+        :raises OfferNotFoundError: If the user has no offers, before the first batch.
+        :raises PostgresError: If the database error occurs.
+        """
+        found = False
+        for rows in stream(SELECT_OFFERS + " WHERE seller_id = %s", (user_id,)):
+            found = True
+            yield rows
+
+        if not found:
+            raise OfferNotFoundError(f"No offers found for user {user_id}")
 
     def __str__(self):
         return f'Offer\nTitle: "{self.title}" (ID: {self.id})\nDescription: "{self.description}"\n' \
@@ -0,0 +1,53 @@
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from json import dumps, loads
+from typing import Any
+
+from exc import InvalidCursorError
+
+
+def encode_cursor(*values: Any) -> str:
+    """
+    Encodes the sort key of the last row of a page as an opaque cursor token.
+
+    :param values: The JSON-serializable values of the sort key.
+    :return: The cursor token.
+    """
+    raw = dumps(list(values), separators=(",", ":")).encode("utf-8")
+    return urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token: str, length: int) -> list[Any]:
+    """
+    Decodes a cursor token created by `encode_cursor`.
+
+    :param token: The cursor token.
+    :param length: The expected number of values in the sort key.
+    :return: The values of the sort key.
+    :raises InvalidCursorError: If the token is malformed.
+    """
+    try:
+        values = loads(urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except Exception:
+        raise InvalidCursorError(token)
+
+    if not isinstance(values, list) or len(values) != length:
+        raise InvalidCursorError(token)
+
+    return values
+
+
+def parse_page(page: str) -> tuple[int | None, str | None]:
+    """
+    Parses the page argument of a paginated endpoint, which is either a page number or a cursor token.
+
+    :param page: The page argument.
+    :return: A tuple of the page number and the cursor token, exactly one of which is not None.
+    :raises InvalidCursorError: If the page is a negative number.
+    """
+    if page.isdigit():
+        return int(page), None
+
+    if page.startswith("-"):
+        raise InvalidCursorError(page)
+
+    return None, page
@@ -0,0 +1,108 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from os import environ
+
+import threading
+
+import metrics
+
+from images import Image, generate_renditions, render_rendition, IMAGE_READY, IMAGE_FAILED
+
+# The number of processes generating renditions in every worker
+RENDITION_WORKERS = int(environ.get("RENDITION_WORKERS", "2"))
+
+executor: ProcessPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """
+    Returns the rendition process pool, creating it on first use. The processes are spawned rather than forked,
+    as forking a multithreaded server is unsafe.
+
+    :return: The process pool.
+    """
+    global executor
+    with _executor_lock:
+        if executor is None:
+            executor = ProcessPoolExecutor(max_workers=RENDITION_WORKERS, mp_context=get_context("spawn"))
+        return executor
+
+
+def _reset_executor(broken: ProcessPoolExecutor) -> None:
+    global executor
+    with _executor_lock:
+        if executor is broken:
+            executor = None
+    broken.shutdown(wait=False)
+
+
+def _submit(fn, *args) -> tuple[ProcessPoolExecutor, Future]:
+    pool = get_executor()
+    try:
+        return pool, pool.submit(fn, *args)
+    except BrokenProcessPool:
+        # A worker process died (e.g. it was OOM-killed), start over with a new pool
+        _reset_executor(pool)
+        pool = get_executor()
+        return pool, pool.submit(fn, *args)
+
+
+def submit(image: Image) -> Future:
+    """
+    Generates the renditions of a pending image in the background. The status of the image is set to "ready"
+    once all renditions are written, or to "failed" if they could not be generated.
+
+    :param image: The image, saved with `Image.save_original`.
+    :return: The future of the rendition job.
+    """
+    pool, future = _submit(generate_renditions, image.source, [image.original, image.preview, image.thumbnail])
+    future.add_done_callback(lambda f: _finish(image, pool, f))
+    return future
+
+
+def render(source_name: str, output: str, width: int, height: int, extension: str) -> None:
+    """
+    Renders a single rendition in the worker pool and waits for it, see `images.render_rendition`.
+
+    :raises Exception: If the rendition could not be rendered.
+    """
+    pool, future = _submit(render_rendition, source_name, output, width, height, extension)
+    try:
+        future.result()
+    except BrokenProcessPool:
+        _reset_executor(pool)
+        raise
+
+
+def _finish(image: Image, pool: ProcessPoolExecutor, future: Future) -> None:
+    error = future.exception()
+
+    if isinstance(error, BrokenProcessPool):
+        _reset_executor(pool)
+
+    if error is not None:
+        print(f"Exception while generating renditions of image {image.image_id}:", error)
+
+    try:
+        if error is None:
+            image.set_status(IMAGE_READY, future.result())
+        else:
+            image.set_status(IMAGE_FAILED)
+    except Exception as e:
+        print(f"Exception while updating the status of image {image.image_id}:", e)
+
+
+def stats() -> dict[str, int]:
+    """
+    :return: The number of rendition processes and their total resident memory, as the images are decoded there.
+    """
+    with _executor_lock:
+        processes = list((executor._processes or {}).values()) if executor is not None else []
+
+    rss = 0
+    for process in processes:
+        rss += metrics.process_memory(process.pid).get("rss_bytes", 0)
+
+    return {"workers": len(processes), "rss_bytes": rss}
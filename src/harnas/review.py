@@ -25,7 +25,22 @@ class Review:
         except Exception as e:
             raise PostgresError(e)
 
-        return [cls(User.get_user_by_id(r[0]), User.get_user_by_id(r[1]), r[2]) for r in reviews]
+        users = User.get_users_by_ids([r[0] for r in reviews] + [r[1] for r in reviews])
+
+        return [cls(users[r[0]], users[r[1]], r[2]) for r in reviews]
+
+    @classmethod
+    def get_version(cls, uid: str) -> str:
+        """
+        Gets a version of all reviews for the user with the given id, without loading them. Reviews are only ever
+        added or replaced, each of which changes the number of them or the time of the latest one.
+
+        :param uid: The id of the user.
+        :return: The version.
+        :raises PostgresError: If the database error occurs.
+        """
+        result = fetch("SELECT count(*), max(updated_at) FROM reviews WHERE reviewee = %s", (uid,))
+        return f"{result[0][0]}-{result[0][1]}"
 
     @classmethod
     def new_review_with_ids(cls, reviewer_id: str, reviewee_id: str, review: str) -> "Review":
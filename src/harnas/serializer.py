@@ -0,0 +1,223 @@
+from dataclasses import asdict, is_dataclass
+from datetime import date
+from decimal import Decimal
+from json import dumps as json_dumps, loads
+from json.encoder import encode_basestring_ascii
+from os import environ
+from typing import Any, Callable, Dict, Iterable, Iterator
+from uuid import UUID
+
+from werkzeug.http import http_date
+
+import codecs
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# "orjson" (used if it is installed) or "json" (the standard library)
+JSON_SERIALIZER = environ.get("JSON_SERIALIZER", "orjson")
+
+# type -> the function returning something serializable in place of an object of the type
+ENCODERS: Dict[type, Callable[[Any], Any]] = {}
+
+# The dates, times and dataclasses are passed to `default` as they are, so that they are encoded as registered
+ORJSON_OPTIONS = 0 if orjson is None else \
+    orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+# The bytes left as they are by ensure_ascii, DEL is escaped
+ASCII = bytes(range(0x7f))
+
+
+def encoder(cls: type) -> Callable:
+    """
+    Registers the decorated function as the encoder of the objects of the given type and of its subclasses.
+
+    :param cls: The type.
+    :return: The decorator.
+    """
+    def register(function: Callable[[Any], Any]) -> Callable[[Any], Any]:
+        ENCODERS[cls] = function
+        return function
+
+    return register
+
+
+def is_registered(obj: Any) -> bool:
+    return type(obj) in ENCODERS or _resolve(type(obj)) is not None
+
+
+def _resolve(cls: type) -> Callable[[Any], Any] | None:
+    for base in cls.__mro__[1:]:
+        if base in ENCODERS:
+            # Remembered, so that the next object of the type is a single lookup
+            ENCODERS[cls] = ENCODERS[base]
+            return ENCODERS[cls]
+
+    return None
+
+
+def default(obj: Any) -> Any:
+    """
+    Encodes an object the JSON libraries do not know. Falls back to what Flask does for the unregistered types.
+
+    :param obj: The object.
+    :return: Something serializable in place of the object.
+    :raises TypeError: If the object cannot be encoded.
+    """
+    encode = ENCODERS.get(type(obj)) or _resolve(type(obj))
+    if encode is not None:
+        return encode(obj)
+
+    if is_dataclass(obj):
+        return asdict(obj)
+    if hasattr(obj, "__html__"):
+        return str(obj.__html__())
+
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class _StandardFloat(float):
+    """ A float written by the standard library as any other, but not by orjson, which makes it fall back """
+
+
+def number(value: int | float) -> int | float:
+    """
+    Passes a number on to the payload. orjson writes NaN, infinity and the floats Python writes in exponent
+    notation (e.g. 1e-05 or 1.5e+16) differently, these make the payload serialized by the standard library instead.
+    The encoders pass every float through here.
+
+    :param value: The number.
+    :return: The number.
+    """
+    if type(value) is float and not (value == 0 or 1e-4 <= abs(value) < 1e16):
+        return _StandardFloat(value)
+
+    return value
+
+
+def _escape_non_ascii(error: UnicodeEncodeError) -> tuple[str, int]:
+    # Called with every run of characters above ASCII, which only occur in strings
+    return encode_basestring_ascii(error.object[error.start:error.end])[1:-1], error.end
+
+
+codecs.register_error("harnas_json_escape", _escape_non_ascii)
+
+
+def _ensure_ascii(encoded: bytes) -> bytes:
+    # Writes the characters above U+00FF as \uXXXX and the rest as raw bytes, which are then escaped one by one
+    escaped = encoded.decode().encode("raw_unicode_escape")
+
+    if b"\\U" in escaped:
+        # Characters above U+FFFF, written as surrogate pairs by ensure_ascii (or a \U in a string)
+        escaped = encoded.decode().encode("ascii", "harnas_json_escape")
+        return escaped.replace(b"\x7f", b"\\u007f")
+
+    for byte in set(escaped.translate(None, ASCII)):
+        escaped = escaped.replace(bytes((byte,)), b"\\u%04x" % byte)
+
+    return escaped
+
+
+def dumps_json(obj: Any) -> bytes:
+    """
+    Serializes with the standard library, the way Flask's jsonify does: ASCII only, sorted keys, no whitespace.
+
+    :param obj: The object to serialize.
+    :return: The JSON.
+    :raises TypeError: If an object cannot be encoded.
+    """
+    return json_dumps(obj, default=default, ensure_ascii=True, sort_keys=True, separators=(",", ":")).encode()
+
+
+def dumps_orjson(obj: Any) -> bytes:
+    """
+    Serializes with orjson, byte for byte the same as `dumps_json` as long as the floats are put in the payload
+    by the encoders (see `number`). What orjson cannot do the same way (integers beyond 64 bits, keys other than
+    strings, lone surrogates and the floats rejected by `number`) is serialized by `dumps_json` instead.
+
+    :param obj: The object to serialize.
+    :return: The JSON.
+    :raises TypeError: If an object cannot be encoded.
+    """
+    try:
+        encoded = orjson.dumps(obj, default=default, option=ORJSON_OPTIONS)
+    except TypeError:
+        return dumps_json(obj)
+
+    # orjson escapes the control characters only, ensure_ascii escapes DEL and everything above it too
+    if encoded.isascii() and b"\x7f" not in encoded:
+        return encoded
+
+    return _ensure_ascii(encoded)
+
+
+_dumps: Callable[[Any], bytes] = dumps_orjson if orjson is not None and JSON_SERIALIZER == "orjson" else dumps_json
+
+
+class Fragment(bytes):
+    """ Something serialized already (e.g. a cached offer), written as it is """
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    Serializes with orjson if it is installed, otherwise with the standard library. A fragment, or a list of
+    fragments, is written without being serialized again.
+
+    :param obj: The object to serialize.
+    :return: The JSON.
+    :raises TypeError: If an object cannot be encoded.
+    """
+    if type(obj) is Fragment:
+        return obj
+    if type(obj) is list and len(obj) > 0 and type(obj[0]) is Fragment:
+        return b"[" + b",".join(obj) + b"]"
+
+    return _dumps(obj)
+
+
+def stream_array(batches: Iterable[list]) -> Iterator[bytes]:
+    """
+    Writes a JSON array a batch of items at a time. Together the chunks are the same as `dumps` of the whole list,
+    followed by a newline as in Flask's responses. Nothing is written before the first batch is there.
+
+    :param batches: The lists of items.
+    :return: A generator of the chunks.
+    """
+    separator = b"["
+    for batch in batches:
+        if len(batch) > 0:
+            yield separator + dumps(batch)[1:-1]
+            separator = b","
+
+    yield b"[]\n" if separator == b"[" else b"]\n"
+
+
+def stream_lines(batches: Iterable[list]) -> Iterator[bytes]:
+    """
+    Writes newline delimited JSON (NDJSON), an item per line, a batch of items at a time.
+
+    :param batches: The lists of items.
+    :return: A generator of the chunks.
+    """
+    for batch in batches:
+        if len(batch) > 0:
+            yield b"\n".join([dumps(item) for item in batch]) + b"\n"
+
+
+@encoder(Fragment)
+def encode_fragment(obj: Fragment) -> Any:
+    # Only nested fragments get here, they are parsed to be serialized again
+    return loads(obj)
+
+
+@encoder(date)
+def encode_date(obj: date) -> str:
+    return http_date(obj)
+
+
+@encoder(Decimal)
+@encoder(UUID)
+def encode_str(obj: Any) -> str:
+    return str(obj)
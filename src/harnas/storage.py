@@ -0,0 +1,251 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+from pathlib import Path
+from shutil import copyfileobj
+from tempfile import SpooledTemporaryFile
+from typing import BinaryIO, Dict, Iterator
+from uuid import uuid4
+
+import os
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+# "local" or "s3"
+IMAGE_STORAGE = environ.get("IMAGE_STORAGE", "local")
+# The number of directory levels the local files are spread over, 0 keeps them all in IMAGE_OUTPUT
+IMAGE_SHARD_DEPTH = int(environ.get("IMAGE_SHARD_DEPTH", "2"))
+# The number of files written at the same time by `save_many`
+IMAGE_WRITE_WORKERS = int(environ.get("IMAGE_WRITE_WORKERS", "4"))
+
+CHUNK_SIZE = 64 * 1024
+SPOOL_SIZE = 1024 * 1024
+
+
+class Storage(ABC):
+    """
+    Where the stored uploads and the renditions are kept. Files are addressed by their flat name, e.g.
+    "<hash>_original.jpg", the layout behind the name is up to the backend.
+    """
+
+    @abstractmethod
+    def open(self, name: str) -> BinaryIO:
+        """
+        Opens the file for reading.
+
+        :param name: The name of the file.
+        :return: A seekable binary file, to be closed by the caller.
+        :raises FileNotFoundError: If the file does not exist.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def save(self, name: str, file: BinaryIO) -> None:
+        """
+        Writes the file from the current position of the given file, in chunks. Readers never see a partially
+        written file.
+
+        :param name: The name of the file.
+        :param file: The content.
+        """
+        raise NotImplementedError
+
+    def save_many(self, files: Dict[str, BinaryIO]) -> None:
+        """
+        Writes many files in parallel.
+
+        :param files: A mapping from the name of the file to its content.
+        :raises Exception: The first error of the writes, after all of them finished.
+        """
+        if len(files) <= 1:
+            for name, file in files.items():
+                self.save(name, file)
+            return
+
+        with ThreadPoolExecutor(max_workers=IMAGE_WRITE_WORKERS) as executor:
+            futures = [executor.submit(self.save, name, file) for name, file in files.items()]
+        for future in futures:
+            future.result()
+
+    @abstractmethod
+    def exists(self, name: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, name: str) -> None:
+        """
+        Deletes the file. Does nothing if it does not exist.
+
+        :param name: The name of the file.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def url(self, name: str) -> str:
+        """
+        :param name: The name of the file.
+        :return: The public URL of the file.
+        """
+        raise NotImplementedError
+
+    def local_path(self, name: str) -> Path | None:
+        """
+        :param name: The name of the file.
+        :return: The path of the file if it is kept on the local disk, None otherwise.
+        """
+        return None
+
+
+def check_name(name: str) -> str:
+    if name == "" or "/" in name or "\\" in name or name.startswith("."):
+        raise ValueError(f"Invalid file name: {name!r}")
+    return name
+
+
+class LocalStorage(Storage):
+    """
+    Keeps the files on the local disk, spread over nested directories by the first characters of the name
+    (e.g. "ab/cd/abcdef..._original.jpg"), so that no directory grows to millions of entries. The names are random
+    UUIDs or content hashes, so the directories fill up evenly. Files of the flat layout are still found until
+    they are moved with `migrate_storage.py`.
+    """
+
+    def __init__(self, root: str | Path, base_url: str, shard_depth: int = IMAGE_SHARD_DEPTH):
+        self.root = Path(root)
+        self.base_url = base_url
+        self.shard_depth = shard_depth
+
+    def sharded_path(self, name: str) -> Path:
+        check_name(name)
+        shards = [name[2 * i:2 * i + 2] for i in range(self.shard_depth)]
+        return self.root.joinpath(*shards, name)
+
+    def flat_path(self, name: str) -> Path:
+        return self.root / check_name(name)
+
+    def local_path(self, name: str) -> Path:
+        path = self.sharded_path(name)
+        if self.shard_depth > 0 and not path.exists():
+            flat = self.flat_path(name)
+            if flat.exists():
+                return flat
+        return path
+
+    def open(self, name: str) -> BinaryIO:
+        return open(self.local_path(name), "rb")
+
+    def save(self, name: str, file: BinaryIO) -> None:
+        path = self.sharded_path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        temporary = path.with_name(f".{name}.{uuid4().hex}")
+        try:
+            with open(temporary, "wb") as f:
+                copyfileobj(file, f, CHUNK_SIZE)
+            os.replace(temporary, path)
+        finally:
+            temporary.unlink(missing_ok=True)
+
+        if self.shard_depth > 0:
+            self.flat_path(name).unlink(missing_ok=True)
+
+    def exists(self, name: str) -> bool:
+        return self.local_path(name).exists()
+
+    def delete(self, name: str) -> None:
+        self.sharded_path(name).unlink(missing_ok=True)
+        self.flat_path(name).unlink(missing_ok=True)
+
+    def url(self, name: str) -> str:
+        return self.base_url + "/image/" + name
+
+    def move_to_shard(self, name: str) -> None:
+        """
+        Moves a file of the flat layout to its sharded path, without copying it.
+
+        :param name: The name of the file.
+        """
+        path = self.sharded_path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(self.flat_path(name), path)
+
+    def flat_files(self) -> Iterator[str]:
+        """
+        :return: The names of the files still kept in the flat layout.
+        """
+        for path in self.root.iterdir():
+            if path.is_file() and not path.name.startswith("."):
+                yield path.name
+
+
+class S3Storage(Storage):
+    """
+    Keeps the files in a bucket of S3 or of an S3-compatible service (e.g. MinIO). The files are served straight
+    from the bucket, or from a CDN in front of it. Needs boto3, the credentials are read by boto3 as usual.
+    """
+
+    def __init__(self, bucket: str, endpoint_url: str | None = None, public_url: str | None = None,
+                 prefix: str = "", client=None):
+        if client is None:
+            if boto3 is None:
+                raise RuntimeError("The S3 image storage needs boto3, install it with `pip install boto3`.")
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.public_url = (public_url or f"{endpoint_url or 'https://s3.amazonaws.com'}/{bucket}").rstrip("/")
+
+    def key(self, name: str) -> str:
+        return self.prefix + check_name(name)
+
+    def open(self, name: str) -> BinaryIO:
+        file = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        try:
+            self.client.download_fileobj(self.bucket, self.key(name), file)
+        except Exception as e:
+            file.close()
+            if getattr(e, "response", {}).get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                raise FileNotFoundError(name) from e
+            raise
+
+        file.seek(0)
+        return file
+
+    def save(self, name: str, file: BinaryIO) -> None:
+        # Uploaded in parts, the object only appears once all of them are
+        self.client.upload_fileobj(file, self.bucket, self.key(name))
+
+    def exists(self, name: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+            return True
+        except Exception as e:
+            if getattr(e, "response", {}).get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                return False
+            raise
+
+    def delete(self, name: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+
+    def url(self, name: str) -> str:
+        return self.public_url + "/" + self.key(name)
+
+
+def new_storage() -> Storage:
+    """
+    Creates the storage configured by IMAGE_STORAGE.
+
+    :return: The storage.
+    """
+    if IMAGE_STORAGE == "s3":
+        return S3Storage(environ["S3_BUCKET"], environ.get("S3_ENDPOINT_URL"), environ.get("S3_PUBLIC_URL"),
+                         environ.get("S3_PREFIX", ""))
+
+    return LocalStorage(environ["IMAGE_OUTPUT"], environ.get("ROOT_URL", ""))
+
+
+storage = new_storage()
@@ -7,7 +7,28 @@ from firebase import FirebaseUser
 from exc import UserNotFoundError, CurrencyNotFoundError, PostgresError, UserAlreadyExistsError
 
 # Functions import
+from cache import LRUCache
 from db import fetch, execute
+from fragments import offer_fragments
+from os import environ
+
+USER_CACHE_SIZE = int(environ.get("USER_CACHE_SIZE", "10000"))
+# Users are cached per worker, so changes made through another worker are visible after at most this many seconds
+USER_CACHE_TTL = float(environ.get("USER_CACHE_TTL", "60"))
+
+user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+def drop_if_stale(user_id: str, version: int) -> None:
+    """
+    Drops the cached copy of a user if it is older than the given version, e.g. changed through another worker.
+
+    :param user_id: The id of the user
+    :param version: The current version of the user
+    """
+    cached = user_cache.get(user_id)
+    if cached is not None and cached.version < version:
+        user_cache.invalidate(user_id)
 
 
 @dataclass(init=True, eq=True, order=True, unsafe_hash=False, frozen=False)
@@ -19,6 +40,9 @@ class User:
     accepted_currencies: list[Currency]
     favorites: list["Offer"]
 
+    # The row version, bumped by the database on every change of the user or of their accepted currencies
+    version: int = 0
+
     @classmethod
     def get_user_by_id(cls, user_id: str) -> "User":
         """
@@ -29,27 +53,94 @@ class User:
         :raises UserNotFoundError: If the user does not exist
         :raises PostgresError: If the database error occurs
         """
-        result = fetch("SELECT id, email, name FROM users WHERE id = %s", (user_id,))
-        if result is None or len(result) == 0 or result[0] is None:
-            raise UserNotFoundError(user_id)
+        return cls.get_users_by_ids([user_id])[user_id]
 
-        raw_user = result[0]
-        user = cls(raw_user[0], raw_user[1], raw_user[2], [], [])
+    @classmethod
+    def get_users_by_ids(cls, user_ids: list[str]) -> dict[str, "User"]:
+        """
+        Get many users by their ids, together with their accepted currencies. Users found in the user cache are
+        not queried, all the other ones are loaded with a single query.
 
-        result = fetch("SELECT name, symbol, exchange_rate FROM currencies WHERE symbol IN "
-                       "(SELECT currency_symbol FROM accepted_currencies WHERE user_id = %s)",
-                       (user_id,))
+        :param user_ids: The ids of the users
+        :return: A mapping from the user id to the user
+        :raises UserNotFoundError: If any of the users does not exist
+        :raises PostgresError: If the database error occurs
+        """
+        users = {}
+        missing = []
 
-        if len(result) == 0:
-            # TODO: Probably an error if the user has no accepted currencies.
-            #  Only possible when creating a user – should refactor
-            print("No accepted currencies for user " + user_id)
+        for user_id in set(user_ids):
+            cached = user_cache.get(user_id)
+            if cached is None:
+                missing.append(user_id)
+            else:
+                users[user_id] = cached.copy()
 
-        for raw_currency in result:
-            currency = Currency(raw_currency[0], raw_currency[1], raw_currency[2])
-            user.accepted_currencies.append(currency)
+        if len(missing) == 0:
+            return users
 
-        return user
+        result = fetch("SELECT u.id, u.email, u.name, "
+                       "ARRAY_REMOVE(ARRAY_AGG(a.currency_symbol), NULL), u.version FROM users u "
+                       "LEFT JOIN accepted_currencies a ON a.user_id = u.id "
+                       "WHERE u.id = ANY(%s) GROUP BY u.id", (missing,))
+
+        for raw_user in result:
+            user = cls(raw_user[0], raw_user[1], raw_user[2], [], [], raw_user[4])
+
+            if len(raw_user[3]) == 0:
+                # TODO: Probably an error if the user has no accepted currencies.
+                #  Only possible when creating a user – should refactor
+                print("No accepted currencies for user " + user.uid)
+
+            for symbol in raw_user[3]:
+                try:
+                    user.accepted_currencies.append(Currency.get_currency_by_symbol(symbol))
+                except CurrencyNotFoundError:
+                    print("Unknown accepted currency " + symbol + " for user " + user.uid)
+
+            user_cache.put(user.uid, user)
+            users[user.uid] = user.copy()
+
+        for user_id in missing:
+            if user_id not in users:
+                raise UserNotFoundError(user_id)
+
+        return users
+
+    @classmethod
+    def reference(cls, user_id: str) -> "User":
+        """
+        A user known only by their id, without loading them, e.g. the seller of an offer serialized without it
+
+        :param user_id: The id of the user
+        :return: The user with the id only
+        """
+        return cls(user_id, None, None, [], [])
+
+    def copy(self) -> "User":
+        """
+        Copies the user, so that the copy can be modified without affecting the cached user
+
+        :return: The copy of the user
+        """
+        return User(self.uid, self.email, self.name, list(self.accepted_currencies), list(self.favorites), self.version)
+
+    @classmethod
+    def get_version(cls, user_id: str) -> int | None:
+        """
+        Gets the row version of a user, without loading the user. A cached copy of an older version is dropped,
+        so that the user loaded next is at least as new as the returned version.
+
+        :param user_id: The id of the user
+        :return: The version, None if the user does not exist
+        :raises PostgresError: If the database error occurs
+        """
+        result = fetch("SELECT version FROM users WHERE id = %s", (user_id,))
+        if len(result) == 0:
+            return None
+
+        drop_if_stale(user_id, result[0][0])
+        return result[0][0]
 
     # TODO: Should also check whether the currency is already accepted.
     def add_accepted_currency(self, currency: Currency) -> None:
@@ -59,12 +150,12 @@ class User:
         :param currency: Currency to add
         :return: None
         """
-        result = fetch("SELECT count(*) FROM currencies WHERE symbol = %s", (currency.symbol,))
-        if result is None or len(result) == 0 or result[0][0] == 0:
-            raise CurrencyNotFoundError(currency.symbol)
+        Currency.get_currency_by_symbol(currency.symbol)
 
         execute("INSERT INTO accepted_currencies (user_id, currency_symbol) VALUES (%s, %s)",
                 (self.uid, currency.symbol))
+        user_cache.invalidate(self.uid)
+        offer_fragments.invalidate_seller(self.uid)
 
         self.accepted_currencies.append(currency)
 
@@ -82,6 +173,8 @@ class User:
 
         # Remove all the old accepted currencies
         execute("DELETE FROM accepted_currencies WHERE user_id = %s", (self.uid,))
+        user_cache.invalidate(self.uid)
+        offer_fragments.invalidate_seller(self.uid)
         self.accepted_currencies = []
 
         # Add the new accepted currencies
@@ -124,6 +217,7 @@ class User:
 
         execute("INSERT INTO users (id, email, name) VALUES (%s, %s, %s)",
                 (firebase_user.uid, firebase_user.email, firebase_user.name))
+        user_cache.invalidate(firebase_user.uid)
 
         try:
             user = User.get_user_by_id(firebase_user.uid)
@@ -0,0 +1,49 @@
+import time
+import unittest
+
+from cache import LRUCache
+
+
+class cache_test(unittest.TestCase):
+    def test_get_put(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_ttl(self):
+        cache = LRUCache(2, ttl=0.01)
+        cache.put('a', 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.invalidate('a')
+        cache.invalidate('b')
+        self.assertIsNone(cache.get('a'))
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+from os import environ
+
+environ["POSTGRES_HOST"] = "localhost"
+environ["POSTGRES_USER"] = "postgres"
+environ["POSTGRES_PASSWORD"] = "postgres"
+environ["POSTGRES_DB_MAIN"] = "test_database"
+environ["SERVICE_ACCOUNT_PATH"] = "test/path"
+environ["IMAGE_OUTPUT"] = "test/output"
+
+import gzip
+import unittest
+from flask import Flask, make_response
+
+import compression
+from json_encoder import APIJSONProvider, stream_response
+
+
+def make_app() -> Flask:
+    app = Flask(__name__)
+    app.json = APIJSONProvider(app)
+    app.after_request(compression.compress_response)
+
+    @app.route('/big')
+    def big():
+        resp = make_response({'items': list(range(1000))})
+        resp.set_etag('v1', weak=True)
+        return resp
+
+    @app.route('/small')
+    def small():
+        return {'items': [1, 2, 3]}
+
+    @app.route('/stream')
+    def stream():
+        return stream_response([list(range(i, i + 100)) for i in range(0, 1000, 100)])
+
+    @app.route('/text')
+    def text():
+        return 'a' * 10000
+
+    return app
+
+
+class compression_test(unittest.TestCase):
+
+    def setUp(self):
+        self.client = make_app().test_client()
+        compression.compression_cache.clear()
+
+    def test_gzip(self):
+        response = self.client.get('/big', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(gzip.decompress(response.data), self.client.get('/big').data)
+        self.assertEqual(response.headers['Content-Length'], str(len(response.data)))
+
+    def test_negotiation(self):
+        cases = {'gzip, deflate, br, zstd': compression.AVAILABLE[0], 'br;q=0.5, gzip': 'gzip',
+                 'gzip;q=0': None, 'identity': None, '': None}
+        for accept, encoding in cases.items():
+            response = self.client.get('/big', headers={'Accept-Encoding': accept})
+            self.assertEqual(response.headers.get('Content-Encoding'), encoding, accept)
+
+    def test_small_and_other_responses(self):
+        self.assertNotIn('Content-Encoding', self.client.get('/small', headers={'Accept-Encoding': 'gzip'}).headers)
+        self.assertNotIn('Content-Encoding', self.client.get('/text', headers={'Accept-Encoding': 'gzip'}).headers)
+
+    def test_stream(self):
+        response = self.client.get('/stream', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.data), self.client.get('/stream').data)
+
+    def test_cached_by_etag(self):
+        first = self.client.get('/big', headers={'Accept-Encoding': 'gzip'})
+        second = self.client.get('/big', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(compression.compression_cache.stats()['hits'], 1)
+
+    def test_all_encodings(self):
+        data = b'{"items":[' + b','.join(b'%d' % i for i in range(1000)) + b']}'
+        for encoding in compression.AVAILABLE:
+            compressed = compression.compress(data, encoding, 5)
+            streamed = b''.join(compression.compress_stream(iter([data[:100], data[100:]]), encoding, 5))
+            for body in (compressed, streamed):
+                if encoding == 'gzip':
+                    self.assertEqual(gzip.decompress(body), data)
+                elif encoding == 'br':
+                    self.assertEqual(compression.brotli.decompress(body), data)
+                else:
+                    self.assertEqual(compression.zstandard.ZstdDecompressor().decompressobj().decompress(body), data)
@@ -0,0 +1,31 @@
+import unittest
+from flask import Flask, make_response
+
+from cors import enable_cors
+
+
+def make_app() -> Flask:
+    app = Flask(__name__)
+    enable_cors(app)
+
+    @app.route('/page')
+    def page():
+        resp = make_response([])
+        resp.headers['X-Next-Cursor'] = 'cursor'
+        resp.headers['X-Currencies-Version'] = 'version'
+        return resp
+
+    return app
+
+
+class cors_test(unittest.TestCase):
+
+    def setUp(self):
+        self.client = make_app().test_client()
+
+    def test_expose_headers(self):
+        response = self.client.get('/page', headers={'Origin': 'https://example.com'})
+        self.assertEqual(response.headers['Access-Control-Allow-Origin'], 'https://example.com')
+        exposed = [header.strip() for header in response.headers['Access-Control-Expose-Headers'].split(',')]
+        self.assertIn('X-Next-Cursor', exposed)
+        self.assertIn('X-Currencies-Version', exposed)
@@ -6,7 +6,7 @@ environ["POSTGRES_PASSWORD"] = "postgres"
 environ["POSTGRES_DB_MAIN"] = "test_database"
 
 import unittest
-from currencies import Currency
+from currencies import Currency, CurrencyRegistry, registry
 import db
 import exc
 
@@ -24,6 +24,7 @@ class currencies_test(unittest.TestCase):
         db.connect()
         db.execute("DELETE FROM piwegro.currencies", ())
         db.execute("INSERT INTO piwegro.currencies (symbol, name, exchange_rate) VALUES (%s, %s, %s)", ('PER', 'Perla', 1.0))
+        registry.refresh()
         result = Currency.get_currencies()
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0].name, 'Perla')
@@ -32,13 +33,58 @@ class currencies_test(unittest.TestCase):
     def test_get_all_if_empty(self):
         db.connect()
         db.execute("DELETE FROM piwegro.currencies", ())
+        registry.refresh()
         self.assertEqual(len(Currency.get_currencies()), 0)
 
     def test_get_by_symbol(self):
         db.connect()
         db.execute("DELETE FROM piwegro.currencies", ())
         db.execute("INSERT INTO piwegro.currencies (symbol, name, exchange_rate) VALUES (%s, %s, %s)", ('PER', 'Perla', 1.0))
+        registry.refresh()
         result = Currency.get_currency_by_symbol('PER')
         self.assertEqual(result.name, 'Perla')
         self.assertTrue(isinstance(result, Currency))
         db.disconnect()
+
+
+class registry_test(unittest.TestCase):
+
+    def setUp(self):
+        self.currencies = [Currency('Harnas', 'HAR', 1.0), Currency('Perla', 'PER', 2.0)]
+        self.loads = 0
+
+        def loader():
+            self.loads += 1
+            return list(self.currencies)
+
+        self.registry = CurrencyRegistry(loader, channel="")
+
+    def test_loads_once(self):
+        self.assertEqual(self.registry.get('PER').name, 'Perla')
+        self.assertEqual(len(self.registry.all()), 2)
+        self.assertEqual(self.loads, 1)
+
+    def test_not_found(self):
+        with self.assertRaises(exc.CurrencyNotFoundError):
+            self.registry.get('USD')
+
+    def test_version_changes_with_content(self):
+        version = self.registry.snapshot.version
+        self.registry.refresh()
+        self.assertEqual(self.registry.snapshot.version, version)
+
+        self.currencies[1] = Currency('Perla', 'PER', 2.5)
+        self.registry.refresh()
+        self.assertNotEqual(self.registry.snapshot.version, version)
+
+    def test_listeners_notified_on_change(self):
+        notified = []
+        self.registry.subscribe(notified.append)
+        self.registry.refresh()
+        self.registry.refresh()
+        self.assertEqual(len(notified), 0)
+
+        self.currencies.append(Currency('Tyskie', 'TYS', 1.9))
+        self.registry.refresh()
+        self.assertEqual(len(notified), 1)
+        self.assertEqual(notified[0].currencies['TYS'].value, 1.9)
@@ -5,19 +5,37 @@ environ["POSTGRES_USER"] = "postgres"
 environ["POSTGRES_PASSWORD"] = "postgres"
 environ["POSTGRES_DB_MAIN"] = "test_database"
 
+import threading
+import time
 import unittest
 import db
+from exc import PoolTimeoutError
+
+
+class FakeConnection:
+    """ Stands in for a psycopg2 connection in the pool tests """
+    def __init__(self):
+        self.closed = 0
+
+    def get_transaction_status(self):
+        return 0
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
 
 
 class db_test(unittest.TestCase):
     def test_connect(self):
         db.connect()
-        self.assertIsNotNone(db.connection)
+        self.assertIsNotNone(db.pool)
 
     def test_disconnect(self):
         db.connect()
         db.disconnect()
-        self.assertIsNone(db.connection)
+        self.assertIsNone(db.pool)
 
     def test_execute(self):
         db.connect()
@@ -36,6 +54,114 @@ class db_test(unittest.TestCase):
         result = db.fetch("SELECT * FROM piwegro.currencies", ())
         self.assertEqual(len(result), 1)
 
+    def test_stream(self):
+        db.connect()
+        batches = list(db.stream("SELECT generate_series(1, %s)", (5,), batch_size=2))
+        self.assertEqual(batches, [[(1,), (2,)], [(3,), (4,)], [(5,)]])
+        self.assertEqual(db.pool_stats().in_use, 0)
+
+    def test_stream_closed_early(self):
+        db.connect()
+        batches = db.stream("SELECT generate_series(1, %s)", (5,), batch_size=2)
+        self.assertEqual(next(batches), [(1,), (2,)])
+        self.assertEqual(db.pool_stats().in_use, 1)
+        batches.close()
+        self.assertEqual(db.pool_stats().in_use, 0)
+
+    def test_stream_buffered_over_the_limit(self):
+        db.connect()
+        db.pool.max_streams = 1
+
+        held = db.stream("SELECT generate_series(1, %s)", (5,), batch_size=2)
+        self.assertEqual(next(held), [(1,), (2,)])
+
+        # The second stream does not hold a connection while it is read
+        buffered = db.stream("SELECT generate_series(1, %s)", (5,), batch_size=2)
+        self.assertEqual(next(buffered), [(1,), (2,)])
+        self.assertEqual(db.pool_stats().in_use, 1)
+        self.assertEqual(list(buffered), [[(3,), (4,)], [(5,)]])
+
+        stats = db.pool_stats()
+        self.assertEqual(stats.streams, 1)
+        self.assertEqual(stats.buffered_streams, 1)
+
+        held.close()
+        self.assertEqual(db.pool_stats().streams, 0)
+        db.disconnect()
+
+
+class pool_test(unittest.TestCase):
+    def test_min_size(self):
+        pool = db.ConnectionPool(2, 4, connect=FakeConnection)
+        stats = pool.stats()
+        self.assertEqual(stats.size, 2)
+        self.assertEqual(stats.idle, 2)
+        self.assertEqual(stats.in_use, 0)
+
+    def test_max_streams(self):
+        pool = db.ConnectionPool(0, 2, connect=FakeConnection, max_streams=5)
+        self.assertEqual(pool.max_streams, 1)
+
+        self.assertTrue(pool.begin_stream())
+        self.assertFalse(pool.begin_stream())
+        pool.end_stream()
+        self.assertTrue(pool.begin_stream())
+
+        with self.assertRaises(ValueError):
+            db.ConnectionPool(0, 2, connect=FakeConnection, max_streams=-1)
+
+    def test_checkout_and_return(self):
+        pool = db.ConnectionPool(0, 2, connect=FakeConnection)
+        with pool.connection() as conn:
+            self.assertEqual(pool.stats().in_use, 1)
+        self.assertEqual(pool.stats().idle, 1)
+
+        with pool.connection() as conn2:
+            self.assertIs(conn, conn2)
+
+    def test_timeout(self):
+        pool = db.ConnectionPool(0, 1, timeout=0.05, connect=FakeConnection)
+        conn = pool.getconn()
+        with self.assertRaises(PoolTimeoutError):
+            pool.getconn()
+        stats = pool.stats()
+        self.assertEqual(stats.waits, 1)
+        self.assertEqual(stats.timeouts, 1)
+        pool.putconn(conn)
+
+    def test_waiter_gets_returned_connection(self):
+        pool = db.ConnectionPool(0, 1, timeout=2.0, connect=FakeConnection)
+        conn = pool.getconn()
+        got = []
+
+        t = threading.Thread(target=lambda: got.append(pool.getconn()))
+        t.start()
+        time.sleep(0.05)
+        pool.putconn(conn)
+        t.join()
+
+        self.assertIs(got[0], conn)
+        self.assertEqual(pool.stats().waits, 1)
+        self.assertGreater(pool.stats().wait_time, 0)
+
+    def test_closed_connection_is_replaced(self):
+        pool = db.ConnectionPool(1, 1, connect=FakeConnection)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        conn.closed = 1
+
+        new_conn = pool.getconn()
+        self.assertIsNot(conn, new_conn)
+        self.assertEqual(pool.stats().discarded, 1)
+        self.assertEqual(pool.stats().size, 1)
+
+    def test_broken_connection_is_discarded(self):
+        pool = db.ConnectionPool(0, 1, connect=FakeConnection)
+        conn = pool.getconn()
+        pool.putconn(conn, broken=True)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.stats().size, 0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,106 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+
+from disk_cache import DiskCache
+
+
+class disk_cache_test(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_creates_once(self):
+        cache = DiskCache(self.directory.name, 1024)
+        calls = []
+
+        def create(path: Path):
+            calls.append(path)
+            path.write_bytes(b"abc")
+
+        first = cache.get_or_create("a", create)
+        second = cache.get_or_create("a", create)
+
+        self.assertEqual(first, second)
+        self.assertEqual(first.read_bytes(), b"abc")
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    def test_coalesces_concurrent_requests(self):
+        cache = DiskCache(self.directory.name, 1024)
+        calls = []
+
+        def create(path: Path):
+            calls.append(path)
+            time.sleep(0.1)
+            path.write_bytes(b"abc")
+
+        threads = [threading.Thread(target=cache.get_or_create, args=("a", create)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.stats()["coalesced"], 4)
+
+    def test_evicts_least_recently_used(self):
+        cache = DiskCache(self.directory.name, 10)
+        write = lambda path: path.write_bytes(b"12345")
+
+        a = cache.get_or_create("a", write)
+        b = cache.get_or_create("b", write)
+        cache.get_or_create("a", write)
+        c = cache.get_or_create("c", write)
+
+        self.assertTrue(a.exists())
+        self.assertFalse(b.exists())
+        self.assertTrue(c.exists())
+        self.assertEqual(cache.stats()["bytes"], 10)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_failed_create_leaves_no_file(self):
+        cache = DiskCache(self.directory.name, 1024)
+
+        def create(path: Path):
+            path.write_bytes(b"partial")
+            raise ValueError("render failed")
+
+        with self.assertRaises(ValueError):
+            cache.get_or_create("a", create)
+
+        self.assertEqual(list(Path(self.directory.name).iterdir()), [])
+        self.assertEqual(len(cache), 0)
+
+    def test_adopts_existing_files(self):
+        Path(self.directory.name, "a").write_bytes(b"abc")
+        interrupted = Path(self.directory.name, ".b.partial")
+        interrupted.write_bytes(b"abc")
+        os.utime(interrupted, (time.time() - 120, time.time() - 120))
+        # Still being written by another process
+        Path(self.directory.name, ".c.partial").write_bytes(b"abc")
+
+        cache = DiskCache(self.directory.name, 1024, temporary_grace=60)
+
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get_or_create("a", lambda path: self.fail("should not be created")),
+                         Path(self.directory.name, "a"))
+        self.assertFalse(interrupted.exists())
+        self.assertTrue(Path(self.directory.name, ".c.partial").exists())
+
+    def test_recreates_files_evicted_by_another_process(self):
+        cache = DiskCache(self.directory.name, 1024)
+        other = DiskCache(self.directory.name, 1024)
+        write = lambda path: path.write_bytes(b"abc")
+
+        path = cache.get_or_create("a", write)
+        self.assertEqual(other.get_or_create("a", lambda path: self.fail("should not be created")), path)
+        path.unlink()
+
+        self.assertEqual(cache.get_or_create("a", write).read_bytes(), b"abc")
+        self.assertEqual(cache.stats()["vanished"], 1)
+        self.assertEqual(cache.stats()["misses"], 2)
+        self.assertEqual(cache.stats()["bytes"], 3)
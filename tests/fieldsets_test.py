@@ -0,0 +1,36 @@
+import unittest
+
+from exc import InvalidFieldsetError
+from fieldsets import DEFAULT_FIELDSET, parse_fieldset
+
+
+class fieldsets_test(unittest.TestCase):
+
+    def test_default(self):
+        self.assertIs(parse_fieldset(None, None), DEFAULT_FIELDSET)
+        self.assertIs(parse_fieldset(",".join(DEFAULT_FIELDSET.fields), "images,seller"), DEFAULT_FIELDSET)
+
+    def test_fields(self):
+        fieldset = parse_fieldset("offer_id, title,price,,seller", None)
+        self.assertEqual(fieldset.fields, {"offer_id", "title", "price", "seller"})
+        self.assertTrue(fieldset.expands("seller"))
+        self.assertFalse(fieldset.expands("images"))
+        self.assertTrue(fieldset.needs_sellers)
+
+    def test_expand(self):
+        fieldset = parse_fieldset(None, "")
+        self.assertTrue(fieldset.includes("images"))
+        self.assertFalse(fieldset.expands("images"))
+        self.assertFalse(fieldset.expands("seller"))
+
+        self.assertFalse(parse_fieldset("title,seller", "images").needs_sellers)
+
+    def test_unknown(self):
+        with self.assertRaises(InvalidFieldsetError):
+            parse_fieldset("title,password", None)
+        with self.assertRaises(InvalidFieldsetError):
+            parse_fieldset(None, "price")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+
+from fragments import FragmentCache, ENTRY_OVERHEAD
+
+
+class fragments_test(unittest.TestCase):
+    def test_get_put(self):
+        cache = FragmentCache(4096)
+        cache.put(1, (1, 1, 'a'), 'seller', 'default', b'{"offer_id":1}')
+
+        self.assertEqual(cache.get(1, (1, 1, 'a'), 'default'), b'{"offer_id":1}')
+        self.assertIsNone(cache.get(1, (1, 1, 'a'), 'title'))
+        self.assertIsNone(cache.get(2, (1, 1, 'a'), 'default'))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 2)
+        self.assertEqual(cache.stats()['bytes'], ENTRY_OVERHEAD + 14)
+
+    def test_versions(self):
+        cache = FragmentCache(4096)
+        cache.put(1, (1, 1, 'a'), 'seller', 'default', b'{"offer_id":1}')
+        cache.put(1, (1, 1, 'a'), 'seller', 'title', b'{}')
+
+        # An offer of other versions is not returned, and replaces all fragments of the old ones
+        self.assertIsNone(cache.get(1, (1, 2, 'a'), 'default'))
+        cache.put(1, (1, 2, 'a'), 'seller', 'default', b'{"offer_id":2}')
+        self.assertIsNone(cache.get(1, (1, 2, 'a'), 'title'))
+        self.assertEqual(cache.get(1, (1, 2, 'a'), 'default'), b'{"offer_id":2}')
+        self.assertEqual(cache.stats()['bytes'], ENTRY_OVERHEAD + 14)
+
+    def test_evicts_least_recently_used(self):
+        fragment = b'x' * 100
+        cache = FragmentCache(2 * (ENTRY_OVERHEAD + 100))
+        cache.put(1, (), 'seller', 'default', fragment)
+        cache.put(2, (), 'seller', 'default', fragment)
+        cache.get(1, (), 'default')
+        cache.put(3, (), 'seller', 'default', fragment)
+
+        self.assertIsNotNone(cache.get(1, (), 'default'))
+        self.assertIsNone(cache.get(2, (), 'default'))
+        self.assertIsNotNone(cache.get(3, (), 'default'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['bytes'], 2 * (ENTRY_OVERHEAD + 100))
+
+        # Bigger than the whole cache, not cached at all
+        cache.put(4, (), 'seller', 'default', b'x' * cache.max_bytes)
+        self.assertEqual(len(cache), 2)
+
+    def test_invalidate(self):
+        cache = FragmentCache(4096)
+        cache.put(1, (), 'anna', 'default', b'{}')
+        cache.put(2, (), 'anna', 'default', b'{}')
+        cache.put(3, (), 'ola', 'default', b'{}')
+
+        cache.invalidate_offer(3)
+        cache.invalidate_offer(4)
+        self.assertIsNone(cache.get(3, (), 'default'))
+
+        cache.invalidate_seller('anna')
+        cache.invalidate_seller('ewa')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()['bytes'], 0)
+        self.assertEqual(cache.stats()['invalidations'], 3)
+
+        cache.put(1, (), 'anna', 'default', b'{}')
+        cache.clear()
+        self.assertIsNone(cache.get(1, (), 'default'))
+
+
+if __name__ == '__main__':
+    unittest.main()
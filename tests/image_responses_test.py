@@ -0,0 +1,74 @@
+from os import environ
+
+environ["POSTGRES_HOST"] = "localhost"
+environ["POSTGRES_USER"] = "postgres"
+environ["POSTGRES_PASSWORD"] = "postgres"
+environ["POSTGRES_DB_MAIN"] = "test_database"
+environ["SERVICE_ACCOUNT_PATH"] = "test/path"
+environ["IMAGE_OUTPUT"] = "test/output"
+
+import tempfile
+import unittest
+from io import BytesIO
+from unittest import mock
+from flask import Flask
+
+import image_responses
+from storage import LocalStorage
+
+
+def make_app() -> Flask:
+    app = Flask(__name__)
+    app.route("/image/<path:path>", methods=["GET"])(image_responses.send_image)
+    return app
+
+
+class image_responses_test(unittest.TestCase):
+
+    def setUp(self):
+        output = tempfile.TemporaryDirectory()
+        self.addCleanup(output.cleanup)
+
+        self.storage = LocalStorage(output.name, "")
+        patch = mock.patch.object(image_responses, "storage", self.storage)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        self.content = bytes(range(256)) * 16
+        self.storage.save("abc_original.jpg", BytesIO(self.content))
+        self.storage.save("abc_source", BytesIO(self.content))
+
+        self.client = make_app().test_client()
+
+    def test_send(self):
+        response = self.client.get("/image/abc_original.jpg")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, self.content)
+        self.assertEqual(response.headers["Accept-Ranges"], "bytes")
+
+        cache_control = response.cache_control
+        self.assertTrue(cache_control.public)
+        self.assertTrue(cache_control.immutable)
+        self.assertEqual(cache_control.max_age, image_responses.IMAGE_MAX_AGE)
+
+    def test_not_modified(self):
+        etag = self.client.get("/image/abc_original.jpg").get_etag()[0]
+
+        response = self.client.get("/image/abc_original.jpg", headers={"If-None-Match": f'"{etag}"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+        self.assertEqual(response.get_etag()[0], etag)
+        self.assertTrue(response.cache_control.immutable)
+        self.assertEqual(response.cache_control.max_age, image_responses.IMAGE_MAX_AGE)
+
+    def test_range(self):
+        response = self.client.get("/image/abc_original.jpg", headers={"Range": "bytes=100-199"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, self.content[100:200])
+        self.assertEqual(response.headers["Content-Range"], f"bytes 100-199/{len(self.content)}")
+
+    def test_not_found(self):
+        # The stored uploads are never served, even though the file exists
+        self.assertEqual(self.client.get("/image/abc_source").status_code, 404)
+        self.assertEqual(self.client.get("/image/missing_original.jpg").status_code, 404)
+        self.assertEqual(self.client.get("/image/../abc_original.jpg").status_code, 404)
@@ -7,7 +7,19 @@ environ["POSTGRES_DB_MAIN"] = "test_database"
 environ["SERVICE_ACCOUNT_PATH"] = "temp/path"
 environ["IMAGE_OUTPUT"] = "temp/path"
 
-from images import Image
+import pytest
+import tempfile
+from base64 import b64decode, b64encode
+from io import BytesIO
+from pathlib import Path
+from unittest import mock
+
+from PIL import Image as PILImage, ImageChops, ImageCms, ImageStat
+
+import images
+from exc import ImageEncodingError, ImageTooLargeError
+from images import Image, decode_for_renditions, generate_renditions, render_rendition, SIZES
+from storage import LocalStorage
 
 def test_from_base64():
     # Get base64 image from file
@@ -16,7 +28,202 @@ def test_from_base64():
         img = Image.new_image_base64(base64)
 
     assert img is not None
+    assert img.upload is not None
+
+
+def test_from_stream():
+    body = BytesIO()
+    PILImage.new("RGB", (64, 48)).save(body, "PNG")
+    body.seek(0)
+
+    img = Image.new_image_stream(body)
+
+    assert img.raw_image.size == (64, 48)
+    img.upload.seek(0)
+    assert img.upload.read() == body.getvalue()
+
+
+def test_from_stream_not_an_image():
+    with pytest.raises(ImageEncodingError):
+        Image.new_image_stream(BytesIO(b"not an image"))
+
+
+def test_from_stream_base64_fallback():
+    body = BytesIO()
+    PILImage.new("RGB", (64, 48)).save(body, "PNG")
+
+    img = Image.new_image_stream(BytesIO(b64encode(body.getvalue())), base64_fallback=True)
+    assert img.raw_image.size == (64, 48)
+
+    with pytest.raises(ImageEncodingError):
+        Image.new_image_stream(BytesIO(b64encode(body.getvalue())))
+    with pytest.raises(ImageEncodingError):
+        Image.new_image_stream(BytesIO(b"not an image"), base64_fallback=True)
+
+    # A base64 string may be a third longer than the image it encodes, a raw image may not
+    encoded = b64encode(body.getvalue())
+    with mock.patch.object(images, "IMAGE_MAX_BYTES", len(encoded) * 3 // 4):
+        assert len(encoded) > images.IMAGE_MAX_BYTES
+        assert Image.new_image_stream(BytesIO(encoded), base64_fallback=True).raw_image.size == (64, 48)
+    with mock.patch.object(images, "IMAGE_MAX_BYTES", len(body.getvalue()) - 1):
+        with pytest.raises(ImageTooLargeError):
+            Image.new_image_stream(BytesIO(body.getvalue()), base64_fallback=True)
+
+def test_too_many_pixels():
+    body = BytesIO()
+    PILImage.new("RGB", (64, 48)).save(body, "PNG")
+    heif = BytesIO()
+    PILImage.new("RGB", (64, 48)).save(heif, "HEIF")
+
+    with mock.patch.object(images, "IMAGE_MAX_PIXELS", 64 * 48 - 1):
+        for upload in (body, heif):
+            with pytest.raises(ImageTooLargeError):
+                Image.new_image_stream(BytesIO(upload.getvalue()))
+
+
+def test_too_many_bytes():
+    body = BytesIO()
+    PILImage.new("RGB", (64, 48)).save(body, "PNG")
+    size = len(body.getvalue())
+
+    with mock.patch.object(images, "IMAGE_MAX_BYTES", size - 1):
+        with pytest.raises(ImageTooLargeError):
+            Image.new_image_stream(BytesIO(body.getvalue()))
+        with pytest.raises(ImageTooLargeError):
+            Image.new_image_base64(b64encode(body.getvalue()))
+
+    with mock.patch.object(images, "IMAGE_MAX_BYTES", size):
+        assert Image.new_image_stream(BytesIO(body.getvalue())).raw_image.size == (64, 48)
+
+
+def test_stream_hash_matches_upload_hash():
+    body = BytesIO()
+    PILImage.new("RGB", (64, 48)).save(body, "PNG")
+
+    streamed = Image.new_image_stream(BytesIO(body.getvalue()))
+    uploaded = Image.new_image_base64(b64encode(body.getvalue()))
+
+    assert streamed.content_hash is not None
+    assert streamed.content_hash == uploaded.hash_upload()
+
+
+def test_store_upload_deduplicates():
+    body = BytesIO()
+    PILImage.new("RGB", (64, 48)).save(body, "PNG")
+
+    with tempfile.TemporaryDirectory() as output, mock.patch.object(images, "storage", LocalStorage(output, "")):
+        first = Image.new_image_stream(BytesIO(body.getvalue()))
+        second = Image.new_image_stream(BytesIO(body.getvalue()))
+        first.store_upload()
+        second.store_upload()
+
+        assert first.source == second.source == first.content_hash + "_source"
+        assert first.original == second.original
+        assert [p.name for p in Path(output).rglob("*") if p.is_file()] == [first.source]
+
+
+def test_generate_renditions():
+    with tempfile.TemporaryDirectory() as output, mock.patch.object(images, "storage", LocalStorage(output, "")):
+        PILImage.new("RGBA", (640, 480), (255, 0, 0, 128)).save(Path(output, "test_source"), "PNG")
+
+        names = ["test_original.jpg", "test_preview.jpg", "test_thumbnail.jpg"]
+        placeholder = generate_renditions("test_source", names)
+
+        assert placeholder.startswith("data:image/jpeg;base64,")
+        with PILImage.open(BytesIO(b64decode(placeholder.split(",")[1]))) as thumbnail:
+            assert thumbnail.size == images.PLACEHOLDER_SIZE
+
+        for name, size in zip(names, SIZES):
+            with PILImage.open(images.storage.local_path(name)) as rendition:
+                assert rendition.size == size
+                assert rendition.format == "JPEG"
+
+
+def test_generate_renditions_profiles():
+    profile = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+
+    with tempfile.TemporaryDirectory() as output, mock.patch.object(images, "storage", LocalStorage(output, "")):
+        PILImage.new("RGB", (2400, 1600), (0, 0, 255)).save(Path(output, "test_source"), "JPEG", icc_profile=profile)
+
+        names = ["test_original.jpg", "test_preview.jpg", "test_thumbnail.jpg"]
+        generate_renditions("test_source", names)
+
+        with PILImage.open(images.storage.local_path(names[0])) as original:
+            assert original.info.get("progressive")
+            assert original.info.get("icc_profile") == profile
+        with PILImage.open(images.storage.local_path(names[2])) as thumbnail:
+            assert not thumbnail.info.get("progressive")
+            assert thumbnail.info.get("icc_profile") is None
+
+
+def gradient(width: int, height: int) -> PILImage.Image:
+    # Red grows to the right, green to the bottom, so a crop of the wrong part of the image changes the colors
+    horizontal = PILImage.linear_gradient("L").rotate(90).transpose(PILImage.Transpose.FLIP_LEFT_RIGHT)
+    vertical = PILImage.linear_gradient("L")
+    return PILImage.merge("RGB", (horizontal.resize((width, height)), vertical.resize((width, height)),
+                                  PILImage.new("L", (width, height), 128)))
+
+
+def assert_center_framed(names, source):
+    for name, (width, height) in zip(names, SIZES):
+        with PILImage.open(images.storage.local_path(name)) as rendition:
+            assert rendition.size == (width, height)
+            expected = Image.crop_center(source, width, height).resize((width, height))
+            difference = ImageStat.Stat(ImageChops.difference(rendition.convert("RGB"), expected)).mean
+            assert max(difference) < 4, (name, difference)
+
+
+def test_generate_renditions_large_jpeg():
+    source = gradient(4000, 3000)
+
+    with tempfile.TemporaryDirectory() as output, mock.patch.object(images, "storage", LocalStorage(output, "")):
+        source.save(Path(output, "test_source"), "JPEG", quality=95)
+
+        # Drafted by the decoder to half the size, which still covers the largest rendition
+        with open(Path(output, "test_source"), "rb") as file, images.open_image(file) as raw_image:
+            decoded = decode_for_renditions(raw_image, SIZES)
+            assert raw_image.size == decoded.size == (2000, 1500)
+
+        names = ["test_original.jpg", "test_preview.jpg", "test_thumbnail.jpg"]
+        generate_renditions("test_source", names)
+        assert_center_framed(names, source)
+
+
+def test_generate_renditions_large_png():
+    source = gradient(4000, 3000)
+
+    with tempfile.TemporaryDirectory() as output, mock.patch.object(images, "storage", LocalStorage(output, "")):
+        source.save(Path(output, "test_source"), "PNG")
+
+        # Decoded fully, then reduced
+        with open(Path(output, "test_source"), "rb") as file, images.open_image(file) as raw_image:
+            decoded = decode_for_renditions(raw_image, SIZES)
+            assert raw_image.size == (4000, 3000)
+            assert decoded.size == (2000, 1500)
+
+        names = ["test_original.jpg", "test_preview.jpg", "test_thumbnail.jpg"]
+        generate_renditions("test_source", names)
+        assert_center_framed(names, source)
+
+
+def test_render_rendition():
+    with tempfile.TemporaryDirectory() as output, mock.patch.object(images, "storage", LocalStorage(output, "")):
+        PILImage.new("RGB", (3000, 2000), (0, 128, 0)).save(Path(output, "test_source"), "JPEG")
+
+        for extension, fmt in (("jpg", "JPEG"), ("webp", "WEBP"), ("avif", "AVIF")):
+            render_rendition("test_source", str(Path(output, "rendition")), 320, 320, extension)
+            with PILImage.open(Path(output, "rendition")) as rendition:
+                assert rendition.size == (320, 320)
+                assert rendition.format == fmt
+
+
+def test_profile_digest():
+    digest = images.profile_digest("webp")
+    assert digest == images.profile_digest("webp")
+    assert digest != images.profile_digest("avif")
 
+    with mock.patch.dict(images.ENCODING_PROFILES["webp"], {"quality": 80}):
+        assert images.profile_digest("webp") != digest
 
 # def test_from_base64_save():
 #     # Get base64 image from file
@@ -8,7 +8,7 @@ environ["IMAGE_OUTPUT"] = "test_output"
 
 import unittest
 from exc import ImageNotFoundError
-from images import Image
+from images import Image, IMAGE_CLAIM_TIMEOUT
 import db
 
 
@@ -53,6 +53,39 @@ class images_test(unittest.TestCase):
         self.assertEqual(result[0].image_id, 1)
         db.disconnect()
 
+    def test_get_images_by_ids(self):
+        db.connect()
+        db.execute("DELETE FROM piwegro.images", ())
+        for i in (1, 2, 3):
+            db.execute("INSERT INTO piwegro.images (id, original, thumbnail, preview) VALUES (%s, %s, %s, %s)",
+                       (i, 'test', 'test', 'test'))
+        result = Image.get_images_by_ids([3, 1, 2])
+        self.assertEqual([image.image_id for image in result], [3, 1, 2])
+        with self.assertRaises(ImageNotFoundError):
+            Image.get_images_by_ids([1, 4])
+        db.disconnect()
+
+    def test_get_images_by_offer_ids(self):
+        db.connect()
+        db.execute("DELETE FROM piwegro.images", ())
+        db.execute("DELETE FROM piwegro.offers WHERE seller_id='7'", ())
+        db.execute("DELETE FROM piwegro.users WHERE id='7'", ())
+        db.execute("INSERT INTO piwegro.currencies (symbol, name, exchange_rate) VALUES ('PER', 'Perla', 1.0) "
+                   "ON CONFLICT DO NOTHING", ())
+        db.execute("INSERT INTO piwegro.users (id, name, email) VALUES ('7', 'Ewa', 'ewa@mail.com')", ())
+        offer_ids = [db.fetch("INSERT INTO piwegro.offers (seller_id, name, description, price, currency, images) "
+                              "VALUES ('7', 'test', 'test', 1, 'PER', '{}') RETURNING id", ())[0][0]
+                     for _ in range(3)]
+        for image_id, offer_id in ((3, offer_ids[0]), (1, offer_ids[0]), (2, offer_ids[1])):
+            db.execute("INSERT INTO piwegro.images (id, offer_id, original, thumbnail, preview) "
+                       "VALUES (%s, %s, %s, %s, %s)", (image_id, offer_id, 'test', 'test', 'test'))
+        result = Image.get_images_by_offer_ids(offer_ids)
+        self.assertEqual([[image.image_id for image in result[offer_id]] for offer_id in offer_ids], [[1, 3], [2], []])
+        db.execute("DELETE FROM piwegro.images", ())
+        db.execute("DELETE FROM piwegro.offers WHERE seller_id='7'", ())
+        db.execute("DELETE FROM piwegro.users WHERE id='7'", ())
+        db.disconnect()
+
     def test_dummies(self):
         images = Image.dummies()
         self.assertEqual(len(images), 3)
@@ -67,4 +100,65 @@ class images_test(unittest.TestCase):
         img.associate_with_offer(2)
         img = Image.get_image_by_id(1)
         result = db.fetch("SELECT offer_id FROM piwegro.images WHERE id = 1", ())
-        self.assertEqual(result[0][0], 2)
\ No newline at end of file
+        self.assertEqual(result[0][0], 2)
+
+    def test_insert_pending(self):
+        db.connect()
+        db.execute("DELETE FROM piwegro.images", ())
+        db.execute("DELETE FROM piwegro.image_blobs", ())
+        images = [Image(None, None, f'{i}_o', f'{i}_p', f'{i}_t', source=f'{i}_source', content_hash=str(i) * 64)
+                  for i in range(3)]
+        Image.insert_pending(images)
+        for image in images:
+            result = db.fetch("SELECT source, status FROM piwegro.images WHERE id = %s", (image.image_id,))
+            self.assertEqual(result[0][0], image.source)
+            self.assertEqual(result[0][1], 'pending')
+            self.assertTrue(image.needs_renditions)
+        db.disconnect()
+
+    def test_insert_pending_stale_claim(self):
+        db.connect()
+        db.execute("DELETE FROM piwegro.images", ())
+        db.execute("DELETE FROM piwegro.image_blobs", ())
+        new = lambda: Image(None, None, 'b_o', 'b_p', 'b_t', source='b_source', content_hash='b' * 64)
+
+        first = new()
+        Image.insert_pending([first])
+        self.assertTrue(first.needs_renditions)
+
+        # Claimed by a worker that is still generating the renditions
+        again = new()
+        Image.insert_pending([again])
+        self.assertFalse(again.needs_renditions)
+
+        # The worker died, the claim is taken again once it is older than the timeout
+        db.execute("UPDATE piwegro.image_blobs SET claimed_at = NOW() - make_interval(secs => %s) WHERE hash = %s",
+                   (IMAGE_CLAIM_TIMEOUT + 1, 'b' * 64))
+        last = new()
+        Image.insert_pending([last])
+        self.assertTrue(last.needs_renditions)
+        self.assertEqual(last.status, 'pending')
+        db.disconnect()
+
+    def test_insert_pending_duplicates(self):
+        db.connect()
+        db.execute("DELETE FROM piwegro.images", ())
+        db.execute("DELETE FROM piwegro.image_blobs", ())
+        new = lambda: Image(None, None, 'a_o', 'a_p', 'a_t', source='a_source', content_hash='a' * 64)
+
+        images = [new(), new()]
+        Image.insert_pending(images)
+        self.assertEqual(len({image.image_id for image in images}), 2)
+        self.assertEqual([image.needs_renditions for image in images].count(True), 1)
+
+        images[0].set_status('ready', 'data:image/jpeg;base64,AA==')
+        self.assertEqual(Image.get_image_by_id(images[1].image_id).placeholder, 'data:image/jpeg;base64,AA==')
+        again = new()
+        Image.insert_pending([again])
+        self.assertEqual(again.status, 'ready')
+        self.assertEqual(again.placeholder, 'data:image/jpeg;base64,AA==')
+        self.assertFalse(again.needs_renditions)
+
+        result = db.fetch("SELECT refcount FROM piwegro.image_blobs WHERE hash = %s", ('a' * 64,))
+        self.assertEqual(result[0][0], 3)
+        db.disconnect()
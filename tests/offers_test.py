@@ -7,11 +7,20 @@ environ["POSTGRES_DB_MAIN"] = "test_database"
 environ["SERVICE_ACCOUNT_PATH"] = "test/path"
 environ["IMAGE_OUTPUT"] = "test/output"
 
+import json
 import unittest
-from offers import Offer
+from unittest import mock
+import offers
+from offers import Offer, RESULTS_PER_PAGE, SEARCH_QUERIES, SELECT_OFFERS, search_queries
 from currencies import Currency, Price
-from users import User
+from users import User, user_cache
 import db
+from exc import InvalidCursorError, PostgresError
+from pagination import encode_cursor, decode_cursor
+from fieldsets import offer_fieldset, parse_fieldset
+from fragments import offer_fragments
+from json_encoder import encode_offer_rows
+import serializer
 
 class offers_test(unittest.TestCase):
 
@@ -33,4 +42,189 @@ class offers_test(unittest.TestCase):
         db.execute("DELETE FROM piwegro.users WHERE id='5'", ())
         db.disconnect()
 
+    def test_new_offers_from_rows_constant_queries(self):
+        db.connect()
+        db.execute("DELETE FROM piwegro.images", ())
+        db.execute("DELETE FROM piwegro.offers WHERE seller_id='6'", ())
+        db.execute("DELETE FROM piwegro.accepted_currencies WHERE user_id='6'", ())
+        db.execute("DELETE FROM piwegro.users WHERE id='6'", ())
+        db.execute("INSERT INTO piwegro.currencies (symbol, name, exchange_rate) VALUES ('PER', 'Perla', 1.0) "
+                   "ON CONFLICT DO NOTHING", ())
+        db.execute("INSERT INTO piwegro.users (id, name, email) VALUES ('6', 'Ola', 'ola@mail.com')", ())
+        db.execute("INSERT INTO piwegro.accepted_currencies (user_id, currency_symbol) VALUES ('6', 'PER')", ())
+        for i in range(15):
+            result = db.fetch("INSERT INTO piwegro.offers (seller_id, name, description, price, currency, images) "
+                              "VALUES ('6', 'test', 'test', 1, 'PER', '{}') RETURNING id", ())
+            db.execute("INSERT INTO piwegro.images (offer_id, original, thumbnail, preview) "
+                       "VALUES (%s, 'test', 'test', 'test')", (result[0][0],))
+        rows = db.fetch(SELECT_OFFERS + " WHERE seller_id='6'", ())
+
+        before = db.pool_stats().queries
+        offers = Offer.new_offers_from_rows(rows)
+        queries = db.pool_stats().queries - before
+
+        self.assertEqual(len(offers), 15)
+        self.assertEqual(len(offers[0].images), 1)
+        self.assertEqual(offers[0].seller.accepted_currencies[0].symbol, 'PER')
+        self.assertLessEqual(queries, 4)
+
+        # The sellers are not loaded without the prices, the images are loaded without their URLs
+        token = offer_fieldset.set(parse_fieldset('offer_id,title,seller,images', ''))
+        try:
+            before = db.pool_stats().queries
+            offers = Offer.new_offers_from_rows(rows)
+            self.assertEqual(db.pool_stats().queries - before, 1)
+            self.assertEqual(offers[0].seller.uid, '6')
+            self.assertIsNone(offers[0].images[0].original)
+
+            offer_fieldset.set(parse_fieldset('offer_id,title', None))
+            before = db.pool_stats().queries
+            Offer.new_offers_from_rows(rows)
+            self.assertEqual(db.pool_stats().queries - before, 0)
+        finally:
+            offer_fieldset.reset(token)
+        db.disconnect()
+
+    def test_encode_offer_rows(self):
+        db.connect()
+        db.execute("INSERT INTO piwegro.currencies (symbol, name, exchange_rate) VALUES ('PER', 'Perla', 1.0) "
+                   "ON CONFLICT DO NOTHING", ())
+        db.execute("INSERT INTO piwegro.users (id, name, email) VALUES ('9', 'Iza', 'iza@mail.com')", ())
+        db.execute("INSERT INTO piwegro.accepted_currencies (user_id, currency_symbol) VALUES ('9', 'PER')", ())
+        for i in range(3):
+            db.execute("INSERT INTO piwegro.offers (seller_id, name, description, price, currency, images) "
+                       "VALUES ('9', 'test', 'test', 1, 'PER', '{}')", ())
+        rows = db.fetch(SELECT_OFFERS + " WHERE seller_id='9'", ())
+
+        fragments = encode_offer_rows(rows)
+        self.assertEqual(serializer.dumps(fragments), serializer.dumps(Offer.new_offers_from_rows(rows)))
+
+        # Serialized again from the cache, without loading the images
+        before = db.pool_stats().queries
+        self.assertEqual(encode_offer_rows(rows), fragments)
+        self.assertEqual(db.pool_stats().queries - before, 0)
+
+        # An offer changed elsewhere (e.g. by another worker) has a new row version
+        offer_id = rows[0][0]
+        db.execute("UPDATE piwegro.offers SET name = 'changed' WHERE id = %s", (offer_id,))
+        rows = db.fetch(SELECT_OFFERS + " WHERE seller_id='9'", ())
+        changed = {json.loads(fragment)['offer_id']: json.loads(fragment)['title']
+                   for fragment in encode_offer_rows(rows)}
+        self.assertEqual(changed[offer_id], 'changed')
+        self.assertEqual(list(changed.values()).count('test'), 2)
+
+        # The prices change with the accepted currencies of the seller
+        invalidations = offer_fragments.stats()['invalidations']
+        User.get_user_by_id('9').update_accepted_currencies([])
+        self.assertEqual(offer_fragments.stats()['invalidations'] - invalidations, 3)
+        self.assertEqual(json.loads(encode_offer_rows(rows)[0])['price'], [])
+
+        # Changed through another worker: nothing is invalidated here and the seller is still in the user cache
+        db.execute("INSERT INTO piwegro.accepted_currencies (user_id, currency_symbol) VALUES ('9', 'PER')", ())
+        rows = db.fetch(SELECT_OFFERS + " WHERE seller_id='9'", ())
+        self.assertEqual(len(json.loads(encode_offer_rows(rows)[0])['price']), 1)
+
+        db.execute("DELETE FROM piwegro.offers WHERE seller_id='9'", ())
+        db.execute("DELETE FROM piwegro.accepted_currencies WHERE user_id='9'", ())
+        db.execute("DELETE FROM piwegro.users WHERE id='9'", ())
+        db.disconnect()
+
+    def test_get_version(self):
+        db.connect()
+        db.execute("INSERT INTO piwegro.currencies (symbol, name, exchange_rate) VALUES ('PER', 'Perla', 1.0) "
+                   "ON CONFLICT DO NOTHING", ())
+        db.execute("INSERT INTO piwegro.users (id, name, email) VALUES ('8', 'Ewa', 'ewa@mail.com')", ())
+        offer_id = db.fetch("INSERT INTO piwegro.offers (seller_id, name, description, price, currency, images) "
+                            "VALUES ('8', 'test', 'test', 1, 'PER', '{}') RETURNING id", ())[0][0]
+        self.assertIsNone(Offer.get_version('0'))
+        offer_version, seller_version = Offer.get_version(str(offer_id))
+
+        # The images of the offer and the accepted currencies of the seller are a part of it
+        db.execute("INSERT INTO piwegro.images (offer_id, original, thumbnail, preview) "
+                   "VALUES (%s, 'test', 'test', 'test')", (offer_id,))
+        self.assertEqual(Offer.get_version(str(offer_id)), (offer_version + 1, seller_version))
+
+        seller = User.get_user_by_id('8')
+        db.execute("INSERT INTO piwegro.accepted_currencies (user_id, currency_symbol) VALUES ('8', 'PER')", ())
+        self.assertEqual(Offer.get_version(str(offer_id)), (offer_version + 1, seller_version + 1))
+
+        # The seller cached before is older now
+        self.assertEqual(seller.version, seller_version)
+        self.assertIsNone(user_cache.get('8'))
+        self.assertEqual(User.get_user_by_id('8').version, seller_version + 1)
+
+        db.execute("DELETE FROM piwegro.images WHERE offer_id = %s", (offer_id,))
+        db.execute("DELETE FROM piwegro.offers WHERE id = %s", (offer_id,))
+        db.execute("DELETE FROM piwegro.accepted_currencies WHERE user_id='8'", ())
+        db.execute("DELETE FROM piwegro.users WHERE id='8'", ())
+        db.disconnect()
+
+    def test_search_mode(self):
+        self.assertIs(search_queries('levenshtein'), SEARCH_QUERIES['levenshtein'])
+        with self.assertRaises(ValueError):
+            search_queries('trigrams')
+
+    def test_search_cursor(self):
+        # The score is selected last
+        rows = [(100 - i,) + (None,) * 10 + (0.5 - i / 64,) for i in range(RESULTS_PER_PAGE + 1)]
+        last = rows[RESULTS_PER_PAGE - 1]
+        calls = []
+
+        def fetch(query, params):
+            calls.append((query, params))
+            return rows
+
+        for mode in SEARCH_QUERIES:
+            with self.subTest(mode=mode), mock.patch.object(offers, 'SEARCH_MODE', mode), \
+                    mock.patch.object(offers, 'fetch', fetch):
+                result, cursor = Offer.search_offer_rows_page('szafa', 0)
+                self.assertEqual(result, rows[:RESULTS_PER_PAGE])
+                self.assertEqual(decode_cursor(cursor, 2), [last[-1], last[0]])
+
+                Offer.search_offer_rows_page('szafa', cursor=cursor)
+                query, params = calls[-1]
+                self.assertEqual(query, SEARCH_QUERIES[mode]['after'])
+                self.assertEqual((params['score'], params['offer_id']), (last[-1], last[0]))
+
+                with self.assertRaises(InvalidCursorError):
+                    Offer.search_offer_rows_page('szafa', cursor=encode_cursor('best', 1))
+
+        # The similarity is a real, compared as a double it would never equal the score of the cursor
+        self.assertIn('%(score)s::real', SEARCH_QUERIES['trigram']['after'])
+
+    def test_search_offers_pages(self):
+        db.connect()
+        db.execute("INSERT INTO piwegro.currencies (symbol, name, exchange_rate) VALUES ('PER', 'Perla', 1.0) "
+                   "ON CONFLICT DO NOTHING", ())
+        db.execute("INSERT INTO piwegro.users (id, name, email) VALUES ('10', 'Ala', 'ala@mail.com')", ())
+        names = ['szafa', 'szafy', 'szafka', 'szafek']
+        offer_ids = set()
+        for i in range(2 * RESULTS_PER_PAGE - 5):
+            offer_ids.add(db.fetch("INSERT INTO piwegro.offers (seller_id, name, description, price, currency, "
+                                   "images) VALUES ('10', %s, 'test', 1, 'PER', '{}') RETURNING id",
+                                   (names[i % len(names)],))[0][0])
+
+        for mode, extension in (('levenshtein', 'fuzzystrmatch'), ('trigram', 'pg_trgm')):
+            with self.subTest(mode=mode), mock.patch.object(offers, 'SEARCH_MODE', mode):
+                try:
+                    db.execute(f"CREATE EXTENSION IF NOT EXISTS {extension}", ())
+                except PostgresError:
+                    self.skipTest(f"{extension} is not available")
+
+                by_number = Offer.search_offer_rows_page('szafa', 0)[0] + Offer.search_offer_rows_page('szafa', 1)[0]
+
+                result, cursor = Offer.search_offer_rows_page('szafa', 0)
+                by_cursor = list(result)
+                while cursor is not None:
+                    result, cursor = Offer.search_offer_rows_page('szafa', cursor=cursor)
+                    by_cursor += result
+
+                # The best fits first, every offer exactly once
+                self.assertEqual([row[0] for row in by_cursor], [row[0] for row in by_number])
+                self.assertEqual(set(row[0] for row in by_cursor), offer_ids)
+                self.assertEqual(by_cursor[0][2], 'szafa')
+
+        db.execute("DELETE FROM piwegro.offers WHERE seller_id='10'", ())
+        db.execute("DELETE FROM piwegro.users WHERE id='10'", ())
+        db.disconnect()
 
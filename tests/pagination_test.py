@@ -0,0 +1,39 @@
+import unittest
+
+from exc import InvalidCursorError
+from pagination import encode_cursor, decode_cursor, parse_page
+
+
+class pagination_test(unittest.TestCase):
+    def test_round_trip(self):
+        cursor = encode_cursor("2022-10-31T18:32:19", 42)
+        self.assertEqual(decode_cursor(cursor, 2), ["2022-10-31T18:32:19", 42])
+
+    def test_cursor_is_url_safe(self):
+        cursor = encode_cursor("2022-10-31T18:32:19.123456", 123456789)
+        self.assertNotIn("/", cursor)
+        self.assertNotIn("+", cursor)
+        self.assertNotIn("=", cursor)
+
+    def test_decode_garbage(self):
+        with self.assertRaises(InvalidCursorError):
+            decode_cursor("not a cursor", 2)
+
+    def test_decode_wrong_length(self):
+        with self.assertRaises(InvalidCursorError):
+            decode_cursor(encode_cursor(1, 2, 3), 2)
+
+    def test_parse_page_number(self):
+        self.assertEqual(parse_page("10"), (10, None))
+
+    def test_parse_page_cursor(self):
+        cursor = encode_cursor("2022-10-31T18:32:19", 42)
+        self.assertEqual(parse_page(cursor), (None, cursor))
+
+    def test_parse_negative_page(self):
+        with self.assertRaises(InvalidCursorError):
+            parse_page("-1")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,14 @@
 import unittest
 from os import environ
+from unittest import mock
 
 environ["POSTGRES_HOST"] = "localhost"
 environ["POSTGRES_USER"] = "postgres"
 environ["POSTGRES_PASSWORD"] = "postgres"
 environ["POSTGRES_DB_MAIN"] = "test_database"
 
-from currencies import Price, Currency
+from currencies import Price, Currency, convert_prices
+import currencies
 
 class price_test(unittest.TestCase):
     def test_str(self):
@@ -29,3 +31,23 @@ class price_test(unittest.TestCase):
         converted = price.convert_to(currency2)
 
         self.assertEqual(converted.amount, 2)
+
+    def test_convert_prices(self):
+        targets = [Currency('Harnas', 'HAR', 1.0), Currency('Perla', 'PER', 3.7), Currency('US Dollar', 'USD', 2.0),
+                   Currency('Zloty', 'PLN', 0.25), Currency('Grosz', 'GR', 1e-9)]
+        # Below 1, halves rounded to even, and big amounts
+        amounts = [-3, 0, 1, 3, 5, 7, 10, 11, 1234, 1850, 2 ** 31 - 1]
+        prices = [Price(amount, targets[0]) for amount in amounts]
+        accepted = [targets[:i % len(targets) + 1] for i in range(len(amounts))]
+
+        expected = [[price.convert_to(c) for c in offer_currencies]
+                    for price, offer_currencies in zip(prices, accepted)]
+        for numpy in (currencies.numpy, None):
+            with mock.patch.object(currencies, 'numpy', numpy):
+                converted = convert_prices(prices, accepted)
+                self.assertEqual(converted, expected)
+                self.assertEqual([[type(p.amount) for p in c] for c in converted],
+                                 [[type(p.amount) for p in c] for c in expected])
+
+                with self.assertRaises(ZeroDivisionError):
+                    convert_prices(prices, [[Currency('Zero', 'ZER', 0.0)]] * len(prices))
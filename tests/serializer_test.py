@@ -0,0 +1,128 @@
+from os import environ
+
+environ["POSTGRES_HOST"] = "localhost"
+environ["POSTGRES_USER"] = "postgres"
+environ["POSTGRES_PASSWORD"] = "postgres"
+environ["POSTGRES_DB_MAIN"] = "test_database"
+environ["SERVICE_ACCOUNT_PATH"] = "test/path"
+environ["IMAGE_OUTPUT"] = "test/output"
+
+import json
+import unittest
+from datetime import datetime
+from flask import Flask, jsonify
+
+from currencies import Currency, Price
+from error import Error
+from images import Image
+from offers import Offer
+from users import User
+from json_encoder import APIJSONProvider, as_json, conditional, offer_fields
+import serializer
+
+
+def make_offer(value: float) -> Offer:
+    currencies = [Currency('Harnaś', 'HAR', 1.0), Currency('Perła', 'PER', value)]
+    seller = User('1', 'anna@mail.com', 'Zażółć gęślą jaźń 😀 \x7f "\\U0001"', currencies, [])
+    images = [Image(None, 1, 'http://x/o.jpg', 'http://x/p.jpg', 'http://x/t.jpg'),
+              Image(None, 2, 'o.jpg', 'p.jpg', 't.jpg', status='pending')]
+    return Offer(1, 'Półeczka', 'Opis\n\t\x01', Price(1234, currencies[0]), seller, images, 'Kraków',
+                 datetime(2022, 10, 31, 18, 32, 19, 5))
+
+
+class serializer_test(unittest.TestCase):
+
+    def test_same_as_standard_library(self):
+        for value in (3.7, 0.1 + 0.2, 1e-4, 0.00001234, 2.5e17, float('nan')):
+            payload = {'offers': [make_offer(value)], 'next_cursor': None, 'error': Error('Nie znaleziono')}
+            expected = json.dumps(payload, default=serializer.default, ensure_ascii=True, sort_keys=True,
+                                  separators=(',', ':')).encode()
+            self.assertEqual(serializer.dumps_json(payload), expected)
+            if serializer.orjson is not None:
+                self.assertEqual(serializer.dumps_orjson(payload), expected)
+
+    def test_big_integers(self):
+        payload = {'a': 2 ** 70, 'b': 'ó'}
+        self.assertEqual(serializer.dumps(payload), b'{"a":1180591620717411303424,"b":"\\u00f3"}')
+
+    def test_unknown_type(self):
+        with self.assertRaises(TypeError):
+            serializer.dumps({'a': object()})
+
+    def test_stream(self):
+        batches = [[make_offer(3.7), make_offer(0.25)], [], [make_offer(2.5e17)]]
+        self.assertEqual(b''.join(serializer.stream_array(batches)), serializer.dumps(sum(batches, [])) + b'\n')
+        self.assertEqual(b''.join(serializer.stream_array([[]])), b'[]\n')
+
+        lines = b''.join(serializer.stream_lines(batches)).splitlines()
+        self.assertEqual(lines, [serializer.dumps(offer) for offer in sum(batches, [])])
+
+    def test_fragment(self):
+        offers = [make_offer(3.7), make_offer(0.25)]
+        fragments = [serializer.Fragment(serializer.dumps(offer)) for offer in offers]
+
+        self.assertEqual(serializer.dumps(fragments[0]), serializer.dumps(offers[0]))
+        self.assertEqual(serializer.dumps(fragments), serializer.dumps(offers))
+        self.assertEqual(b''.join(serializer.stream_array([fragments[:1], fragments[1:]])),
+                         serializer.dumps(offers) + b'\n')
+        # Nested in something else, it is serialized again
+        self.assertEqual(serializer.dumps({'offer': fragments[0]}), serializer.dumps({'offer': offers[0]}))
+
+    def test_response(self):
+        app = Flask(__name__)
+        app.json = APIJSONProvider(app)
+        with app.test_request_context():
+            response = jsonify(Currency('Złoty', 'PLN', 0.25))
+        self.assertEqual(response.get_data(), b'{"name":"Z\\u0142oty","symbol":"PLN","value":0.25}\n')
+        self.assertEqual(response.mimetype, 'application/json')
+
+    def test_conditional(self):
+        app = Flask(__name__)
+        app.json = APIJSONProvider(app)
+        calls = []
+
+        @app.route('/currency/<symbol>')
+        @conditional(lambda symbol: None if symbol == 'XXX' else (symbol, 1))
+        @as_json
+        def view(symbol):
+            calls.append(symbol)
+            return Currency('Złoty', symbol, 0.25), 200
+
+        client = app.test_client()
+        response = client.get('/currency/PLN')
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        response = client.get('/currency/PLN', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(calls, ['PLN'])
+
+        self.assertEqual(client.get('/currency/HAR', headers={'If-None-Match': etag}).status_code, 200)
+        self.assertNotIn('ETag', client.get('/currency/XXX').headers)
+
+    def test_offer_fields(self):
+        app = Flask(__name__)
+        app.json = APIJSONProvider(app)
+
+        @app.route('/offer')
+        @offer_fields
+        @as_json
+        def view():
+            return make_offer(3.7), 200
+
+        client = app.test_client()
+        self.assertEqual(client.get('/offer').data, serializer.dumps(make_offer(3.7)) + b'\n')
+
+        offer = client.get('/offer?fields=offer_id,price,seller,images&expand=').json
+        self.assertEqual(set(offer), {'offer_id', 'price', 'seller', 'images'})
+        self.assertEqual(offer['seller'], '1')
+        self.assertEqual(offer['images'], [1, 2])
+        self.assertEqual(len(offer['price']), 2)
+
+        offer = client.get('/offer?fields=title,images&expand=images').json
+        self.assertEqual(offer['images'][0]['original'], 'http://x/o.jpg')
+
+        response = client.get('/offer?fields=password')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {'error': 'Unknown field password.'})
+
@@ -0,0 +1,93 @@
+from os import environ
+
+environ["IMAGE_OUTPUT"] = "temp/path"
+
+import tempfile
+import unittest
+from io import BytesIO
+from pathlib import Path
+from uuid import uuid4
+
+import storage
+from storage import LocalStorage, S3Storage, Storage
+
+
+class storage_test(unittest.TestCase):
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            Storage()
+
+        class Incomplete(Storage):
+            def open(self, name):
+                return BytesIO()
+
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+
+class local_storage_test(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.storage = LocalStorage(self.directory.name, "http://localhost:8080")
+
+    def test_save_sharded(self):
+        self.storage.save("abcdef_original.jpg", BytesIO(b"image"))
+
+        path = Path(self.directory.name, "ab", "cd", "abcdef_original.jpg")
+        self.assertEqual(path.read_bytes(), b"image")
+        self.assertEqual(self.storage.local_path("abcdef_original.jpg"), path)
+        self.assertEqual([p.name for p in path.parent.iterdir()], ["abcdef_original.jpg"])
+
+    def test_reads_flat_layout(self):
+        Path(self.directory.name, "abcdef_original.jpg").write_bytes(b"image")
+
+        self.assertTrue(self.storage.exists("abcdef_original.jpg"))
+        with self.storage.open("abcdef_original.jpg") as f:
+            self.assertEqual(f.read(), b"image")
+
+        self.storage.move_to_shard("abcdef_original.jpg")
+        self.assertFalse(Path(self.directory.name, "abcdef_original.jpg").exists())
+        with self.storage.open("abcdef_original.jpg") as f:
+            self.assertEqual(f.read(), b"image")
+
+    def test_save_many_and_delete(self):
+        self.storage.save_many({f"{i}{i}_preview.jpg": BytesIO(bytes([i])) for i in range(5)})
+
+        for i in range(5):
+            self.assertTrue(self.storage.exists(f"{i}{i}_preview.jpg"))
+        self.storage.delete("00_preview.jpg")
+        self.assertFalse(self.storage.exists("00_preview.jpg"))
+
+    def test_rejects_paths(self):
+        for name in ("../secret", "a/b", ".hidden", ""):
+            with self.assertRaises(ValueError):
+                self.storage.local_path(name)
+
+    def test_url(self):
+        self.assertEqual(self.storage.url("abcdef_original.jpg"), "http://localhost:8080/image/abcdef_original.jpg")
+
+
+# Runs against an S3-compatible server, e.g. `minio server` with S3_TEST_ENDPOINT=http://localhost:9000
+@unittest.skipUnless(environ.get("S3_TEST_ENDPOINT") and storage.boto3, "No S3 endpoint to test against")
+class s3_storage_test(unittest.TestCase):
+    def setUp(self):
+        bucket = "harnas-test-" + uuid4().hex[:8]
+        self.storage = S3Storage(bucket, environ["S3_TEST_ENDPOINT"], prefix="images/")
+        self.storage.client.create_bucket(Bucket=bucket)
+
+    def test_save_open_delete(self):
+        self.storage.save_many({"abcdef_original.jpg": BytesIO(b"image"), "abcdef_preview.jpg": BytesIO(b"small")})
+
+        self.assertTrue(self.storage.exists("abcdef_original.jpg"))
+        with self.storage.open("abcdef_preview.jpg") as f:
+            self.assertEqual(f.read(), b"small")
+
+        self.storage.delete("abcdef_original.jpg")
+        self.assertFalse(self.storage.exists("abcdef_original.jpg"))
+        with self.assertRaises(FileNotFoundError):
+            self.storage.open("abcdef_original.jpg")
+
+    def test_url(self):
+        self.assertEqual(self.storage.url("abcdef_original.jpg"),
+                         f"{environ['S3_TEST_ENDPOINT']}/{self.storage.bucket}/images/abcdef_original.jpg")